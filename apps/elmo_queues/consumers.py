@@ -8,6 +8,8 @@ from __future__ import absolute_import
 from __future__ import unicode_literals
 
 import logging
+import os
+import queue
 
 from django.conf import settings
 from django.db import connection
@@ -17,6 +19,7 @@ from kombu.mixins import ConsumerMixin
 
 from life.models import Forest, Repository
 from pushes import utils
+from .dispatch import Coalescer, Dispatcher
 
 
 HGMO = Queue(
@@ -30,8 +33,16 @@ HGMO = Queue(
 
 
 class ElmoConsumer(ConsumerMixin):
-    def __init__(self, connection):
+    def __init__(self, connection, workers=None, window=None):
         self.connection = connection
+        if workers is None:
+            workers = settings.PULSE_WORKERS
+        if window is None:
+            window = settings.PULSE_COALESCE_WINDOW
+        self.dispatcher = Dispatcher(workers)
+        self.coalescer = Coalescer(window) if window else None
+        # messages handled by the workers, to be acked on our channel
+        self.done = queue.Queue()
 
     def get_consumers(self, Consumer, channel):
         return [
@@ -39,11 +50,94 @@ class ElmoConsumer(ConsumerMixin):
         ]
 
     def on_message(self, body, message):
-        if body['_meta']['exchange'] == HGMO.exchange.name:
+        if body['_meta']['exchange'] != HGMO.exchange.name:
+            logging.info("UNHANDLED MESSAGE: {0!r}".format(body))
+            message.ack()
+            return
+        repo_name = body['_meta']['routing_key']
+        if self.coalescer is not None:
+            if body['payload']['type'].startswith('changegroup.'):
+                self.coalescer.add(repo_name, body, message)
+                return
+            if repo_name in self.coalescer:
+                # keep the order of messages for this repository
+                self.dispatch(*self.coalescer.pop(repo_name))
+        self.dispatch(body, [message])
+
+    def dispatch(self, body, messages):
+        lane = self.lane(body['_meta']['routing_key'])
+        # Close the django db connection, the workers use their own
+        connection.close()
+        self.dispatcher.submit(lane, self.process, body, messages)
+
+    def lane(self, repo_name):
+        '''Serialize work on the local clone of the repository.
+
+        Forks in unified clones share the same local path. Repositories
+        unknown yet get the path they'll have once created by on_hg_newrepo.
+        '''
+        try:
+            return Repository.objects.get(name=repo_name).local_path()
+        except Repository.DoesNotExist:
+            pass
+        if '/' in repo_name:
+            forest_name, locale_code = repo_name.rsplit('/', 1)
+            try:
+                forest = Forest.objects.get(name=forest_name)
+                return os.path.join(forest.local_path(), locale_code)
+            except Forest.DoesNotExist:
+                pass
+        return repo_name
+
+    def process(self, body, messages):
+        '''Handle a message on a worker thread.
+
+        The messages are acked by the consumer thread, after the database
+        changes have been committed.
+        '''
+        try:
             self.on_hgpushes(body['_meta'], body['payload'])
+        except Exception:
+            # Requeue the message once, see on_iteration.
+            logging.exception(
+                f"Failed to handle {body['_meta']['routing_key']}"
+            )
+            connection.close()
+            handled = False
         else:
-            logging.info("UNHANDLED MESSAGE: {0!r}".format(body))
-        message.ack()
+            handled = True
+        for message in messages:
+            self.done.put((message, handled))
+
+    def on_iteration(self):
+        if self.coalescer is not None:
+            for _, body, messages in self.coalescer.pop_due():
+                self.dispatch(body, messages)
+        while True:
+            try:
+                message, handled = self.done.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                if handled:
+                    message.ack()
+                elif not message.delivery_info.get('redelivered'):
+                    message.requeue()
+                else:
+                    # Failed again, drop the message. The next push to
+                    # the repository picks up all pushes since the last
+                    # one we know.
+                    message.reject()
+            except Exception:
+                # The channel is gone, the broker will redeliver.
+                logging.exception("Failed to ack message")
+
+    def on_consume_end(self, connection, channel):
+        if self.coalescer is not None:
+            for _, body, messages in self.coalescer.pop_due(everything=True):
+                self.dispatch(body, messages)
+        self.dispatcher.join()
+        self.on_iteration()
 
     def on_hgpushes(self, meta, payload):
         repo_name = meta['routing_key']
@@ -70,9 +164,11 @@ class ElmoConsumer(ConsumerMixin):
         logging.info(
             f"push:handle {repo.url} {repo.last_known_push()}-{new_pushid}"
         )
-        pushes = utils.PushJS.pushes_for(repo, new_pushid)
-        logging.info(f"push: found {len(pushes)} pushes for {repo_name}")
-        utils.handlePushes(repo.id, pushes)
+        for pushes in utils.PushJS.pages_for(repo, new_pushid):
+            logging.info(
+                f"push: found {len(pushes)} pushes for {repo_name}"
+            )
+            utils.handlePushes(repo.id, pushes)
 
     def on_hg_newrepo(self, repo_name, payload):
         if '/' not in repo_name:
@@ -0,0 +1,113 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+'''Run consumer work in parallel, but in order per repository,
+and merge bursts of pushes to the same repository.
+'''
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import threading
+import time
+
+import markus
+from markus.utils import generate_tag
+
+
+metrics = markus.get_metrics('elmo_queues')
+
+
+class Dispatcher(object):
+    '''Run jobs on a pool of worker threads, in order per key.
+
+    Jobs with the same key run one after the other, in the order they
+    were submitted. Jobs for different keys run in parallel.
+    '''
+    def __init__(self, workers):
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self._idle = threading.Condition()
+        # pending jobs per key, while a job for that key is running
+        self._lanes = {}
+
+    def submit(self, key, fn, *args):
+        with self._idle:
+            if key in self._lanes:
+                self._lanes[key].append((fn, args))
+                return
+            self._lanes[key] = deque()
+        self.executor.submit(self._run, key, fn, args)
+
+    def join(self):
+        '''Wait until all submitted jobs are done.
+        '''
+        with self._idle:
+            self._idle.wait_for(lambda: not self._lanes)
+
+    def shutdown(self):
+        self.join()
+        self.executor.shutdown()
+
+    def _run(self, key, fn, args):
+        while True:
+            try:
+                fn(*args)
+            except Exception:
+                logging.exception('Job for {} failed'.format(key))
+            with self._idle:
+                if not self._lanes[key]:
+                    del self._lanes[key]
+                    self._idle.notify_all()
+                    return
+                fn, args = self._lanes[key].popleft()
+
+
+class Coalescer(object):
+    '''Merge changegroup messages for the same repository.
+
+    Messages are held for up to window seconds after the first one for
+    a repository came in. All messages in that window are merged into one
+    payload with the pushlog pushes of all of them, and thus into one
+    pull and ingestion up to the highest pushid.
+    '''
+    def __init__(self, window):
+        self.window = window
+        # repo_name -> [deadline, body, messages], in order of arrival
+        self._pending = OrderedDict()
+
+    def __contains__(self, repo_name):
+        return repo_name in self._pending
+
+    def add(self, repo_name, body, message):
+        if repo_name not in self._pending:
+            self._pending[repo_name] = [
+                time.monotonic() + self.window, body, [message]
+            ]
+            return
+        pending = self._pending[repo_name]
+        pending[1]['payload']['data']['pushlog_pushes'].extend(
+            body['payload']['data']['pushlog_pushes']
+        )
+        pending[2].append(message)
+        metrics.incr(
+            'coalesced', tags=[generate_tag('repo', repo_name)]
+        )
+
+    def pop(self, repo_name):
+        '''Remove the pending messages for repo_name,
+        returns the merged body and the messages.
+        '''
+        _, body, messages = self._pending.pop(repo_name)
+        return body, messages
+
+    def pop_due(self, everything=False):
+        '''Remove and yield the repository name, merged body and messages
+        for all repositories with an expired window.
+        '''
+        now = time.monotonic()
+        for repo_name, (deadline, _, _) in list(self._pending.items()):
+            if everything or deadline <= now:
+                yield (repo_name,) + self.pop(repo_name)
@@ -39,4 +39,5 @@ class Command(BaseCommand):
             except KeyboardInterrupt:
                 pass
             finally:
+                c.dispatcher.shutdown()
                 pulse.release()
@@ -0,0 +1,91 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+'''Record hgpushes messages from pulse, for replay-pulse.
+'''
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import json
+import logging
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from kombu import Connection, Queue
+from kombu.mixins import ConsumerMixin
+import requests
+
+from elmo_queues.consumers import HGMO
+
+
+# Separate queue, to not steal messages from consume-pulse
+RECORD = Queue(
+    f"queue/{settings.PULSE_USER}/hgmo-record",
+    routing_key="#", auto_delete=True, exchange=HGMO.exchange,
+)
+
+
+class Recorder(ConsumerMixin):
+    '''Write each hgpushes message as a JSON line to output.
+
+    For changegroup messages, the pushes from json-pushes are recorded,
+    too, as replay-pulse needs those to fake the json-pushes endpoint.
+    '''
+    def __init__(self, connection, output, limit=None):
+        self.connection = connection
+        self.output = output
+        self.limit = limit
+        self.count = 0
+
+    def get_consumers(self, Consumer, channel):
+        return [
+            Consumer([RECORD], callbacks=[self.on_message], accept=['json']),
+        ]
+
+    def on_message(self, body, message):
+        record = {'body': body}
+        payload = body.get('payload', {})
+        if payload.get('type', '').startswith('changegroup.'):
+            record['pushes'] = {}
+            for push in payload['data']['pushlog_pushes']:
+                record['pushes'].update(
+                    requests.get(push['push_json_url']).json()['pushes']
+                )
+        self.output.write(json.dumps(record) + '\n')
+        self.output.flush()
+        message.ack()
+        self.count += 1
+        if self.limit is not None and self.count >= self.limit:
+            self.should_stop = True
+
+
+class Command(BaseCommand):
+    help = 'Record hgpushes messages from pulse.m.o to a JSONL file'
+
+    def add_arguments(self, parser):
+        parser.add_argument('output', help='File to append messages to')
+        parser.add_argument(
+            '--limit', type=int, default=None,
+            help='Stop after this many messages'
+        )
+
+    def handle(self, output, limit=None, **options):
+        logging.basicConfig(
+            level=logging.INFO, format="%(asctime)s - %(message)s"
+        )
+        with open(output, 'a') as fh, Connection(
+            hostname=settings.PULSE_HOST,
+            userid=settings.PULSE_USER,
+            password=settings.PULSE_PASSWORD,
+            ssl=settings.PULSE_SSL
+        ) as pulse:
+            recorder = Recorder(pulse, fh, limit=limit)
+            try:
+                recorder.run()
+            except KeyboardInterrupt:
+                pass
+            finally:
+                pulse.release()
+        self.stdout.write('Recorded {} messages\n'.format(recorder.count))
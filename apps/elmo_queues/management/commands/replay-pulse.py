@@ -0,0 +1,228 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+'''Replay hgpushes messages recorded by record-pulse, and benchmark
+the ingestion.
+
+The messages go through the consumer like messages from pulse, including
+the coalescing of bursts and the worker lanes. The replayed repositories
+are pulled from local upstream clones, and their pushlogs come from the
+recording. The urls stored in the database aren't changed. Set
+ELMO_REPOSITORY_BASE to keep the local clones of the replay apart.
+'''
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+from collections import defaultdict
+import json
+import os
+import threading
+import time
+from urllib.parse import parse_qs
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.db.backends.signals import connection_created
+from markus.testing import MetricsMock
+import requests
+
+from elmo_queues.consumers import ElmoConsumer
+from life.models import Changeset, Push, Repository
+from pushes import utils
+
+
+class JsonPushesAdapter(requests.adapters.BaseAdapter):
+    '''Stand-in for the json-pushes endpoint, serving recorded pushes.
+
+    Mounted on the session of pushes.utils for the replayed repositories.
+    '''
+    def __init__(self, pushes, urls):
+        super(JsonPushesAdapter, self).__init__()
+        # repo_name -> {pushid: push}
+        self.pushes = pushes
+        # repo url -> repo_name
+        self.urls = urls
+
+    def send(self, request, **kwargs):
+        base, query = request.url.split('json-pushes?', 1)
+        query = parse_qs(query)
+        start = int(query['startID'][0])
+        end = int(query['endID'][0])
+        pushes = self.pushes[self.urls[base]]
+        response = requests.Response()
+        response.status_code = 200
+        response.url = request.url
+        response.request = request
+        response._content = json.dumps({
+            'lastpushid': max(pushes) if pushes else 0,
+            'pushes': {
+                str(pushid): push for pushid, push in pushes.items()
+                if start < pushid <= end
+            },
+        }).encode('utf-8')
+        return response
+
+    def close(self):
+        pass
+
+
+class ReplayedMessage(object):
+    '''Stand-in for a kombu message, keeps track of how it got handled.
+
+    Replayed messages count as redelivered, failures aren't requeued.
+    '''
+    delivery_info = {'redelivered': True}
+
+    def __init__(self):
+        self.state = None
+
+    def ack(self):
+        self.state = 'ACK'
+
+    def reject(self):
+        self.state = 'REJECTED'
+
+    def requeue(self):
+        self.state = 'REQUEUED'
+
+
+class QueryTimer(object):
+    '''Execute wrapper counting and timing db queries on all threads.
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.count = 0
+        self.seconds = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.monotonic()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            with self.lock:
+                self.count += 1
+                self.seconds += time.monotonic() - start
+
+    def install(self, sender=None, connection=None, **kwargs):
+        '''Add to connection, connect to connection_created for
+        the connections of the worker threads.
+        '''
+        if self not in connection.execute_wrappers:
+            connection.execute_wrappers.append(self)
+
+
+class Command(BaseCommand):
+    help = 'Replay recorded hgpushes messages against local clones'
+
+    def add_arguments(self, parser):
+        parser.add_argument('input', help='JSONL file from record-pulse')
+        parser.add_argument(
+            '--upstream', required=True,
+            help='Directory with upstream clones, by repository name'
+        )
+        parser.add_argument(
+            '--workers', type=int, default=None,
+            help='Number of worker threads, instead of PULSE_WORKERS'
+        )
+        parser.add_argument(
+            '--window', type=int, default=None,
+            help='Coalescing window, instead of PULSE_COALESCE_WINDOW'
+        )
+
+    def handle(self, input, upstream=None, workers=None, window=None,
+               **options):
+        with open(input) as fh:
+            records = [json.loads(line) for line in fh if line.strip()]
+        upstream = os.path.abspath(upstream)
+        pushes = defaultdict(dict)
+        # repo url -> repo_name
+        urls = dict(
+            Repository.objects
+            .filter(name__in=set(
+                record['body']['_meta']['routing_key'] for record in records
+            ))
+            .values_list('url', 'name')
+        )
+        for record in records:
+            repo_name = record['body']['_meta']['routing_key']
+            pushes[repo_name].update(
+                (int(pushid), push)
+                for pushid, push in record.get('pushes', {}).items()
+            )
+            payload = record['body']['payload']
+            if payload['type'].startswith('newrepo.'):
+                repo_url = payload['data']['repo_url']
+                if not repo_url.endswith('/'):
+                    repo_url += '/'
+                urls.setdefault(repo_url, repo_name)
+        adapter = JsonPushesAdapter(pushes, urls)
+        timer = QueryTimer()
+        try:
+            for url, repo_name in urls.items():
+                utils.session.mount(url, adapter)
+                utils.pull_urls[url] = 'file://{}/{}/'.format(
+                    upstream, repo_name
+                )
+            push_count = Push.objects.count()
+            changeset_count = Changeset.objects.count()
+            timer.install(connection=connection)
+            connection_created.connect(timer.install)
+            with MetricsMock() as metrics:
+                start = time.monotonic()
+                messages = self.replay(records, workers, window)
+                elapsed = time.monotonic() - start
+            connection_created.disconnect(timer.install)
+            connection.execute_wrappers.remove(timer)
+            push_count = Push.objects.count() - push_count
+            changeset_count = Changeset.objects.count() - changeset_count
+        finally:
+            for url in urls:
+                utils.session.adapters.pop(url, None)
+                utils.pull_urls.pop(url, None)
+
+        def seconds(stat):
+            return sum(
+                record[2] for record in metrics.filter_records(
+                    fun_name='timing', stat=stat
+                )
+            ) / 1000
+
+        self.stdout.write(
+            'Replayed {} messages in {:.2f}s\n'.format(len(records), elapsed)
+        )
+        failed = sum(1 for message in messages if message.state != 'ACK')
+        if failed:
+            self.stdout.write('{} messages failed\n'.format(failed))
+        self.stdout.write('{} pushes, {:.2f} pushes/sec\n'.format(
+            push_count, push_count / elapsed if elapsed else 0
+        ))
+        self.stdout.write('{} changesets, {:.2f} changesets/sec\n'.format(
+            changeset_count, changeset_count / elapsed if elapsed else 0
+        ))
+        self.stdout.write('{:.1f} db queries per push\n'.format(
+            timer.count / push_count if push_count else 0
+        ))
+        self.stdout.write(
+            '{:.2f}s in hg pull, {:.2f}s in handlePushes, '
+            '{:.2f}s in db queries\n'.format(
+                seconds('hg.worker.hg-pull'),
+                seconds('hg.worker.handle-pushes'),
+                timer.seconds,
+            )
+        )
+
+    def replay(self, records, workers, window):
+        '''Pass the records to a consumer like pulse would,
+        and wait for all of them to be handled.
+        '''
+        consumer = ElmoConsumer(None, workers=workers, window=window)
+        messages = []
+        for record in records:
+            message = ReplayedMessage()
+            messages.append(message)
+            consumer.on_message(record['body'], message)
+            consumer.on_iteration()
+        consumer.on_consume_end(None, None)
+        consumer.dispatcher.shutdown()
+        return messages
@@ -2,16 +2,31 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import importlib
+import io
 import os
 import shutil
 import tempfile
+import threading
+import time
 from unittest import mock
 
 import hglib
 
+from django.core import management
+from django.test import override_settings, TransactionTestCase
+from elmo.test import TestCase
+from pushes import utils
+from pushes.hgpool import hg_pool
 from pushes.tests.base import RepoTestBase
 from elmo_queues import consumers
-from life.models import Changeset, File, Forest, Repository
+from elmo_queues.dispatch import Dispatcher
+from life.models import Changeset, File, Forest, Locale, Push, Repository
+
+
+Recorder = importlib.import_module(
+    'elmo_queues.management.commands.record-pulse'
+).Recorder
 
 
 @mock.patch('elmo_queues.consumers.logging', mock.MagicMock())
@@ -90,3 +105,269 @@ class TestHandleRepo(RepoTestBase):
             sorted((f.path for f in File.objects.all())),
             ['f1', 'f2']
         )
+        # imported in checkpointed batches, the heads are in the repo
+        repo = Repository.objects.get(name=self.repo_name)
+        self.assertTrue(os.path.isfile(os.path.join(
+            repo.local_path(), '.hg', utils.CHECKPOINT_FILE
+        )))
+        self.assertEqual(
+            repo.changesets.exclude(revision=utils.NULL_REVISION).count(), 2
+        )
+
+
+class TestDispatcher(TestCase):
+
+    def test_order(self):
+        dispatcher = Dispatcher(4)
+        done = []
+        blocker = threading.Event()
+
+        def job(key, i):
+            if key == 'slow':
+                blocker.wait(5)
+            done.append((key, i))
+
+        for i in range(3):
+            dispatcher.submit('slow', job, 'slow', i)
+            dispatcher.submit('fast', job, 'fast', i)
+        # the fast lane doesn't wait for the slow one
+        while len(done) < 3:
+            time.sleep(.01)
+        self.assertListEqual(done, [('fast', 0), ('fast', 1), ('fast', 2)])
+        blocker.set()
+        dispatcher.shutdown()
+        self.assertListEqual(
+            [i for key, i in done if key == 'slow'],
+            [0, 1, 2]
+        )
+
+
+@mock.patch('elmo_queues.consumers.logging', mock.MagicMock())
+class TestConsumer(TestCase):
+
+    def body(self, repo_name, type_='changegroup.1', pushids=()):
+        return {
+            '_meta': {
+                'exchange': consumers.HGMO.exchange.name,
+                'routing_key': repo_name,
+            },
+            'payload': {
+                'type': type_,
+                'data': {
+                    'pushlog_pushes': [{'pushid': i} for i in pushids],
+                },
+            },
+        }
+
+    @override_settings(REPOSITORY_BASE='/repos')
+    def test_lane(self):
+        ec = consumers.ElmoConsumer(None, workers=1)
+        forest = Forest.objects.create(name='l10n-central', url='http://x/')
+        fork = Forest.objects.create(
+            name='releases/l10n/beta', url='http://y/', fork_of=forest
+        )
+        de = Locale.objects.create(code='de')
+        repo = Repository.objects.create(
+            name='releases/l10n/beta/de', url='http://y/de/',
+            forest=fork, locale=de
+        )
+        self.assertEqual(
+            ec.lane('releases/l10n/beta/de'), repo.local_path()
+        )
+        self.assertEqual(
+            ec.lane('releases/l10n/beta/de'),
+            ec.lane('l10n-central/de')
+        )
+        self.assertEqual(
+            ec.lane('releases/l10n/beta/fr'),
+            ec.lane('l10n-central/fr')
+        )
+        self.assertEqual(ec.lane('unknown'), 'unknown')
+        ec.dispatcher.shutdown()
+
+    def test_ack(self):
+        ec = consumers.ElmoConsumer(None, workers=2, window=0)
+        good = mock.MagicMock()
+        bad = mock.MagicMock()
+        bad.delivery_info = {'redelivered': False}
+
+        def on_hgpushes(meta, payload):
+            self.assertFalse(good.ack.called)
+            if meta['routing_key'] == 'bad':
+                raise RuntimeError('bad push')
+
+        with mock.patch.object(ec, 'on_hgpushes', on_hgpushes):
+            ec.on_message(self.body('good'), good)
+            ec.on_message(self.body('bad'), bad)
+            ec.dispatcher.join()
+        # acks happen on the consumer thread
+        self.assertFalse(good.ack.called)
+        ec.on_iteration()
+        good.ack.assert_called_once_with()
+        self.assertFalse(good.reject.called)
+        # failed messages are requeued once
+        bad.requeue.assert_called_once_with()
+        self.assertFalse(bad.reject.called)
+        self.assertFalse(bad.ack.called)
+        bad.delivery_info = {'redelivered': True}
+        with mock.patch.object(ec, 'on_hgpushes', on_hgpushes):
+            ec.on_message(self.body('bad'), bad)
+            ec.dispatcher.join()
+        ec.on_iteration()
+        bad.reject.assert_called_once_with()
+        bad.requeue.assert_called_once_with()
+        ec.dispatcher.shutdown()
+
+    def test_coalesce(self):
+        ec = consumers.ElmoConsumer(None, workers=2, window=60)
+        handled = []
+        messages = [mock.MagicMock() for _ in range(5)]
+
+        def on_hgpushes(meta, payload):
+            handled.append((
+                meta['routing_key'],
+                payload['type'],
+                [p['pushid'] for p in payload['data']['pushlog_pushes']]
+            ))
+
+        with mock.patch.object(ec, 'on_hgpushes', on_hgpushes):
+            ec.on_message(self.body('de', pushids=[1]), messages[0])
+            ec.on_message(self.body('fr', pushids=[7]), messages[1])
+            ec.on_message(self.body('de', pushids=[2, 3]), messages[2])
+            ec.on_iteration()
+            ec.dispatcher.join()
+            # nothing is due yet
+            self.assertListEqual(handled, [])
+            # other messages flush pending pushes to keep the order
+            ec.on_message(
+                self.body('de', type_='obsolete.1'), messages[3]
+            )
+            ec.dispatcher.join()
+            self.assertListEqual(
+                handled,
+                [('de', 'changegroup.1', [1, 2, 3]), ('de', 'obsolete.1', [])]
+            )
+            ec.on_message(self.body('de', pushids=[4]), messages[4])
+            # expire the window
+            for pending in ec.coalescer._pending.values():
+                pending[0] = 0
+            ec.on_iteration()
+            ec.dispatcher.join()
+        self.assertListEqual(
+            sorted(handled[2:]),
+            [('de', 'changegroup.1', [4]), ('fr', 'changegroup.1', [7])]
+        )
+        ec.on_iteration()
+        for message in messages:
+            message.ack.assert_called_once_with()
+        ec.dispatcher.shutdown()
+
+
+@mock.patch('elmo_queues.consumers.logging', mock.MagicMock())
+@mock.patch('pushes.utils.logging', mock.MagicMock())
+class TestRecordReplay(TransactionTestCase):
+    '''The replay runs on worker threads with their own db connections,
+    which need to see the committed test data.
+    '''
+
+    repo_name = 'mozilla-central'
+
+    def setUp(self):
+        super(TestRecordReplay, self).setUp()
+        self.upstream = tempfile.mkdtemp()
+        self.repository_base = tempfile.mkdtemp()
+        self._settings_context = override_settings(
+            REPOSITORY_BASE=self.repository_base
+        )
+        self._settings_context.enable()
+
+    def tearDown(self):
+        hg_pool.clear()
+        shutil.rmtree(self.repository_base)
+        self._settings_context.disable()
+        shutil.rmtree(self.upstream)
+        super(TestRecordReplay, self).tearDown()
+
+    def body(self, pushids):
+        return {
+            '_meta': {
+                'exchange': consumers.HGMO.exchange.name,
+                'routing_key': self.repo_name,
+            },
+            'payload': {
+                'type': 'changegroup.1',
+                'data': {
+                    'pushlog_pushes': [
+                        {
+                            'pushid': pushid,
+                            'push_json_url': f'https://hg/{pushid}',
+                        }
+                        for pushid in pushids
+                    ],
+                },
+            },
+        }
+
+    def test_record_replay(self):
+        revs = []
+        upstream = os.path.join(self.upstream, self.repo_name)
+        with hglib.init(upstream).open() as hgrepo:
+            for i in range(3):
+                with open(hgrepo.pathto('file.dtd'), 'w') as fh:
+                    fh.write(f'<!ENTITY key "{i}">\n')
+                hgrepo.commit(user="Jane Doe <jdoe@foo.tld>",
+                              message=f"commit {i}", addremove=True)
+                revs.append(hgrepo.tip().node.decode('ascii'))
+        json_pushes = {
+            1: {'changesets': revs[:2], 'date': 1593532760, 'user': 'jdoe'},
+            2: {'changesets': revs[2:], 'date': 1593558780, 'user': 'jdoe'},
+        }
+        recording = os.path.join(self.upstream, 'pulse.jsonl')
+        output = io.StringIO()
+        recorder = Recorder(None, output, limit=2)
+
+        def get(url):
+            pushid = int(url.rsplit('/', 1)[1])
+            response = mock.MagicMock()
+            response.json.return_value = {
+                'pushes': {str(pushid): json_pushes[pushid]}
+            }
+            return response
+
+        with mock.patch('requests.get', get):
+            for pushid in json_pushes:
+                message = mock.MagicMock()
+                recorder.on_message(self.body([pushid]), message)
+                message.ack.assert_called_once_with()
+        self.assertTrue(recorder.should_stop)
+        with open(recording, 'w') as fh:
+            fh.write(output.getvalue())
+
+        Repository.objects.create(
+            name=self.repo_name, url='https://hg/mozilla-central/'
+        )
+        out = io.StringIO()
+        management.call_command(
+            'replay-pulse', recording, upstream=self.upstream,
+            workers=2, window=60, stdout=out
+        )
+        # the stored urls aren't touched, the local upstreams are gone
+        self.assertEqual(
+            Repository.objects.get(name=self.repo_name).url,
+            'https://hg/mozilla-central/'
+        )
+        self.assertDictEqual(utils.pull_urls, {})
+        self.assertNotIn('https://hg/mozilla-central/', utils.session.adapters)
+        self.assertListEqual(
+            list(Push.objects.order_by('push_id')
+                 .values_list('push_id', flat=True)),
+            [1, 2]
+        )
+        self.assertEqual(Changeset.objects.count(), 4)
+        out = out.getvalue()
+        self.assertIn('Replayed 2 messages', out)
+        self.assertIn('2 pushes', out)
+        self.assertIn('3 changesets', out)
+        self.assertIn('db queries per push', out)
+        self.assertIn('in db queries', out)
+        self.assertNotIn('failed', out)
@@ -0,0 +1,45 @@
+# Generated by Django 2.2.15 on 2026-10-18 17:55
+
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+import django.db.models.deletion
+
+
+CHUNK_SIZE = 10000
+
+
+def set_tips(apps, schema_editor):
+    Push = apps.get_model('life', 'Push')
+    PushChangesets = Push.changesets.through
+    tips = (
+        PushChangesets.objects
+        .filter(push=OuterRef('id'))
+        .order_by('-changeset')
+        .values('changeset')[:1]
+    )
+    last_id = Push.objects.aggregate(last=models.Max('id'))['last'] or 0
+    for start in range(0, last_id, CHUNK_SIZE):
+        (
+            Push.objects
+            .filter(id__gt=start, id__lte=start + CHUNK_SIZE)
+            .update(tip=Subquery(tips))
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('life', '0001_squashed_0004_auto_20191116_1511'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='push',
+            name='tip',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='life.Changeset'),
+        ),
+        migrations.RunPython(
+            set_tips,
+            migrations.RunPython.noop
+        ),
+    ]
@@ -0,0 +1,81 @@
+# Generated by Django 2.2.15 on 2026-10-18 18:07
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+CHUNK_SIZE = 10000
+
+
+def resolve_origins(apps, schema_editor):
+    '''Find the first push and canonical repository of existing
+    changesets, in chunks of changesets.
+    '''
+    Changeset = apps.get_model('life', 'Changeset')
+    ChangesetOrigin = apps.get_model('life', 'ChangesetOrigin')
+    Push = apps.get_model('life', 'Push')
+    Repository = apps.get_model('life', 'Repository')
+    PushChangesets = Push.changesets.through
+    RepositoryChangesets = Repository.changesets.through
+    last_id = Changeset.objects.aggregate(last=models.Max('id'))['last'] or 0
+    for start in range(0, last_id, CHUNK_SIZE):
+        in_chunk = {
+            'changeset_id__gt': start,
+            'changeset_id__lte': start + CHUNK_SIZE,
+        }
+        # changeset -> (push_date, push, repository) of the first push
+        first = {}
+        for cs_id, push_id, push_date, repo_id in (
+            PushChangesets.objects
+            .filter(**in_chunk)
+            .values_list(
+                'changeset_id', 'push_id', 'push__push_date',
+                'push__repository_id'
+            )
+        ):
+            candidate = (push_date, push_id, repo_id)
+            if cs_id not in first or candidate < first[cs_id]:
+                first[cs_id] = candidate
+        origins = {
+            cs_id: ChangesetOrigin(
+                changeset_id=cs_id, first_push_id=push_id,
+                repository_id=repo_id
+            )
+            for cs_id, (_, push_id, repo_id) in first.items()
+        }
+        # changesets that were never pushed get their first repository
+        for cs_id, repo_id in (
+            RepositoryChangesets.objects
+            .filter(**in_chunk)
+            .order_by('repository_id')
+            .values_list('changeset_id', 'repository_id')
+        ):
+            if cs_id not in origins:
+                origins[cs_id] = ChangesetOrigin(
+                    changeset_id=cs_id, repository_id=repo_id
+                )
+        ChangesetOrigin.objects.bulk_create(
+            origins.values(), batch_size=1000
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('life', '0002_push_tip'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChangesetOrigin',
+            fields=[
+                ('changeset', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='origin', serialize=False, to='life.Changeset')),
+                ('first_push', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='life.Push')),
+                ('repository', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='life.Repository')),
+            ],
+        ),
+        migrations.RunPython(
+            resolve_origins,
+            migrations.RunPython.noop
+        ),
+    ]
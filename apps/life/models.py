@@ -12,7 +12,7 @@ import os
 from django.conf import settings
 from django.db import models
 from django.dispatch import receiver
-from django.db.models.signals import post_save
+from django.db.models.signals import m2m_changed, post_save
 from django.core.cache import cache
 from django.utils.encoding import python_2_unicode_compatible
 from mbdb.models import File
@@ -85,6 +85,13 @@ class Branch(models.Model):
 
 
 class ChangesetManager(models.Manager):
+    def get_queryset(self):
+        # url() and __str__ use the origin, get it in the same query
+        return (
+            super(ChangesetManager, self).get_queryset()
+            .select_related('origin__repository')
+        )
+
     def get_by_natural_key(self, rev):
         return self.get(revision__startswith=rev)
 
@@ -120,6 +127,10 @@ class Changeset(models.Model):
         return self._children.exclude(revision='0' * 40)
 
     def url(self):
+        try:
+            return self.origin.repository.url + "rev/" + self.shortrev
+        except ChangesetOrigin.DoesNotExist:
+            pass
         try:
             return (self.pushes.order_by('push_date')[0].repository.url
                     + "rev/" + self.shortrev)
@@ -278,6 +289,7 @@ class Push(models.Model):
     user -- person who did the push
     push_date -- date and time of the push
     push_id -- unique id of the push
+    tip -- last changeset of the push, the one with the highest id
     """
     objects = PushManager()
     repository = models.ForeignKey(Repository, on_delete=models.CASCADE)
@@ -285,14 +297,16 @@ class Push(models.Model):
     user = models.CharField(max_length=200, db_index=True)
     push_date = models.DateTimeField('date of push', db_index=True)
     push_id = models.PositiveIntegerField(default=0)
+    # kept up to date by update_push_tip, or set by bulk inserts
+    tip = models.ForeignKey(Changeset, null=True, blank=True,
+                            related_name='+', on_delete=models.SET_NULL)
 
-    @property
-    def tip(self):
-        if hasattr(self, '_tip'):
-            return getattr(self, '_tip')
-        tip = self.changesets.order_by('-pk')[0]
-        setattr(self, '_tip', tip)
-        return tip
+    def update_tip(self):
+        self.tip_id = self.changesets.aggregate(tip=models.Max('id'))['tip']
+        if Push.tip.is_cached(self):
+            # drop the previous tip
+            Push.tip.field.delete_cached_value(self)
+        Push.objects.filter(id=self.id).update(tip=self.tip_id)
 
     def __str__(self):
         tip = self.tip.shortrev
@@ -302,6 +316,41 @@ class Push(models.Model):
         return (self.repository.name, self.tip.shortrev)
 
 
+@receiver(m2m_changed, sender=Push.changesets.through)
+def update_push_tip(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        instance.update_tip()
+        return
+    # changes through Changeset.pushes, instance is a changeset
+    if action == 'post_clear':
+        pushes = Push.objects.filter(tip=instance)
+    else:
+        pushes = Push.objects.filter(id__in=pk_set)
+    for push in pushes:
+        push.update_tip()
+
+
+class ChangesetOrigin(models.Model):
+    """first push and canonical repository of a changeset
+
+    Fields:
+    changeset -- the changeset
+    first_push -- earliest push of the changeset, if any
+    repository -- repository of the first push, or the first repository
+                  the changeset got imported into
+    """
+    changeset = models.OneToOneField(Changeset, primary_key=True,
+                                     related_name='origin',
+                                     on_delete=models.CASCADE)
+    first_push = models.ForeignKey(Push, null=True, blank=True,
+                                   related_name='+',
+                                   on_delete=models.SET_NULL)
+    repository = models.ForeignKey(Repository, related_name='+',
+                                   on_delete=models.CASCADE)
+
+
 class TreeManager(models.Manager):
     def get_by_natural_key(self, code):
         return self.get(code=code)
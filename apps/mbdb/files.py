@@ -0,0 +1,175 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+'''Process-wide cache of File ids by path.
+
+Changesets and buildbot changes refer to the same paths over and over
+again, like browser/chrome/browser/browser.dtd for each of our locales.
+
+Files are added to the PathTrigram index when they're created, see
+mbdb.models.index_paths. matching_files uses that to find files by parts
+of their path without scanning the whole File table.
+'''
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+from collections import OrderedDict
+import threading
+
+from django.core.cache import cache
+from django.db import transaction
+import markus
+
+from mbdb.models import File, PathTrigram, path_trigrams
+
+
+metrics = markus.get_metrics('mbdb.files')
+
+# number of paths to keep in the cache
+FILE_CACHE_SIZE = 50000
+# Parts of paths are only looked up in the PathTrigram index if their
+# rarest trigram is in at most this many files. For common trigrams, the
+# index doesn't narrow down the files enough to beat comparing all paths.
+MAX_CANDIDATES = 5000
+# mysql doesn't like too many values at once, chunk up queries
+CHUNK_SIZE = 1000
+# django cache key for the generation of the File table,
+# bumped when files get deleted
+GENERATION_KEY = 'mbdb.files.generation'
+
+
+class FileIds(object):
+    '''LRU-bounded mapping of paths to File ids.
+
+    MySQL ignores trailing spaces and case when comparing strings, and
+    some of our localizers check in files with trailing ' '. Thus
+    paths coming out of the database are compared in Python.
+    Entries are only cached once the transaction creating or reading
+    them is committed.
+    Processes deleting files need to call invalidate(), which also
+    clears the caches in other processes via the django cache.
+    '''
+    def __init__(self, maxsize=FILE_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._ids = OrderedDict()
+        self._lock = threading.Lock()
+        self._generation = None
+
+    def resolve(self, paths):
+        '''Map the given paths to File ids, create missing File objects.
+        '''
+        wanted = set(paths)
+        ids = {}
+        self._check_generation()
+        with self._lock:
+            for path in wanted:
+                if path in self._ids:
+                    self._ids.move_to_end(path)
+                    ids[path] = self._ids[path]
+        metrics.incr('hit', len(ids))
+        misses = [path for path in wanted if path not in ids]
+        if not misses:
+            return ids
+        metrics.incr('miss', len(misses))
+        resolved = {}
+        for chunk in _chunks(misses):
+            self._query(chunk, wanted, resolved)
+        missing = [path for path in misses if path not in resolved]
+        for chunk in _chunks(missing):
+            File.objects.bulk_create([File(path=path) for path in chunk])
+            self._query(chunk, wanted, resolved)
+        transaction.on_commit(lambda: self._store(resolved))
+        ids.update(resolved)
+        return ids
+
+    def invalidate(self):
+        '''Clear this cache, and the ones in other processes.
+        '''
+        with self._lock:
+            self._ids.clear()
+        try:
+            self._generation = cache.incr(GENERATION_KEY)
+        except ValueError:
+            cache.set(GENERATION_KEY, 1, None)
+            self._generation = 1
+
+    def _check_generation(self):
+        generation = cache.get(GENERATION_KEY)
+        if generation != self._generation:
+            with self._lock:
+                self._ids.clear()
+            self._generation = generation
+
+    def _query(self, chunk, wanted, resolved):
+        for path, id_ in (
+            File.objects.filter(path__in=chunk).values_list('path', 'id')
+        ):
+            if path in wanted:
+                resolved.setdefault(path, id_)
+
+    def _store(self, resolved):
+        with self._lock:
+            self._ids.update(resolved)
+            while len(self._ids) > self.maxsize:
+                self._ids.popitem(last=False)
+
+
+def rarest_trigram(trigrams):
+    '''The trigram in the fewest files, and the number of those files.
+
+    Files are only counted up to MAX_CANDIDATES + 1 per trigram, common
+    trigrams are in too many files to count them all. Returns
+    (None, MAX_CANDIDATES + 1) if all trigrams are that common.
+    '''
+    rarest = None, MAX_CANDIDATES + 1
+    for trigram in sorted(trigrams):
+        files = (
+            PathTrigram.objects
+            .filter(trigram=trigram)
+            .values('file')[:MAX_CANDIDATES + 1]
+            .count()
+        )
+        if files < rarest[1]:
+            rarest = trigram, files
+            if not files:
+                # no file has this trigram, nor the part
+                break
+    return rarest
+
+
+def matching_files(parts):
+    '''Query for the ids of the Files with paths containing all parts.
+
+    Candidates for a part are the files having its rarest trigram, which
+    are then compared to the part in the database. Parts shorter than a
+    trigram, or with only trigrams in more than MAX_CANDIDATES files,
+    fall back to just comparing all paths.
+    '''
+    q = File.objects.all()
+    for part in parts:
+        trigrams = path_trigrams(part)
+        if trigrams:
+            trigram, files = rarest_trigram(trigrams)
+            if trigram is None:
+                metrics.incr('trigrams.scan')
+            elif not files:
+                metrics.incr('trigrams.none')
+                return q.none().values_list('id', flat=True)
+            else:
+                metrics.incr('trigrams.index')
+                q = q.filter(id__in=(
+                    PathTrigram.objects
+                    .filter(trigram=trigram)
+                    .values('file')
+                ))
+        q = q.filter(path__contains=part)
+    return q.values_list('id', flat=True)
+
+
+def _chunks(seq, size=CHUNK_SIZE):
+    for i in range(0, len(seq), size):
+        yield seq[i:i + size]
+
+
+file_ids = FileIds()
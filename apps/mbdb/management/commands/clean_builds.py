@@ -9,6 +9,7 @@ from __future__ import unicode_literals
 
 from django.core.management.base import BaseCommand, CommandError
 
+from mbdb.files import file_ids
 from mbdb.models import (Builder, BuildRequest, SourceStamp, NumberedChange,
                          Change, Tag, File, Property)
 
@@ -91,6 +92,7 @@ class Command(BaseCommand):
         if cnt:
             self.stdout.write('Deleting %d files\n' % cnt)
             q.delete()
+            file_ids.invalidate()
         else:
             self.stdout.write('No orphaned files found\n')
 
@@ -0,0 +1,58 @@
+# Generated by Django 2.2.15 on 2026-10-18 17:46
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+CHUNK_SIZE = 1000
+
+
+def index_files(apps, schema_editor):
+    File = apps.get_model('mbdb', 'File')
+    PathTrigram = apps.get_model('mbdb', 'PathTrigram')
+    last_id = 0
+    while True:
+        files = list(
+            File.objects
+            .filter(id__gt=last_id)
+            .order_by('id')
+            .values_list('id', 'path')[:CHUNK_SIZE]
+        )
+        if not files:
+            break
+        trigrams = []
+        for id_, path in files:
+            path = path.lower()
+            trigrams.extend(
+                PathTrigram(trigram=trigram, file_id=id_)
+                for trigram in set(
+                    path[i:i + 3] for i in range(len(path) - 2)
+                )
+            )
+        PathTrigram.objects.bulk_create(trigrams, batch_size=CHUNK_SIZE)
+        last_id = files[-1][0]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mbdb', '0001_squashed_0003_bug_1353850_on_delete'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PathTrigram',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('trigram', models.CharField(max_length=3)),
+                ('file', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='trigrams', to='mbdb.File')),
+            ],
+            options={
+                'index_together': {('trigram', 'file')},
+            },
+        ),
+        migrations.RunPython(
+            index_files,
+            migrations.RunPython.noop
+        ),
+    ]
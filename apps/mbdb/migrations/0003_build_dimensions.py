@@ -0,0 +1,57 @@
+# Generated by Django 2.2.15 on 2026-10-18 18:34
+
+from django.db import migrations, models
+
+
+CHUNK_SIZE = 1000
+
+
+def set_dimensions(apps, schema_editor):
+    Build = apps.get_model('mbdb', 'Build')
+    Property = apps.get_model('mbdb', 'Property')
+    for name in ('locale', 'tree', 'slavename'):
+        max_length = Build._meta.get_field(name).max_length
+        for prop in Property.objects.filter(name=name).iterator():
+            value = prop.value
+            if value is not None:
+                value = str(value)[:max_length]
+            build_ids = list(
+                Build.properties.through.objects
+                .filter(property=prop)
+                .values_list('build', flat=True)
+            )
+            for i in range(0, len(build_ids), CHUNK_SIZE):
+                (
+                    Build.objects
+                    .filter(id__in=build_ids[i:i + CHUNK_SIZE])
+                    .update(**{name: value})
+                )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mbdb', '0002_pathtrigram'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='build',
+            name='locale',
+            field=models.CharField(blank=True, db_index=True, max_length=30, null=True),
+        ),
+        migrations.AddField(
+            model_name='build',
+            name='slavename',
+            field=models.CharField(blank=True, db_index=True, max_length=150, null=True),
+        ),
+        migrations.AddField(
+            model_name='build',
+            name='tree',
+            field=models.CharField(blank=True, db_index=True, max_length=50, null=True),
+        ),
+        migrations.RunPython(
+            set_dimensions,
+            migrations.RunPython.noop
+        ),
+    ]
@@ -0,0 +1,52 @@
+# Generated by Django 2.2.15 on 2026-10-18 18:37
+
+import hashlib
+
+from django.db import migrations, models
+
+
+CHUNK_SIZE = 1000
+
+
+def set_value_hashes(apps, schema_editor):
+    Property = apps.get_model('mbdb', 'Property')
+    field = Property._meta.get_field('value')
+    hashes = {}
+    for prop in (
+        Property.objects
+        .filter(value__isnull=False, value_hash__isnull=True)
+        .iterator()
+    ):
+        value = field.get_prep_value(prop.value)
+        value_hash = hashlib.sha1(value.encode('ascii')).hexdigest()
+        hashes.setdefault(value_hash, []).append(prop.id)
+    for value_hash, ids in hashes.items():
+        for i in range(0, len(ids), CHUNK_SIZE):
+            (
+                Property.objects
+                .filter(id__in=ids[i:i + CHUNK_SIZE])
+                .update(value_hash=value_hash)
+            )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mbdb', '0003_build_dimensions'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='property',
+            name='value_hash',
+            field=models.CharField(blank=True, max_length=40, null=True),
+        ),
+        migrations.AlterIndexTogether(
+            name='property',
+            index_together={('name', 'source', 'value_hash')},
+        ),
+        migrations.RunPython(
+            set_value_hashes,
+            migrations.RunPython.noop
+        ),
+    ]
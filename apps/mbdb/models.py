@@ -7,7 +7,11 @@
 from __future__ import absolute_import
 from __future__ import unicode_literals
 
+import hashlib
+
 from django.db import models
+from django.db.models.signals import post_save, pre_save
+from django.dispatch import receiver
 from django.utils.encoding import python_2_unicode_compatible
 from . import fields
 from django.conf import settings
@@ -32,16 +36,80 @@ class Slave(models.Model):
         return self.name
 
 
+class FileManager(models.Manager):
+    def bulk_create(self, objs, *args, **kwargs):
+        """Create the files, and add them to the PathTrigram index."""
+        objs = super(FileManager, self).bulk_create(objs, *args, **kwargs)
+        ids = dict((f.path, f.pk) for f in objs if f.pk is not None)
+        # most backends don't return the ids of bulk inserts,
+        # find the new files by their missing trigrams
+        paths = set(f.path for f in objs if f.pk is None)
+        chunks = list(paths)
+        for i in range(0, len(chunks), PathTrigram.CHUNK_SIZE):
+            for path, id_ in (
+                self.filter(path__in=chunks[i:i + PathTrigram.CHUNK_SIZE],
+                            trigrams__isnull=True)
+                .values_list('path', 'id')
+            ):
+                # mysql compares case-insensitive, check in python
+                if path in paths:
+                    ids.setdefault(path, id_)
+        index_paths(ids)
+        return objs
+
+
 @python_2_unicode_compatible
 class File(models.Model):
     """Model for files throughout"""
     # not  unique = True, mysql doesn't like long unique utf-8 strings
     path = models.CharField(max_length=400)
 
+    objects = FileManager()
+
     def __str__(self):
         return self.path
 
 
+class PathTrigram(models.Model):
+    """Index of the lowercase three-character substrings of File paths,
+    to find files by parts of their path, see mbdb.files.matching_files"""
+    # mysql doesn't like too many values at once, chunk up queries
+    CHUNK_SIZE = 1000
+
+    trigram = models.CharField(max_length=3)
+    file = models.ForeignKey(File, related_name='trigrams',
+                             on_delete=models.CASCADE)
+
+    class Meta:
+        # not unique, mysql collations consider some different trigrams equal
+        index_together = (('trigram', 'file'),)
+
+
+def path_trigrams(path):
+    """The set of lowercase three-character substrings of path."""
+    path = path.lower()
+    return set(path[i:i + 3] for i in range(len(path) - 2))
+
+
+def index_paths(ids):
+    """Add the paths in the given dict of path to File id to the
+    PathTrigram index."""
+    PathTrigram.objects.bulk_create(
+        [
+            PathTrigram(trigram=trigram, file_id=id_)
+            for path, id_ in ids.items()
+            for trigram in path_trigrams(path)
+        ],
+        batch_size=PathTrigram.CHUNK_SIZE
+    )
+
+
+@receiver(post_save, sender=File)
+def index_file(sender, instance, created, **kwargs):
+    if created:
+        index_paths({instance.path: instance.pk})
+
+
 @python_2_unicode_compatible
 class Tag(models.Model):
     """Model to add tags to the Change model"""
@@ -95,6 +163,24 @@ class NumberedChange(models.Model):
     number = models.IntegerField(db_index=True)
 
 
+class PropertyQuerySet(models.QuerySet):
+    """Keep value_hash in sync for bulk writes, which skip save()."""
+    def bulk_create(self, objs, *args, **kwargs):
+        objs = list(objs)
+        for prop in objs:
+            prop.value_hash = Property.hash_value(prop.value)
+        return super(PropertyQuerySet, self).bulk_create(objs, *args, **kwargs)
+
+    def update(self, **kwargs):
+        if 'value' in kwargs:
+            value = kwargs['value']
+            if hasattr(value, 'resolve_expression'):
+                # we can't hash what the db computes
+                raise ValueError('Property values must be python objects')
+            kwargs['value_hash'] = Property.hash_value(value)
+        return super(PropertyQuerySet, self).update(**kwargs)
+
+
 # this is needed inside the Meta class of the Property class but because we're
 # not allowed to creat variables inside the class itself, we figure out what
 # database engine we're using *before* defining the Property class.
@@ -109,20 +195,40 @@ class Property(models.Model):
     """Helper model for build properties.
 
     To support complex property values, they are internally pickled.
+    Look up properties by value_hash, the pickled value isn't indexed.
+    It's set on save, and by bulk_create and update of Property.objects.
     """
     name = models.CharField(max_length=40, db_index=True)
     source = models.CharField(max_length=20, db_index=True)
     value = fields.PickledObjectField(null=True, blank=True)
+    value_hash = models.CharField(max_length=40, null=True, blank=True)
+
+    objects = PropertyQuerySet.as_manager()
 
     class Meta:
         if not database_engine.endswith('mysql'):
             # hack around mysql, that doesn't do unique of unconstrained texts
             unique_together = (('name', 'source', 'value'),)
+        index_together = (('name', 'source', 'value_hash'),)
+
+    @classmethod
+    def hash_value(cls, value):
+        """sha1 of the pickled value, None for None."""
+        value = cls._meta.get_field('value').get_prep_value(value)
+        if value is None:
+            return None
+        return hashlib.sha1(value.encode('ascii')).hexdigest()
 
     def __str__(self):
         return "%s: %s" % (self.name, self.value)
 
 
+@receiver(pre_save, sender=Property)
+def set_value_hash(sender, instance, **kwargs):
+    # also for raw saves, to hash the properties in fixtures
+    instance.value_hash = sender.hash_value(instance.value)
+
+
 @python_2_unicode_compatible
 class Builder(models.Model):
     """Model for buildbot.status.builder.BuilderStatus"""
@@ -140,7 +246,14 @@ class Builder(models.Model):
 @python_2_unicode_compatible
 class Build(models.Model):
     """Model for buildbot..status.builder.Build
+
+    The locale, tree and slavename properties are also stored in
+    columns, to filter builds without joining the properties.
+    Values longer than the columns are truncated there.
     """
+    # properties that are copied to columns of the same name
+    DIMENSIONS = ('locale', 'tree', 'slavename')
+
     buildnumber = models.IntegerField(null=True, db_index=True)
     properties = models.ManyToManyField(Property, related_name='builds')
     builder = models.ForeignKey(Builder, related_name='builds',
@@ -154,11 +267,30 @@ class Build(models.Model):
     sourcestamp = models.ForeignKey(SourceStamp, null=True,
                                     on_delete=models.SET_NULL,
                                     related_name='builds')
+    locale = models.CharField(max_length=30, null=True, blank=True,
+                              db_index=True)
+    tree = models.CharField(max_length=50, null=True, blank=True,
+                            db_index=True)
+    slavename = models.CharField(max_length=150, null=True, blank=True,
+                                 db_index=True)
+
+    @classmethod
+    def dimension(cls, name, value):
+        """The column value for the property value, truncated to fit.
+        Use for queries, too, to match long values."""
+        if value is None:
+            return None
+        return str(value)[:cls._meta.get_field(name).max_length]
 
     def setProperty(self, name, value, source):
         if name in ('buildername', 'buildnumber'):
             # we have those in the db, ignore
             return
+        if name in self.DIMENSIONS:
+            dimension = self.dimension(name, value)
+            if getattr(self, name) != dimension:
+                setattr(self, name, dimension)
+                self.save(update_fields=[name])
         try:
             # First, see if we have the property, or a property of that name,
             # at least.
@@ -174,9 +306,19 @@ class Build(models.Model):
                 self.properties.remove(prop)
         except Property.DoesNotExist:
             pass
-        prop, created = Property.objects.get_or_create(name=name,
-                                                       source=source,
-                                                       value=value)
+        # mysql doesn't enforce uniqueness, take the first of duplicates
+        prop = (
+            Property.objects
+            .filter(name=name,
+                    source=source,
+                    value_hash=Property.hash_value(value))
+            .order_by('pk')
+            .first()
+        )
+        if prop is None:
+            prop = Property.objects.create(name=name,
+                                           source=source,
+                                           value=value)
         self.properties.add(prop)
 
     def getProperty(self, name, default=None):
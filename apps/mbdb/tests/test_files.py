@@ -0,0 +1,132 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+from unittest import mock
+
+from django.core.cache import cache
+from elmo.test import TestCase
+from mbdb.files import (
+    FileIds, GENERATION_KEY, matching_files, path_trigrams, rarest_trigram
+)
+from mbdb.models import File, PathTrigram
+
+
+# TestCase doesn't commit, run the callbacks right away
+@mock.patch('mbdb.files.transaction.on_commit', lambda callback: callback())
+class FileIdsTest(TestCase):
+
+    def setUp(self):
+        super(FileIdsTest, self).setUp()
+        cache.delete(GENERATION_KEY)
+
+    def test_resolve(self):
+        existing = File.objects.create(path='browser/chrome/foo.dtd')
+        file_ids = FileIds()
+        paths = [
+            'browser/chrome/foo.dtd',
+            'browser/chrome/foo.dtd ',
+            'browser/chrome/Foo.dtd',
+        ]
+        ids = file_ids.resolve(paths)
+        self.assertEqual(File.objects.count(), 3)
+        self.assertEqual(ids['browser/chrome/foo.dtd'], existing.id)
+        self.assertDictEqual(
+            ids,
+            {f.path: f.id for f in File.objects.all()}
+        )
+        with self.assertNumQueries(0):
+            self.assertDictEqual(file_ids.resolve(paths), ids)
+
+    def test_lru(self):
+        file_ids = FileIds(maxsize=2)
+        file_ids.resolve(['a'])
+        file_ids.resolve(['b'])
+        file_ids.resolve(['a'])
+        file_ids.resolve(['c'])
+        self.assertListEqual(list(file_ids._ids), ['a', 'c'])
+        with self.assertNumQueries(1):
+            file_ids.resolve(['b'])
+
+    def test_invalidate(self):
+        file_ids = FileIds()
+        other = FileIds()
+        ids = file_ids.resolve(['a'])
+        other.resolve(['a'])
+        File.objects.all().delete()
+        file_ids.invalidate()
+        self.assertDictEqual(file_ids._ids, {})
+        new_ids = other.resolve(['a'])
+        self.assertNotEqual(ids, new_ids)
+        self.assertListEqual(
+            list(File.objects.values_list('id', flat=True)),
+            [new_ids['a']]
+        )
+
+    def test_matching_files(self):
+        ids = FileIds().resolve([
+            'browser/chrome/browser/browser.dtd',
+            'browser/chrome/browser/places.dtd',
+            'mobile/chrome/browser.dtd',
+            'toolkit/chrome/global/intl.properties',
+        ])
+        self.assertEqual(
+            PathTrigram.objects
+            .filter(file=ids['mobile/chrome/browser.dtd']).count(),
+            len(path_trigrams('mobile/chrome/browser.dtd'))
+        )
+
+        def matching(*parts):
+            return sorted(
+                File.objects
+                .filter(id__in=matching_files(parts))
+                .values_list('path', flat=True)
+            )
+
+        self.assertListEqual(matching('browser.dtd'), [
+            'browser/chrome/browser/browser.dtd',
+            'mobile/chrome/browser.dtd',
+        ])
+        self.assertListEqual(matching('BROWSER/', 'dtd'), [
+            'browser/chrome/browser/browser.dtd',
+            'browser/chrome/browser/places.dtd',
+        ])
+        # all trigrams are there, but not in this order
+        self.assertListEqual(matching('chrome/global/browser'), [])
+        # too short for the index
+        self.assertListEqual(matching('l/'), [
+            'toolkit/chrome/global/intl.properties',
+        ])
+        # trigrams not in the index
+        self.assertListEqual(matching('xyz'), [])
+        self.assertEqual(rarest_trigram({'bro', 'dtd', 'xyz'}), ('xyz', 0))
+        self.assertEqual(rarest_trigram({'bro', 'dtd'}), ('bro', 3))
+        # common trigrams compare all paths, only count what's needed
+        with mock.patch('mbdb.files.MAX_CANDIDATES', 1):
+            self.assertEqual(rarest_trigram({'bro', 'dtd'}), (None, 2))
+        with mock.patch('mbdb.files.MAX_CANDIDATES', 0):
+            self.assertListEqual(matching('BROWSER/', 'dtd'), [
+                'browser/chrome/browser/browser.dtd',
+                'browser/chrome/browser/places.dtd',
+            ])
+
+    def test_index(self):
+        '''All ways to create files add them to the index'''
+        created = File.objects.create(path='browser/created.dtd')
+        File.objects.bulk_create([
+            File(path='browser/bulk.dtd'),
+            File(path='mobile/bulk.dtd'),
+            File(path='ab'),
+        ])
+        for f in File.objects.all():
+            self.assertSetEqual(
+                set(f.trigrams.values_list('trigram', flat=True)),
+                path_trigrams(f.path),
+                f.path
+            )
+        self.assertEqual(
+            PathTrigram.objects.filter(file=created).count(),
+            len(path_trigrams(created.path))
+        )
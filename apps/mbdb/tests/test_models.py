@@ -14,6 +14,7 @@ import six
 from six.moves import StringIO
 from elmo.test import TestCase
 from django.core import management
+from django.db import models
 from mbdb.models import Property, Step, Build, Builder, Master, Slave
 
 
@@ -76,6 +77,78 @@ class ModelsTest(TestCase):
             self.assertEqual(six.text_type(value), value_data)
             prop.delete()
 
+    def testBuildDimensions(self):
+        master = Master.objects.create(name='head')
+        builder = Builder.objects.create(name='builder1', master=master)
+        build = Build.objects.create(
+          buildnumber=1,
+          builder=builder,
+          starttime=datetime.datetime.utcnow(),
+        )
+        build.setProperty('locale', 'de', 'build')
+        build.setProperty('slavename', 'bot1', 'build')
+        build.setProperty('branch', 'central', 'build')
+        build = Build.objects.get(pk=build.pk)
+        self.assertEqual(build.locale, 'de')
+        self.assertEqual(build.slavename, 'bot1')
+        self.assertIsNone(build.tree)
+        self.assertEqual(build.getProperty('locale'), 'de')
+        build.setProperty('locale', 'fr', 'build')
+        self.assertEqual(
+            list(Build.objects.filter(locale='fr').values_list(
+                'pk', flat=True)),
+            [build.pk]
+        )
+        slavename = 'bot-' + 'x' * 200
+        build.setProperty('slavename', slavename, 'build')
+        build = Build.objects.get(pk=build.pk)
+        self.assertEqual(build.slavename, slavename[:150])
+        self.assertEqual(build.getProperty('slavename'), slavename)
+
+    def testPropertyValueHash(self):
+        prop = Property.objects.create(name='locale', source='build',
+                                       value='de')
+        self.assertEqual(prop.value_hash, Property.hash_value('de'))
+        self.assertNotEqual(prop.value_hash, Property.hash_value('fr'))
+        prop = Property.objects.create(name='revision', source='build')
+        self.assertIsNone(prop.value_hash)
+        master = Master.objects.create(name='head')
+        builder = Builder.objects.create(name='builder1', master=master)
+        builds = [
+            Build.objects.create(
+              buildnumber=i,
+              builder=builder,
+              starttime=datetime.datetime.utcnow(),
+            )
+            for i in range(2)
+        ]
+        for build in builds:
+            build.setProperty('branch', ['central', 'beta'], 'build')
+        self.assertEqual(Property.objects.filter(name='branch').count(), 1)
+        prop = Property.objects.get(name='branch')
+        self.assertEqual(prop.builds.count(), 2)
+        self.assertEqual(
+            Property.objects.filter(
+                value_hash=Property.hash_value(['central', 'beta'])
+            ).get(),
+            prop
+        )
+
+    def testPropertyValueHashBulk(self):
+        Property.objects.bulk_create(
+            Property(name='locale', source='build', value=value)
+            for value in ('de', 'fr')
+        )
+        for prop in Property.objects.all():
+            self.assertEqual(prop.value_hash, Property.hash_value(prop.value))
+        Property.objects.filter(value_hash=Property.hash_value('fr')).update(
+            value='it'
+        )
+        prop = Property.objects.get(value_hash=Property.hash_value('it'))
+        self.assertEqual(prop.value, 'it')
+        with self.assertRaises(ValueError):
+            Property.objects.update(value=models.F('name'))
+
     def testStepModel(self):
         # pre-requisites
         master = Master.objects.create(
@@ -145,6 +218,10 @@ class ModelsWithPickleFixtureTest(TestCase):
         prop = Property.objects.get(name='three')
         self.assertEqual(prop.value, ['pickled', 'array'])
 
+    def testPropertyValueHash(self):
+        for prop in Property.objects.all():
+            self.assertEqual(prop.value_hash, Property.hash_value(prop.value))
+
 
 class ModelsWithListFixtureTest(TestCase):
     fixtures = ['list_field_sample.json']
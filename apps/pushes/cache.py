@@ -0,0 +1,54 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+'''Generation counters of the pushes in each repository.
+
+Cached pushlog data is keyed by the generations of the repositories
+it's for, and becomes unreachable when a new push comes in.
+'''
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import time
+
+from django.core.cache import cache
+
+
+# django cache key for the generation of a repository
+GENERATION_KEY = 'pushes.generation.{}'
+# pseudo repository id for the generation of all repositories
+ALL = 'all'
+
+
+def generations(repo_ids):
+    '''Return a dict mapping the given repository ids to their generation.
+
+    Pass ALL to get the generation of all repositories.
+    '''
+    keys = {GENERATION_KEY.format(repo_id): repo_id for repo_id in repo_ids}
+    values = cache.get_many(list(keys))
+    for key in keys:
+        if key not in values:
+            _initialize(key)
+            values[key] = cache.get(key)
+    return {keys[key]: value for key, value in values.items()}
+
+
+def bump(repo_id):
+    '''Invalidate the cached data for repo_id.
+
+    Call this once the transaction with the new pushes is committed,
+    so that nothing caches the old data under the new generation.
+    '''
+    for key in (GENERATION_KEY.format(repo_id), GENERATION_KEY.format(ALL)):
+        try:
+            cache.incr(key)
+        except ValueError:
+            _initialize(key)
+
+
+def _initialize(key):
+    # Use the current time, so that the generation doesn't repeat
+    # one from before the counter got evicted.
+    cache.add(key, int(time.time() * 1000), None)
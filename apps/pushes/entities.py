@@ -0,0 +1,82 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+'''Process-wide cache of parsed localization files.
+
+Sign-offs of a locale review diffs that share most of their file
+revisions, cache the parsed entities by file content instead of
+parsing them for each diff.
+'''
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+from collections import OrderedDict
+import hashlib
+import threading
+
+from django.conf import settings
+import markus
+
+
+metrics = markus.get_metrics('pushes.entities')
+
+
+class EntityCache(object):
+    '''LRU cache of the (key, value) pairs of parsed files.
+
+    Entries are keyed by parser class and the hash of the content.
+    The memory budget is approximated by the size of the parsed contents.
+    It defaults to the DIFF_ENTITY_CACHE_SIZE setting.
+    '''
+    def __init__(self, maxsize=None):
+        self._maxsize = maxsize
+        self._size = 0
+        # key -> (size, entities), least recently used first
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def maxsize(self):
+        if self._maxsize is None:
+            return settings.DIFF_ENTITY_CACHE_SIZE
+        return self._maxsize
+
+    def get(self, parser, content, parse):
+        '''Return the entities of content parsed with parser.
+
+        parse is called with parser and content on misses, and returns
+        an iterable of (key, value) pairs.
+        '''
+        key = (
+            parser.__class__.__name__,
+            hashlib.sha1(content).hexdigest()
+        )
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                metrics.incr('hit')
+                return self._entries[key][1]
+        metrics.incr('miss')
+        entities = tuple(parse(parser, content))
+        self._store(key, len(content), entities)
+        return entities
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def _store(self, key, size, entities):
+        if size > self.maxsize:
+            return
+        with self._lock:
+            if key in self._entries:
+                return
+            self._entries[key] = (size, entities)
+            self._size += size
+            while self._size > self.maxsize:
+                self._size -= self._entries.popitem(last=False)[1][0]
+
+
+entity_cache = EntityCache()
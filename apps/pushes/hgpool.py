@@ -0,0 +1,176 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+'''Pool of long-lived hglib command servers.
+
+Each hglib.open() starts a Python process for the command server, reuse
+them across pushes and requests instead.
+'''
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+from contextlib import contextmanager
+import os
+import threading
+import time
+import weakref
+
+import hglib
+import markus
+
+
+metrics = markus.get_metrics('hg.pool')
+
+# maximum number of idle clients kept open
+POOL_SIZE = 16
+# seconds after which idle clients are closed
+IDLE_TIMEOUT = 300
+# maximum number of clients checked out at the same time
+MAX_ACTIVE = 32
+
+
+class ClientPool(object):
+    '''Bounded pool of idle hglib clients, keyed by local clone path.
+
+    Clients are checked out exclusively. Concurrent users of the same
+    repository get separate clients, and only return them to the pool
+    when they're done.
+    Clients are checked for a live command server and an existing clone
+    before being handed out. Clients idle for longer than idle_timeout are
+    closed, as are the least recently used ones beyond maxsize.
+    At most max_active clients are checked out at a time, acquire()
+    blocks until one is released or closed.
+    '''
+    def __init__(self, maxsize=POOL_SIZE, idle_timeout=IDLE_TIMEOUT,
+                 max_active=MAX_ACTIVE):
+        self.maxsize = maxsize
+        self.idle_timeout = idle_timeout
+        self._active = threading.BoundedSemaphore(max_active)
+        self._lock = threading.Lock()
+        # (path, client, release time), most recently released last
+        self._idle = []
+        self._paths = weakref.WeakKeyDictionary()
+
+    def acquire(self, path):
+        '''Check out a client for the clone at path.
+        '''
+        self._active.acquire()
+        try:
+            client = self._checkout(path)
+        except BaseException:
+            self._active.release()
+            raise
+        with self._lock:
+            self._paths[client] = path
+        return client
+
+    def _checkout(self, path):
+        client = None
+        with self._lock:
+            stale = self._expire()
+            for i in range(len(self._idle) - 1, -1, -1):
+                if self._idle[i][0] == path:
+                    client = self._idle.pop(i)[1]
+                    break
+        self._close(stale, 'expired')
+        if client is not None and not self._healthy(path, client):
+            self._close([client], 'unhealthy')
+            client = None
+        if client is None:
+            metrics.incr('miss')
+            client = hglib.open(path)
+        else:
+            metrics.incr('hit')
+        return client
+
+    def release(self, client):
+        '''Return a client to the pool.
+
+        Clients closed by their users are dropped.
+        '''
+        with self._lock:
+            path = self._paths.pop(client, None)
+            if path is None:
+                return
+            self._active.release()
+            if client.server is None:
+                return
+            self._idle.append((path, client, time.monotonic()))
+            stale = [
+                self._idle.pop(0)[1]
+                for _ in range(len(self._idle) - self.maxsize)
+            ]
+        self._close(stale, 'evicted')
+
+    def close(self, client):
+        '''Close a checked out client instead of returning it to the pool.
+
+        Use this when a command failed in an unknown state, the command
+        server stream might be out of sync.
+        '''
+        with self._lock:
+            if self._paths.pop(client, None) is not None:
+                self._active.release()
+        if client.server is not None:
+            self._close([client], 'failed')
+
+    @contextmanager
+    def client(self, path):
+        '''Context manager for a checked out client for path.
+
+        Errors reported by hg leave the client in a known state. For
+        any other exception, the client is closed.
+        '''
+        client = self.acquire(path)
+        try:
+            yield client
+        except hglib.error.CommandError:
+            self.release(client)
+            raise
+        except BaseException:
+            self.close(client)
+            raise
+        self.release(client)
+
+    def discard(self, path):
+        '''Close all idle clients for path, for example when the clone
+        got removed.
+        '''
+        with self._lock:
+            stale = [entry[1] for entry in self._idle if entry[0] == path]
+            self._idle = [entry for entry in self._idle if entry[0] != path]
+        self._close(stale, 'discarded')
+
+    def clear(self):
+        '''Close all idle clients.
+        '''
+        with self._lock:
+            stale = [entry[1] for entry in self._idle]
+            self._idle = []
+        self._close(stale, 'discarded')
+
+    def _expire(self):
+        deadline = time.monotonic() - self.idle_timeout
+        stale = [entry[1] for entry in self._idle if entry[2] < deadline]
+        self._idle = [entry for entry in self._idle if entry[2] >= deadline]
+        return stale
+
+    def _healthy(self, path, client):
+        return (
+            client.server is not None
+            and client.server.poll() is None
+            and os.path.isdir(os.path.join(path, '.hg'))
+        )
+
+    def _close(self, clients, reason):
+        for client in clients:
+            metrics.incr(reason)
+            try:
+                client.close()
+            except OSError:
+                # the command server is gone already
+                pass
+
+
+hg_pool = ClientPool()
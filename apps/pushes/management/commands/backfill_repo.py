@@ -0,0 +1,66 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+'''Import the full history of repositories, instead of replaying
+their pushes one by one.
+'''
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from life.models import Push, Repository
+from pushes import utils
+
+
+class Command(BaseCommand):
+    help = 'Bulk load changesets and pushes of repositories'
+
+    def add_arguments(self, parser):
+        parser.add_argument('repos', nargs='*', metavar='repository')
+        parser.add_argument(
+            '--forest', action='append', default=[],
+            help='Backfill all repositories in this forest'
+        )
+        parser.add_argument(
+            '--page-size', type=int, default=utils.BACKFILL_PAGE_SIZE,
+            help='Number of pushes to insert per transaction'
+        )
+
+    def handle(self, repos=None, forest=None, page_size=None, **options):
+        q = Repository.objects.filter(name__in=repos or [])
+        if forest:
+            q |= Repository.objects.filter(forest__name__in=forest)
+        q = q.filter(archived=False).order_by('name')
+        if not q:
+            raise CommandError('No repositories to backfill')
+        for repo in q:
+            self.backfill(repo, page_size)
+
+    def backfill(self, repo, page_size):
+        changesets = repo.changesets.count()
+        last_push = repo.last_known_push()
+        pushes = 0
+        start = time.monotonic()
+        self.stdout.write('Backfilling {}\n'.format(repo.name))
+        for count in utils.backfill(repo, page_size=page_size):
+            pushes += count
+            self.stdout.write('{}: {} pushes, last push {}\n'.format(
+                repo.name, pushes, repo.last_known_push()
+            ))
+        changesets = repo.changesets.count() - changesets
+        links = Push.changesets.through.objects.filter(
+            push__repository=repo, push__push_id__gt=last_push
+        ).count()
+        elapsed = time.monotonic() - start
+        rows = changesets + pushes + links
+        self.stdout.write(
+            '{}: {} changesets, {} pushes, {} push changesets '
+            'in {:.2f}s, {:.0f} rows/sec\n'.format(
+                repo.name, changesets, pushes, links, elapsed,
+                rows / elapsed if elapsed else 0
+            )
+        )
@@ -0,0 +1,101 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+'''Benchmark the inline string diffs of the diff view on two versions
+of localization files, against diffing characters with difflib.
+'''
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+from difflib import SequenceMatcher
+import os
+import time
+
+from compare_locales.parser import getParser
+from django.core.management.base import BaseCommand, CommandError
+
+from pushes.stringdiff import diff_strings
+from pushes.views.diff import DiffView
+
+
+class Command(BaseCommand):
+    help = 'Time string diffs between two versions of l10n files'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'old', help='Old version of a file or directory'
+        )
+        parser.add_argument(
+            'new', help='New version of a file or directory'
+        )
+        parser.add_argument(
+            '--repeat', type=int, default=3,
+            help='Number of times to diff all strings'
+        )
+
+    def handle(self, old=None, new=None, repeat=None, **options):
+        pairs = list(self.changed_strings(old, new))
+        if not pairs:
+            raise CommandError('No changed strings found')
+        chars = sum(len(oldval) + len(newval) for oldval, newval in pairs)
+        self.stdout.write('{} changed strings, {} characters\n'.format(
+            len(pairs), chars
+        ))
+        for name, fn in (
+            ('difflib characters', self.char_diff),
+            ('pushes.stringdiff', diff_strings),
+        ):
+            timings = []
+            for _ in range(repeat):
+                start = time.monotonic()
+                for oldval, newval in pairs:
+                    fn(oldval, newval)
+                timings.append(time.monotonic() - start)
+            self.stdout.write('{}: best {:.3f}s, worst {:.3f}s\n'.format(
+                name, min(timings), max(timings)
+            ))
+
+    def changed_strings(self, old, new):
+        '''Yield old and new values of the entities that changed.
+        '''
+        view = DiffView()
+        for old_path, new_path in self.files(old, new):
+            try:
+                parser = getParser(new_path)
+            except UserWarning:
+                continue
+            translations = []
+            for path in (old_path, new_path):
+                with open(path, 'rb') as fh:
+                    content = view._universal_newlines(fh.read())
+                try:
+                    translations.append(dict(
+                        view.parse(parser.__class__(), content)
+                    ))
+                except Exception:
+                    break
+            else:
+                old_translations, new_translations = translations
+                for key, newval in new_translations.items():
+                    oldval = old_translations.get(key)
+                    if oldval and newval and oldval != newval:
+                        yield oldval, newval
+
+    def files(self, old, new):
+        if os.path.isfile(new):
+            yield old, new
+            return
+        for dirpath, dirnames, filenames in os.walk(new):
+            dirnames[:] = [d for d in dirnames if not d.startswith('.')]
+            for filename in filenames:
+                new_path = os.path.join(dirpath, filename)
+                old_path = os.path.join(
+                    old, os.path.relpath(new_path, new)
+                )
+                if os.path.isfile(old_path):
+                    yield old_path, new_path
+
+    def char_diff(self, oldval, newval):
+        # what the diff view did before pushes.stringdiff
+        return SequenceMatcher(None, oldval, newval).get_opcodes()
@@ -0,0 +1,15 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+'''Signals sent when ingesting pushes.
+'''
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+from django.dispatch import Signal
+
+
+# Sent with the repository and the list of its new pushes,
+# once the transaction creating them is committed.
+pushes_ingested = Signal(providing_args=['repository', 'pushes'])
@@ -0,0 +1,120 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+'''Inline diffs of localized strings.
+
+Strings are compared word by word, after cutting off the common prefix
+and suffix. Scripts that don't separate words with spaces are compared
+by character, and long words are cut into pieces. Single replaced words
+that are similar are compared character by character, to show typo
+fixes. Diffing is quadratic in the worst case, so strings that would
+cost more than a budget are shown as replaced as a whole.
+'''
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+from difflib import SequenceMatcher
+import re
+
+import markus
+
+
+metrics = markus.get_metrics('pushes.stringdiff')
+
+# kana and CJK ideographs, which don't have spaces between words
+UNSPACED = '\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff'
+# maximum length of a word token
+MAX_WORD = 40
+# unspaced characters, words and single other characters,
+# with their trailing whitespace
+TOKENS = re.compile(
+    r'[{0}]\s*|(?:(?![{0}])\w){{1,{1}}}\s*|[^\w\s]\s*|\s+'.format(
+        UNSPACED, MAX_WORD
+    ),
+    re.UNICODE
+)
+# maximum product of the number of tokens to diff, per string
+MAX_COST = 250000
+# minimal similarity of replaced words to diff their characters
+SIMILAR_WORDS = 0.6
+
+
+def diff_strings(oldval, newval, max_cost=MAX_COST):
+    '''Diff two strings.
+
+    Returns lists of {'class': opcode, 'value': text} dicts for both
+    strings, with the opcodes of difflib.SequenceMatcher.
+    '''
+    old = TOKENS.findall(oldval)
+    new = TOKENS.findall(newval)
+    limit = min(len(old), len(new))
+    start = 0
+    while start < limit and old[start] == new[start]:
+        start += 1
+    end = 0
+    while end < limit - start and old[-1 - end] == new[-1 - end]:
+        end += 1
+    old_middle = old[start:len(old) - end]
+    new_middle = new[start:len(new) - end]
+    ops = []
+    if start:
+        ops.append(('equal', old[:start], new[:start]))
+    if len(old_middle) * len(new_middle) > max_cost:
+        metrics.incr('over_budget')
+        ops.extend(_split_whitespace(''.join(old_middle), ''.join(new_middle)))
+    elif old_middle or new_middle:
+        ops.extend(_opcodes(old_middle, new_middle, max_cost))
+    if end:
+        ops.append(('equal', old[len(old) - end:], new[len(new) - end:]))
+    return (
+        _segments((op, tokens) for op, tokens, _ in ops),
+        _segments((op, tokens) for op, _, tokens in ops),
+    )
+
+
+def _opcodes(old, new, max_cost):
+    sm = SequenceMatcher(None, old, new, autojunk=False)
+    for op, o1, o2, n1, n2 in sm.get_opcodes():
+        if (
+            op == 'replace' and o2 - o1 == 1 and n2 - n1 == 1 and
+            len(old[o1]) * len(new[n1]) <= max_cost
+        ):
+            # one word replaced by another, compare the characters
+            # if they're similar
+            chars = SequenceMatcher(None, old[o1], new[n1], autojunk=False)
+            if chars.ratio() >= SIMILAR_WORDS:
+                for char_op, c1, c2, d1, d2 in chars.get_opcodes():
+                    yield char_op, old[o1][c1:c2], new[n1][d1:d2]
+                continue
+        if op == 'replace':
+            for ws_op in _split_whitespace(
+                ''.join(old[o1:o2]), ''.join(new[n1:n2])
+            ):
+                yield ws_op
+            continue
+        yield op, old[o1:o2], new[n1:n2]
+
+
+def _split_whitespace(old, new):
+    # don't mark the whitespace at the end of replaced words
+    length = min(len(old) - len(old.rstrip()), len(new) - len(new.rstrip()))
+    while length and old[-length:] != new[-length:]:
+        length -= 1
+    if not length or length == len(old) or length == len(new):
+        yield 'replace', old, new
+        return
+    yield 'replace', old[:-length], new[:-length]
+    yield 'equal', old[-length:], new[-length:]
+
+
+def _segments(ops):
+    segments = []
+    for op, tokens in ops:
+        if not tokens:
+            continue
+        if segments and segments[-1]['class'] == op:
+            segments[-1]['value'] += ''.join(tokens)
+        else:
+            segments.append({'class': op, 'value': ''.join(tokens)})
+    return segments
@@ -8,21 +8,25 @@ import os
 import shutil
 import tempfile
 from django.conf import settings
+from django.core.cache import cache
 from django.test import override_settings
 from elmo.test import TestCase
 from life.models import Repository
+from ..hgpool import hg_pool
 from ..utils import get_or_create_changeset
 
 
 class RepoTestBase(TestCase):
     def setUp(self):
         super(RepoTestBase, self).setUp()
+        cache.clear()
         self._settings_context = override_settings(
             REPOSITORY_BASE=tempfile.mkdtemp())
         self._settings_context.enable()
         self.repo = os.path.join(settings.REPOSITORY_BASE, self.repo_name)
 
     def tearDown(self):
+        hg_pool.clear()
         if os.path.isdir(settings.REPOSITORY_BASE):
             shutil.rmtree(settings.REPOSITORY_BASE)
         self._settings_context.disable()
@@ -0,0 +1,105 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import io
+import os
+import shutil
+import tempfile
+from unittest import mock
+
+from django.core import management
+import hglib
+
+from life.models import Repository
+from pushes import utils
+from .base import RepoTestBase
+
+
+@mock.patch('pushes.utils.logging', mock.MagicMock())
+class TestBackfill(RepoTestBase):
+
+    repo_name = 'backfill'
+
+    def setUp(self):
+        super(TestBackfill, self).setUp()
+        self.upstream = tempfile.mkdtemp()
+        revs = []
+        with hglib.init(self.upstream).open() as hgrepo:
+            for i, branch in enumerate(('default', 'stable', 'default')):
+                hgrepo.branch(branch.encode('ascii'), force=True)
+                with open(hgrepo.pathto('file%d.dtd' % i), 'w') as fh:
+                    fh.write('<!ENTITY key "%d">\n' % i)
+                hgrepo.commit(user="Jane Doe <jdoe@foo.tld>",
+                              message="commit %d" % i,
+                              addremove=True)
+                revs.append(hgrepo.tip().node.decode('ascii'))
+        self.pushes = {
+            1: {'changesets': revs[:2], 'date': 1593532760, 'user': 'jdoe'},
+            2: {'changesets': revs[2:], 'date': 1593558780, 'user': 'jdoe'},
+        }
+        self._get = mock.patch.object(utils.session, 'get', self.get)
+        self._get.start()
+
+    def tearDown(self):
+        self._get.stop()
+        shutil.rmtree(self.upstream)
+        super(TestBackfill, self).tearDown()
+
+    def get(self, url, **kwargs):
+        start, end = (int(arg.split('=')[1]) for arg in url.split('&')[1:])
+        response = mock.MagicMock()
+        response.json.return_value = {
+            'lastpushid': max(self.pushes),
+            'pushes': {
+                str(push_id): push
+                for push_id, push in self.pushes.items()
+                if start < push_id <= end
+            },
+        }
+        return response
+
+    def dump(self, repo):
+        return [
+            (
+                push.push_id, push.user, push.push_date, push.tip.revision,
+                sorted(
+                    (cs.revision, cs.branch.name, cs.description,
+                     sorted(f.path for f in cs.files.all()),
+                     sorted(p.revision for p in cs.parents.all()))
+                    for cs in push.changesets.all()
+                ),
+            )
+            for push in repo.push_set.order_by('push_id')
+        ]
+
+    def test_backfill(self):
+        url = 'file://' + self.upstream + '/'
+        repo = Repository.objects.create(name=self.repo_name, url=url)
+        out = io.StringIO()
+        management.call_command(
+            'backfill_repo', self.repo_name, page_size=1, stdout=out
+        )
+        self.assertIn(
+            '3 changesets, 2 pushes, 3 push changesets', out.getvalue()
+        )
+        self.assertTrue(os.path.isfile(os.path.join(
+            repo.local_path(), '.hg', utils.CHECKPOINT_FILE
+        )))
+        handled = Repository.objects.create(name='handled', url=url)
+        utils.handlePushes(
+            handled.id, utils.PushJS.pushes_for(handled, max(self.pushes))
+        )
+        self.assertListEqual(self.dump(repo), self.dump(handled))
+        self.assertSetEqual(
+            set(repo.changesets.values_list('revision', flat=True)),
+            set(handled.changesets.values_list('revision', flat=True))
+        )
+        # resuming doesn't do anything
+        out = io.StringIO()
+        management.call_command('backfill_repo', self.repo_name, stdout=out)
+        self.assertIn(
+            '0 changesets, 0 pushes, 0 push changesets', out.getvalue()
+        )
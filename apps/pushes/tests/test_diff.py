@@ -6,13 +6,19 @@ from __future__ import absolute_import
 from __future__ import unicode_literals
 
 import codecs
+import os
+from django.core.cache import cache
 from django.urls import reverse
+from compare_locales.parser import getParser
 import hglib
 import six
+from unittest import mock
 
 from life.models import Repository
 from .base import RepoTestBase, TestCase
-from pushes.views.diff import DataTree, DiffView, BadRevision
+from pushes.views.diff import (
+    DataTree, DiffView, BadRevision, get_cached, set_cached, warm
+)
 
 # mercurial doesn't take unicode strings, trigger errors
 import warnings
@@ -128,6 +134,221 @@ class DiffTestCase(RepoTestBase):
         })
         self.assertEqual(response.status_code, 400)
 
+    def test_cache(self):
+        with hglib.init(self.repo).open() as hgrepo:
+            with open(hgrepo.pathto('file.dtd'), 'w') as fh:
+                fh.write('<!ENTITY key1 "Hello">\n')
+            hgrepo.commit(user="Jane Doe <jdoe@foo.tld>",
+                          message="initial commit",
+                          addremove=True)
+            rev0 = hgrepo[0].node().decode('ascii')
+            with open(hgrepo.pathto('file.dtd'), 'w') as fh:
+                fh.write('<!ENTITY key1 "Hello World">\n')
+            with open(hgrepo.pathto('file.png'), 'wb') as fh:
+                fh.write(b'PNG')
+            hgrepo.commit(user="Jane Doe <jdoe@foo.tld>",
+                          message="Second commit",
+                          addremove=True)
+            rev1 = hgrepo[1].node().decode('ascii')
+        Repository.objects.create(
+            name=self.repo_name,
+            url='http://localhost:8001/%s/' % self.repo_name
+        )
+        url = reverse('pushes:diff')
+        response = self.client.get(url, {
+            'repo': self.repo_name,
+            'from': rev0[:12],
+            'to': rev1[:12]
+        })
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'World')
+        # unparsable files link to the resolved revision
+        self.assertContains(response, 'file/{}/file.png'.format(rev1))
+        # the same revisions, spelled differently, come from the cache
+        with mock.patch.object(DiffView, 'status') as status:
+            response = self.client.get(url, {
+                'repo': self.repo_name,
+                'from': '0',
+                'to': rev1
+            })
+        self.assertFalse(status.called)
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'World')
+        self.assertContains(response, 'file/{}/file.png'.format(rev1))
+
+    def test_cache_chunks(self):
+        tree = [('de', {'children': [], 'value': {'lines': ['x' * 100]}})]
+        with mock.patch('pushes.views.diff.DIFF_CACHE_CHUNK_SIZE', 10):
+            self.assertTrue(set_cached('chunked', tree))
+        header = cache.get('chunked')
+        self.assertGreater(header[0], 1)
+        self.assertEqual(get_cached('chunked'), tree)
+        # evicted chunks are a miss
+        cache.delete('chunked.1')
+        self.assertIsNone(get_cached('chunked'))
+        # too big to cache
+        with mock.patch('pushes.views.diff.DIFF_CACHE_MAX_SIZE', 10):
+            self.assertFalse(set_cached('big', tree))
+        self.assertIsNone(get_cached('big'))
+
+    def test_warm(self):
+        with hglib.init(self.repo).open() as hgrepo:
+            with open(hgrepo.pathto('file.dtd'), 'w') as fh:
+                fh.write('<!ENTITY key1 "Hello">\n')
+            hgrepo.commit(user="Jane Doe <jdoe@foo.tld>",
+                          message="initial commit",
+                          addremove=True)
+            with open(hgrepo.pathto('file.dtd'), 'w') as fh:
+                fh.write('<!ENTITY key1 "Hello World">\n')
+            hgrepo.commit(user="Jane Doe <jdoe@foo.tld>",
+                          message="Second commit")
+        Repository.objects.create(
+            name=self.repo_name,
+            url='http://localhost:8001/%s/' % self.repo_name
+        )
+        warm(self.repo_name, '0', '1')
+        with mock.patch.object(DiffView, 'status') as status:
+            response = self.client.get(reverse('pushes:diff'), {
+                'repo': self.repo_name,
+                'from': '0',
+                'to': '1'
+            })
+        self.assertFalse(status.called)
+        self.assertContains(response, 'World')
+
+    def test_diff_files(self):
+        with hglib.init(self.repo).open() as hgrepo:
+            for i in range(10):
+                with open(hgrepo.pathto('file%d.dtd' % i), 'w') as fh:
+                    fh.write('<!ENTITY key "Hello %d">\n' % i)
+            hgrepo.commit(user="Jane Doe <jdoe@foo.tld>",
+                          message="initial commit",
+                          addremove=True)
+            for i in range(10):
+                with open(hgrepo.pathto('file%d.dtd' % i), 'w') as fh:
+                    fh.write('<!ENTITY key "Hello %d">\n' % (i + 10))
+            hgrepo.commit(user="Jane Doe <jdoe@foo.tld>",
+                          message="Second commit")
+        Repository.objects.create(
+            name=self.repo_name,
+            url='http://localhost:8001/%s/' % self.repo_name
+        )
+        view = DiffView()
+        view.getrepo(self.repo_name)
+        paths = view.paths4revs('0', '1')
+        self.assertEqual(len(paths), 10)
+        diffs = view.diff_files(paths)
+        self.assertListEqual(
+            diffs,
+            [view.diffLines(path, action) for path, action in paths]
+        )
+        for lines in diffs:
+            self.assertEqual(lines[0]['class'], 'changed')
+        # don't parse with the parsers shared across threads
+        with mock.patch('pushes.views.diff.entity_cache') as entity_cache:
+            entity_cache.get.return_value = []
+            view.diffLines(*paths[0])
+        shared = getParser(paths[0][0])
+        for args, kwargs in entity_cache.get.call_args_list:
+            self.assertIsInstance(args[0], shared.__class__)
+            self.assertIsNot(args[0], shared)
+
+    def test_fetch_contents(self):
+        with hglib.init(self.repo).open() as hgrepo:
+            for name, content in (
+                ('changed.dtd', b'<!ENTITY key "Hello">\n'),
+                ('moved.dtd', b'<!ENTITY key "Hell\xe3">\n'),
+                ('removed.dtd', b'<!ENTITY key "\0">\r\n'),
+                ('file.png', b'PNG'),
+            ):
+                with open(hgrepo.pathto(name), 'wb') as fh:
+                    fh.write(content)
+            hgrepo.commit(user="Jane Doe <jdoe@foo.tld>",
+                          message="initial commit",
+                          addremove=True)
+            rev0 = hgrepo[0].node()
+            with open(hgrepo.pathto('changed.dtd'), 'wb') as fh:
+                fh.write(b'<!ENTITY key "Hello World">\n')
+            with open(hgrepo.pathto('file.png'), 'wb') as fh:
+                fh.write(b'PNG2')
+            hgrepo.move(hgrepo.pathto('moved.dtd'),
+                        hgrepo.pathto('new name.dtd'))
+            hgrepo.remove(hgrepo.pathto('removed.dtd'))
+            hgrepo.commit(user="Jane Doe <jdoe@foo.tld>",
+                          message="Second commit")
+            rev1 = hgrepo[1].node()
+        Repository.objects.create(
+            name=self.repo_name,
+            url='http://localhost:8001/%s/' % self.repo_name
+        )
+        view = DiffView()
+        view.getrepo(self.repo_name)
+        paths = view.paths4revs('0', '1')
+        with mock.patch.object(view, 'cat', wraps=view.cat) as cat:
+            contents = view.fetch_contents(paths)
+        self.assertDictEqual(contents, {
+            ('changed.dtd', rev0): b'<!ENTITY key "Hello">\n',
+            ('changed.dtd', rev1): b'<!ENTITY key "Hello World">\n',
+            ('moved.dtd', rev0): b'<!ENTITY key "Hell\xe3">\n',
+            ('new name.dtd', rev1): b'<!ENTITY key "Hell\xe3">\n',
+            ('removed.dtd', rev0): b'<!ENTITY key "\0">\r\n',
+        })
+        # one cat per revision
+        self.assertEqual(cat.call_count, 2)
+
+    def test_json(self):
+        files = ('browser/a.dtd', 'browser/b.dtd', 'toolkit/main/c.dtd')
+        with hglib.init(self.repo).open() as hgrepo:
+            for f in files:
+                os.makedirs(os.path.dirname(hgrepo.pathto(f)), exist_ok=True)
+                with open(hgrepo.pathto(f), 'w') as fh:
+                    fh.write('<!ENTITY key "Hello">\n')
+            hgrepo.commit(user="Jane Doe <jdoe@foo.tld>",
+                          message="initial commit",
+                          addremove=True)
+            for f in files:
+                with open(hgrepo.pathto(f), 'w') as fh:
+                    fh.write('<!ENTITY key "Hello World">\n')
+            hgrepo.commit(user="Jane Doe <jdoe@foo.tld>",
+                          message="Second commit")
+        Repository.objects.create(
+            name=self.repo_name,
+            url='http://localhost:8001/%s/' % self.repo_name
+        )
+        url = reverse('pushes:diff-json')
+        params = {'repo': self.repo_name, 'from': '0', 'to': '1'}
+        response = self.client.get(url, {'repo': self.repo_name})
+        self.assertEqual(response.status_code, 400)
+        response = self.client.get(url, params)
+        self.assertEqual(response.status_code, 200)
+        self.assertDictEqual(response.json(), {
+            'path': '',
+            'entries': [
+                {'path': 'browser', 'name': 'browser', 'type': 'directory'},
+                {
+                    'path': 'toolkit/main/c.dtd',
+                    'name': 'toolkit/main/c.dtd',
+                    'type': 'file',
+                    'class': 'file',
+                    'renamed': None,
+                    'copied': None,
+                    'entities': 1,
+                },
+            ]
+        })
+        response = self.client.get(url, dict(params, path='browser'))
+        self.assertListEqual(
+            [entry['path'] for entry in response.json()['entries']],
+            ['browser/a.dtd', 'browser/b.dtd']
+        )
+        response = self.client.get(url, dict(params, path='browser/b.dtd'))
+        data = response.json()
+        self.assertEqual(data['path'], 'browser/b.dtd')
+        self.assertEqual(data['file']['lines'][0]['entity'], 'key')
+        self.assertEqual(data['file']['lines'][0]['class'], 'changed')
+        response = self.client.get(url, dict(params, path='toolkit/foo'))
+        self.assertEqual(response.status_code, 404)
+
 
 class TestPaths4Revs(RepoTestBase):
 
@@ -413,13 +634,13 @@ to_add = New Value
         self.assertEqual(val_line['class'], 'changed')
         self.assertListEqual(
             [d['value'] for d in val_line['oldval']],
-            ['My', ' Value'])
+            ['My Value'])
         self.assertListEqual(
             [d['class'] for d in val_line['oldval']],
-            ['equal', 'equal'])
+            ['equal'])
         self.assertListEqual(
             [d['value'] for d in val_line['newval']],
-            ['My', ' New', ' Value'])
+            ['My ', 'New ', 'Value'])
         self.assertListEqual(
             [d['class'] for d in val_line['newval']],
             ['equal', 'insert', 'equal'])
@@ -427,10 +648,10 @@ to_add = New Value
         self.assertEqual(attr_line['class'], 'changed')
         self.assertListEqual(
             [d['value'] for d in attr_line['oldval']],
-            ['Attr', 'bute'])
+            ['Attrbute'])
         self.assertListEqual(
             [d['class'] for d in attr_line['oldval']],
-            ['equal', 'equal'])
+            ['equal'])
         self.assertListEqual(
             [d['value'] for d in attr_line['newval']],
             ['Attr', 'i', 'bute'])
@@ -0,0 +1,58 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+from unittest import mock
+
+from compare_locales.parser import DTDParser, PropertiesParser
+from django.test import override_settings
+
+from pushes.entities import EntityCache
+from pushes.views.diff import DiffView
+from .base import TestCase
+
+
+class EntityCacheTest(TestCase):
+
+    def setUp(self):
+        super(EntityCacheTest, self).setUp()
+        self.cache = EntityCache(maxsize=100)
+        self.parse = mock.Mock(wraps=DiffView().parse)
+
+    def test_reuse(self):
+        content = b'<!ENTITY key "Hello">\n'
+        entities = self.cache.get(DTDParser(), content, self.parse)
+        self.assertEqual(entities, (('key', 'Hello'),))
+        self.assertIs(
+            self.cache.get(DTDParser(), content, self.parse),
+            entities
+        )
+        self.assertEqual(self.parse.call_count, 1)
+        # other parsers parse the same content differently
+        self.cache.get(PropertiesParser(), content, self.parse)
+        self.assertEqual(self.parse.call_count, 2)
+
+    def test_eviction(self):
+        first = b'<!ENTITY first "%s">\n' % (b'a' * 20)
+        second = b'<!ENTITY second "%s">\n' % (b'b' * 20)
+        third = b'<!ENTITY third "%s">\n' % (b'c' * 20)
+        for content in (first, second, first, third):
+            self.cache.get(DTDParser(), content, self.parse)
+        self.assertEqual(self.parse.call_count, 3)
+        # second is the least recently used
+        self.cache.get(DTDParser(), first, self.parse)
+        self.assertEqual(self.parse.call_count, 3)
+        self.cache.get(DTDParser(), second, self.parse)
+        self.assertEqual(self.parse.call_count, 4)
+        # contents larger than the cache don't get stored
+        big = b'<!ENTITY big "%s">\n' % (b'd' * 100)
+        self.cache.get(DTDParser(), big, self.parse)
+        self.cache.get(DTDParser(), big, self.parse)
+        self.assertEqual(self.parse.call_count, 6)
+
+    @override_settings(DIFF_ENTITY_CACHE_SIZE=10)
+    def test_settings(self):
+        cache = EntityCache()
+        self.assertEqual(cache.maxsize, 10)
@@ -0,0 +1,107 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import shutil
+import threading
+
+import hglib
+
+from pushes.hgpool import ClientPool
+from .base import RepoTestBase
+
+
+class ClientPoolTest(RepoTestBase):
+
+    repo_name = 'mozilla-central'
+
+    def setUp(self):
+        super(ClientPoolTest, self).setUp()
+        hglib.init(self.repo)
+        self.pool = ClientPool(maxsize=2)
+
+    def tearDown(self):
+        self.pool.clear()
+        super(ClientPoolTest, self).tearDown()
+
+    def test_reuse(self):
+        with self.pool.client(self.repo) as client:
+            self.assertEqual(len(client.log()), 0)
+            # concurrent users get their own client
+            with self.pool.client(self.repo) as other:
+                self.assertIsNot(client, other)
+        self.assertEqual(len(self.pool._idle), 2)
+        # the most recently used client is reused
+        with self.pool.client(self.repo) as reused:
+            self.assertIs(reused, client)
+        self.assertIsNotNone(other.server)
+
+    def test_eviction(self):
+        clients = [self.pool.acquire(self.repo) for _ in range(3)]
+        for client in clients:
+            self.pool.release(client)
+        self.assertIsNone(clients[0].server)
+        self.assertListEqual(
+            [entry[1] for entry in self.pool._idle],
+            clients[1:]
+        )
+        self.pool.idle_timeout = 0
+        client = self.pool.acquire(self.repo)
+        self.assertNotIn(client, clients)
+        self.assertListEqual(self.pool._idle, [])
+        self.assertIsNone(clients[1].server)
+        self.assertIsNone(clients[2].server)
+        self.pool.release(client)
+
+    def test_health(self):
+        client = self.pool.acquire(self.repo)
+        client.close()
+        # closed clients don't get back into the pool
+        self.pool.release(client)
+        self.assertListEqual(self.pool._idle, [])
+        client = self.pool.acquire(self.repo)
+        client.server.kill()
+        client.server.wait()
+        self.pool.release(client)
+        other = self.pool.acquire(self.repo)
+        self.assertIsNot(client, other)
+        self.pool.release(other)
+        # removed clones are discarded
+        shutil.rmtree(self.repo)
+        hglib.init(self.repo)
+        self.pool.discard(self.repo)
+        self.assertListEqual(self.pool._idle, [])
+        self.assertIsNone(other.server)
+
+    def test_failure(self):
+        # hg errors leave the client usable
+        with self.assertRaises(hglib.error.CommandError):
+            with self.pool.client(self.repo) as client:
+                client.log(b'nonexisting')
+        self.assertListEqual(
+            [entry[1] for entry in self.pool._idle],
+            [client]
+        )
+        # other errors might leave the protocol out of sync
+        with self.assertRaises(ValueError):
+            with self.pool.client(self.repo) as client:
+                raise ValueError
+        self.assertListEqual(self.pool._idle, [])
+        self.assertIsNone(client.server)
+
+    def test_max_active(self):
+        self.pool = ClientPool(maxsize=2, max_active=1)
+        client = self.pool.acquire(self.repo)
+        acquired = []
+        waiter = threading.Thread(
+            target=lambda: acquired.append(self.pool.acquire(self.repo))
+        )
+        waiter.start()
+        waiter.join(0.5)
+        self.assertListEqual(acquired, [])
+        self.pool.close(client)
+        waiter.join()
+        self.assertEqual(len(acquired), 1)
+        self.pool.release(acquired[0])
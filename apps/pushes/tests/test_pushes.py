@@ -5,20 +5,34 @@ from __future__ import absolute_import
 from __future__ import unicode_literals
 
 import datetime
+import importlib
+import json
+import os
+import threading
 import time
 from unittest import mock
 from elmo.test import TestCase
+from django.apps import apps
+from django.core.cache import cache
 from django.urls import reverse
 import hglib
+from markus.testing import MetricsMock
 
 from elmo_commons.tests.mixins import EmbedsTestCaseMixin
-from life.models import Repository, Push, Branch, File
-from pushes.utils import handlePushes, PushJS
+from life.models import Repository, Push, Branch, Changeset, File
+from pushes import cache as pushes_cache
+from pushes.signals import pushes_ingested
+from pushes import utils
+from pushes.utils import get_or_create_changesets, handlePushes, PushJS
 from .base import RepoTestBase
 
 
 class PushesTestCase(TestCase, EmbedsTestCaseMixin):
 
+    def setUp(self):
+        super(PushesTestCase, self).setUp()
+        cache.clear()
+
     def test_render_push_log(self):
         """basic test rendering the pushlog"""
         url = reverse('pushes:pushlog')
@@ -27,9 +41,186 @@ class PushesTestCase(TestCase, EmbedsTestCaseMixin):
         self.assert_all_embeds(response.content)
         # like I said, a very basic test
 
+    def test_pushlog_path(self):
+        repo = Repository.objects.create(
+          name='mozilla-central',
+          url='file:///mozilla-central/'
+        )
+        file_ids = utils.file_ids.resolve(
+            ['browser/app.dtd', 'mobile/app.ftl']
+        )
+        for push_id, path in enumerate(('browser/app.dtd', 'mobile/app.ftl')):
+            cs = Changeset.objects.create(revision='%040x' % (push_id + 1))
+            cs.files.add(file_ids[path])
+            Push.objects.create(
+                repository=repo, push_id=push_id, user='jdoe',
+                push_date=datetime.datetime(2020, 7, 1, 0, push_id)
+            ).changesets.add(cs)
+        response = self.client.get(
+            reverse('pushes:pushlog'), {'path': 'app.ftl'}
+        )
+        self.assertListEqual(
+            [p['push']['push_id'] for p in response.context['pushes']],
+            [1]
+        )
+        # the context is cached, it only holds plain values
+        push, = response.context['pushes']
+        self.assertDictEqual(push['push']['repository'], {
+            'name': 'mozilla-central',
+            'url': 'file:///mozilla-central/',
+        })
+        self.assertEqual(push['tip']['revision'], '%040x' % 2)
+        self.assertContains(
+            response, 'file:///mozilla-central/rev/' + ('%040x' % 2)[:12]
+        )
+
+    def test_pushlog_cache(self):
+        repo = Repository.objects.create(
+          name='mozilla-central',
+          url='file:///mozilla-central/'
+        )
+        other = Repository.objects.create(
+          name='comm-central',
+          url='file:///comm-central/'
+        )
+
+        def push(repo, push_id):
+            Push.objects.create(
+                repository=repo, push_id=push_id, user='jdoe',
+                push_date=datetime.datetime(2020, 7, 1, 0, push_id)
+            ).changesets.add(Changeset.objects.create(
+                revision='%039x%d' % (push_id, repo.id)
+            ))
+
+        def push_ids(repo_name=None):
+            url = reverse('pushes:pushlog')
+            if repo_name is not None:
+                url += repo_name
+            response = self.client.get(url, {'length': 10})
+            return [p['push']['push_id'] for p in response.context['pushes']]
+
+        push(repo, 1)
+        push(other, 2)
+        self.assertListEqual(push_ids('mozilla-central'), [1])
+        self.assertListEqual(push_ids(), [2, 1])
+        push(repo, 3)
+        # not invalidated yet
+        self.assertListEqual(push_ids('mozilla-central'), [1])
+        self.assertListEqual(push_ids(), [2, 1])
+        pushes_cache.bump(other.id)
+        self.assertListEqual(push_ids('mozilla-central'), [1])
+        self.assertListEqual(push_ids(), [3, 2, 1])
+        pushes_cache.bump(repo.id)
+        self.assertListEqual(push_ids('mozilla-central'), [3, 1])
+
+    def test_pushlog_cursor(self):
+        repo = Repository.objects.create(
+          name='mozilla-central',
+          url='file:///mozilla-central/'
+        )
+        date = datetime.datetime(2020, 7, 1)
+
+        def push(push_id, seconds):
+            p = Push.objects.create(
+                repository=repo, push_id=push_id, user='jdoe',
+                push_date=date + datetime.timedelta(seconds=seconds)
+            )
+            p.changesets.add(Changeset.objects.create(
+                revision='%040x' % push_id
+            ))
+            return p
+
+        # pushes 2 and 3 share a push_date
+        for push_id, seconds in ((1, 0), (2, 1), (3, 1), (4, 2), (5, 3)):
+            push(push_id, seconds)
+        url = reverse('pushes:pushlog')
+        response = self.client.get(url, {'length': 2})
+        pages = [[p['push']['push_id'] for p in response.context['pushes']]]
+        next_page = response.context['next_page']
+        # new pushes don't shift later pages
+        push(6, 4)
+        while next_page:
+            response = self.client.get(url + '?' + next_page)
+            self.assertEqual(response.status_code, 200)
+            pages.append(
+                [p['push']['push_id'] for p in response.context['pushes']]
+            )
+            next_page = response.context['next_page']
+        self.assertListEqual(pages, [[5, 4], [3, 2], [1]])
+        # offset pagination still works
+        response = self.client.get(url, {'length': 2, 'start': 1})
+        self.assertListEqual(
+            [p['push']['push_id'] for p in response.context['pushes']][:2],
+            [5, 4]
+        )
+        # bad cursors are ignored
+        response = self.client.get(url, {'length': 2, 'cursor': 'bogus'})
+        self.assertListEqual(
+            [p['push']['push_id'] for p in response.context['pushes']],
+            [6, 5]
+        )
+
+    def test_pushlog_json(self):
+        repo = Repository.objects.create(
+          name='mozilla-central',
+          url='file:///mozilla-central/'
+        )
+        date = datetime.datetime(2020, 7, 1)
+        for push_id in range(1, 6):
+            p = Push.objects.create(
+                repository=repo, push_id=push_id, user='jdoe',
+                push_date=date + datetime.timedelta(seconds=push_id)
+            )
+            for i in range(2):
+                p.changesets.add(Changeset.objects.create(
+                    revision='%039x%d' % (push_id, i),
+                    user='Jane Doe', description='commit %d' % i
+                ))
+        url = reverse('pushes:pushlog-json')
+
+        def get(**query):
+            response = self.client.get(url, query)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response['Content-Type'], 'application/json')
+            return json.loads(b''.join(response.streaming_content))
+
+        with mock.patch('pushes.views.pushlog.JSON_BATCH_SIZE', 2):
+            data = get(length=3)
+            self.assertListEqual(
+                [push['push_id'] for push in data['pushes']], [5, 4, 3]
+            )
+            self.assertDictEqual(data['pushes'][0], {
+                'id': Push.objects.get(push_id=5).id,
+                'push_id': 5,
+                'repository': 'mozilla-central',
+                'user': 'jdoe',
+                'date': 1593561605,
+                'changesets': [
+                    {
+                        'revision': '%039x%d' % (5, i),
+                        'user': 'Jane Doe',
+                        'description': 'commit %d' % i,
+                    }
+                    for i in (1, 0)
+                ],
+            })
+            data = get(length=3, cursor=data['next'])
+            self.assertListEqual(
+                [push['push_id'] for push in data['pushes']], [2, 1]
+            )
+            self.assertIsNone(data['next'])
+            data = get(length=2, start=2)
+            self.assertListEqual(
+                [push['push_id'] for push in data['pushes']], [3, 2]
+            )
+            # without limit
+            data = get(**{'from': 0})
+            self.assertEqual(len(data['pushes']), 5)
+            self.assertIsNone(data['next'])
+
 
 class TestPushJS(TestCase):
-    @mock.patch('requests.get')
+    @mock.patch.object(utils.session, 'get')
     def test_push_known(self, requests_mock):
         repo = Repository.objects.create(
           name='mozilla-central',
@@ -64,6 +255,137 @@ class TestPushJS(TestCase):
             [len(p.changesets) for p in pushjs_objects]
         )
 
+    @mock.patch.object(utils.session, 'get')
+    def test_pages(self, get_mock):
+        repo = Repository.objects.create(
+          name='mozilla-central',
+          url='file:///mozilla-central/'
+        )
+        Push.objects.create(
+            repository=repo, push_id=3, user='jdoe',
+            push_date=datetime.datetime.utcnow()
+        )
+
+        def get(url, **kwargs):
+            start, end = (
+                int(arg.split('=')[1]) for arg in url.split('&')[1:]
+            )
+            response = mock.MagicMock()
+            response.json.return_value = {'pushes': {
+                str(push_id): {
+                    'changesets': [], 'date': 1593532760, 'user': 'jdoe',
+                }
+                # push 6 got stripped
+                for push_id in range(start + 1, end + 1) if push_id != 6
+            }}
+            return response
+
+        get_mock.side_effect = get
+        pages = PushJS.pages_for(repo, 8, size=2)
+        self.assertListEqual([4, 5], [p.id for p in next(pages)])
+        self.assertEqual(get_mock.call_count, 1)
+        self.assertListEqual(
+            [[7], [8]],
+            [[p.id for p in page] for page in pages]
+        )
+        self.assertListEqual(
+            [
+                'file:///mozilla-central/json-pushes'
+                '?version=2&startID=%d&endID=%d' % (start, end)
+                for start, end in ((3, 5), (5, 7), (7, 8))
+            ],
+            [call[0][0] for call in get_mock.call_args_list]
+        )
+
+
+class TestPushTip(TestCase):
+    def test_tip(self):
+        repo = Repository.objects.create(
+          name='mozilla-central',
+          url='file:///mozilla-central/'
+        )
+        first, second, third = (
+            Changeset.objects.create(revision='%040x' % i)
+            for i in range(1, 4)
+        )
+        push = Push.objects.create(
+            repository=repo, push_id=1, user='jdoe',
+            push_date=datetime.datetime.utcnow()
+        )
+        self.assertIsNone(push.tip)
+        push.changesets.set([second, first])
+        self.assertEqual(push.tip, second)
+        third.pushes.add(push)
+        self.assertEqual(Push.objects.get(id=push.id).tip, third)
+        third.pushes.clear()
+        self.assertEqual(Push.objects.get(id=push.id).tip, second)
+        push.changesets.remove(second)
+        self.assertEqual(push.tip, first)
+        self.assertEqual(
+            str(Push.objects.get(id=push.id)),
+            'file:///mozilla-central/pushloghtml?changeset=' + first.shortrev
+        )
+
+
+class TestChangesetUrl(TestCase):
+    def test_first_push(self):
+        central, beta = (
+            Repository.objects.create(name=name, url=f'https://hg/{name}/')
+            for name in ('central', 'beta')
+        )
+        changesets = [
+            Changeset.objects.create(revision='%040x' % i)
+            for i in range(1, 5)
+        ]
+        central.changesets.add(*changesets)
+        beta.changesets.add(*changesets)
+        for repo, push_id, cs, day in (
+            (beta, 1, changesets[0], 2),
+            (central, 1, changesets[0], 1),
+            (beta, 2, changesets[1], 3),
+        ):
+            Push.objects.create(
+                repository=repo, push_id=push_id, user='jdoe',
+                push_date=datetime.datetime(2020, 7, day)
+            ).changesets.add(cs)
+        self.assertEqual(
+            changesets[2].url(), 'https://hg/central/rev/000000000000'
+        )
+        migration = importlib.import_module(
+            'life.migrations.0003_changesetorigin'
+        )
+        migration.resolve_origins(apps, None)
+        with self.assertNumQueries(1):
+            urls = [
+                cs.url() for cs in
+                Changeset.objects
+                .filter(id__in=[cs.id for cs in changesets])
+                .order_by('id')
+            ]
+        self.assertListEqual(urls, [
+            'https://hg/central/rev/000000000000',
+            'https://hg/beta/rev/000000000000',
+            'https://hg/central/rev/000000000000',
+            'https://hg/central/rev/000000000000',
+        ])
+        # related managers select the origin, too
+        with self.assertNumQueries(1):
+            self.assertEqual(
+                len(set(cs.url() for cs in beta.changesets.all())), 2
+            )
+        self.assertListEqual(
+            list(
+                Changeset.objects
+                .filter(id__in=[cs.id for cs in changesets])
+                .order_by('id')
+                .values_list(
+                    'origin__first_push__repository__name',
+                    'origin__first_push__push_id'
+                )
+            ),
+            [('central', 1), ('beta', 2), (None, None), (None, None)]
+        )
+
 
 @mock.patch('pushes.utils.logging', mock.MagicMock())
 class TestHandlePushes(RepoTestBase):
@@ -96,8 +418,20 @@ class TestHandlePushes(RepoTestBase):
             'changesets': [rev0],
             'user': username,
         })
-        result = handlePushes(repo.pk, [pushjs0])
-        self.assertEqual(result, 1)
+        with mock.patch('pushes.utils.transaction.on_commit') as on_commit, \
+                mock.patch.object(pushes_cache, 'bump') as bump, \
+                mock.patch.object(pushes_ingested, 'send') as send:
+            result = handlePushes(repo.pk, [pushjs0])
+            self.assertEqual(result, 1)
+            # TestCase doesn't commit, run the last callbacks ourselves
+            bump.assert_not_called()
+            send.assert_not_called()
+            for call in on_commit.call_args_list[-2:]:
+                call[0][0]()
+        bump.assert_called_once_with(repo.id)
+        send.assert_called_once_with(
+            sender=Push, repository=repo, pushes=list(Push.objects.all())
+        )
 
         # expect all of these to have been created
         push, = Push.objects.all()
@@ -116,9 +450,77 @@ class TestHandlePushes(RepoTestBase):
         self.assertEqual(changeset.user, 'Jane Doe <jdoe@foo.tld>')
         self.assertEqual(changeset.revision, rev0)
         self.assertEqual(changeset.branch, branch)
+        self.assertEqual(changeset.origin.first_push, push)
+        self.assertEqual(changeset.origin.repository, repo)
 
         self.assertEqual(branch.name, 'default')
 
+    def test_skip_pull(self):
+        repo = Repository.objects.create(
+          name='mozilla-central',
+          url='file:///' + self.repo
+        )
+
+        def commit(hgrepo, content):
+            with open(hgrepo.pathto('file.dtd'), 'w') as fh:
+                fh.write(content)
+            hgrepo.commit(user="Jane Doe <jdoe@foo.tld>",
+                          message="commit",
+                          addremove=True)
+            return hgrepo.tip().node.decode('ascii')
+
+        def push(push_id, revs):
+            return PushJS(push_id, {
+                'date': int(time.time()),
+                'changesets': revs,
+                'user': 'jdoe',
+            })
+
+        def local_tags(metrics):
+            return [
+                [tag for tag in record[3] if tag.startswith('local:')]
+                for record in metrics.filter_records(
+                    'timing', stat='hg.worker.hg-pull'
+                )
+            ]
+
+        with hglib.init(self.repo).open() as hgrepo:
+            rev0 = commit(hgrepo, '<!ENTITY key1 "Hello">\n')
+            with MetricsMock() as metrics:
+                handlePushes(repo.pk, [push(100, [rev0])])
+                handlePushes(repo.pk, [push(101, [rev0])])
+                self.assertListEqual(
+                    local_tags(metrics), [['local:miss'], ['local:hit']]
+                )
+            rev1 = commit(hgrepo, '<!ENTITY key1 "Hi">\n')
+            with MetricsMock() as metrics:
+                handlePushes(repo.pk, [push(102, [rev0, rev1])])
+                self.assertListEqual(local_tags(metrics), [['local:miss']])
+        self.assertListEqual(
+            list(
+                Push.objects.get(push_id=102)
+                .changesets.values_list('revision', flat=True)
+            ),
+            [rev0, rev1]
+        )
+
+    def test_failed_check(self):
+        '''A failing local check pulls instead of cloning again'''
+        repo = Repository.objects.create(
+          name='mozilla-central',
+          url='file:///' + self.repo
+        )
+        hglib.init(self.repo).close()
+        with mock.patch('pushes.utils._has_revisions',
+                        side_effect=RuntimeError('pool')), \
+                mock.patch('pushes.utils._hg_repository_sync') as sync, \
+                mock.patch('pushes.utils.shutil.rmtree') as rmtree:
+            utils._ensure_hg_repository_sync(repo, revisions=['0' * 40])
+        sync.assert_called_once_with(
+            repo.local_path(), repo.url, do_update=False
+        )
+        rmtree.assert_not_called()
+
     def test_handlePushes_messedup_revisions(self):
         repo = Repository.objects.create(
             name='mozilla-central',
@@ -213,6 +615,30 @@ class TestHandlePushes(RepoTestBase):
         pushes_after_after = Push.objects.all().count()
         self.assertEqual(pushes_after, pushes_after_after)
 
+    def test_handlePushes_locked(self):
+        '''Writes to shared tables are serialized across threads'''
+        repo = Repository.objects.create(
+            name='mozilla-central',
+            url='file:///' + self.repo
+        )
+        hglib.init(self.repo).close()
+        locked = []
+
+        def _handlePushes(*args, **kwargs):
+            # try to get the lock from another thread
+            thread = threading.Thread(
+                target=lambda: locked.append(
+                    not utils.ingest_lock.acquire(blocking=False)
+                )
+            )
+            thread.start()
+            thread.join()
+            return 0
+
+        with mock.patch('pushes.utils._handlePushes', _handlePushes):
+            handlePushes(repo.pk, [])
+        self.assertListEqual(locked, [True])
+
     def test_handlePushes_cause_repoerror(self):
         repo = Repository.objects.create(
             name='mozilla-central',
@@ -294,3 +720,144 @@ class TestHandlePushes(RepoTestBase):
         # re-fetch
         repo = Repository.objects.get(pk=repo.pk)
         self.assertEqual(repo.changesets.all().count(), 3)
+
+
+class TestGetOrCreateChangesets(RepoTestBase):
+
+    repo_name = 'mozilla-central'
+
+    def _commit(self, hgrepo, path, content, message, **kwargs):
+        with open(hgrepo.pathto(path), 'w') as fh:
+            fh.write(content)
+        hgrepo.commit(user="Jane Doe <jdoe@foo.tld>", message=message,
+                      addremove=True, **kwargs)
+        return hgrepo.tip().node.decode('ascii')
+
+    def test_batch(self):
+        with hglib.init(self.repo).open() as hgrepo:
+            rev0 = self._commit(hgrepo, 'file.dtd', 'one', 'initial commit')
+            rev1 = self._commit(hgrepo, 'file.dtd ', 'space', 'space file')
+            hgrepo.update(rev=rev0)
+            hgrepo.branch(b'release')
+            rev2 = self._commit(hgrepo, 'other.dtd', 'two', 'on branch')
+            hgrepo.update(rev=rev1)
+            hgrepo.merge(rev=rev2.encode('ascii'), tool=b'internal:local')
+            rev3 = self._commit(hgrepo, 'file.dtd', 'merged', 'merge')
+            repo = self.dbrepo()
+            ids = get_or_create_changesets(repo, hgrepo, b'::tip')
+            files = {
+                rev: hgrepo[rev.encode('ascii')].files()
+                for rev in (rev0, rev1, rev2, rev3)
+            }
+        self.assertSetEqual(set(ids), {rev0, rev1, rev2, rev3})
+        changesets = {
+            cs.revision: cs
+            for cs in Changeset.objects.filter(id__in=ids.values())
+        }
+        for rev, cs in changesets.items():
+            self.assertEqual(cs.id, ids[rev])
+            self.assertListEqual(
+                sorted(f.path for f in cs.files.all()),
+                [f.decode('utf-8') for f in files[rev]]
+            )
+        self.assertListEqual(
+            [cs.revision for cs in changesets[rev0].parents.all()],
+            ['0' * 40]
+        )
+        self.assertSetEqual(
+            {cs.revision for cs in changesets[rev3].parents.all()},
+            {rev1, rev2}
+        )
+        self.assertEqual(changesets[rev2].branch.name, 'release')
+        self.assertEqual(changesets[rev3].branch.name, 'default')
+        self.assertEqual(changesets[rev3].description, 'merge')
+        self.assertEqual(repo.changesets.count(), 5)
+        self.assertSetEqual(
+            set(File.objects.values_list('path', flat=True)),
+            {'file.dtd', 'file.dtd ', 'other.dtd'}
+        )
+
+    def test_existing_parent(self):
+        with hglib.init(self.repo).open() as hgrepo:
+            rev0 = self._commit(hgrepo, 'file.dtd', 'one', 'initial commit')
+            rev1 = self._commit(hgrepo, 'file.dtd', 'two', 'second')
+            rev2 = self._commit(hgrepo, 'file.dtd', 'three', 'third')
+            repo = self.dbrepo(changesets_from=hgrepo, revrange=rev0)
+            # rev1 is neither in the db nor in the batch
+            ids = get_or_create_changesets(
+                repo, hgrepo, [rev2.encode('ascii')]
+            )
+            self.assertListEqual(list(ids), [rev2])
+            self.assertEqual(Changeset.objects.count(), 4)
+            cs2 = Changeset.objects.get(revision=rev2)
+            self.assertListEqual(
+                [cs.revision for cs in cs2.parents.all()], [rev1]
+            )
+            self.assertEqual(File.objects.count(), 1)
+            # existing changesets are just added to the repo
+            other = self.dbrepo(name='other')
+            self.assertDictEqual(
+                get_or_create_changesets(other, hgrepo, b'::tip'),
+                dict(Changeset.objects
+                     .filter(revision__in=[rev0, rev1, rev2])
+                     .values_list('revision', 'id'))
+            )
+            self.assertEqual(other.changesets.count(), 4)
+            self.assertRaises(
+                KeyError,
+                get_or_create_changesets, other, hgrepo, [b'deadbeef']
+            )
+
+    @mock.patch('pushes.utils.INGEST_BATCH_SIZE', 2)
+    def test_import_ancestors(self):
+        with hglib.init(self.repo).open() as hgrepo:
+            revs = [
+                self._commit(hgrepo, 'file.dtd', str(i), 'commit %d' % i)
+                for i in range(7)
+            ]
+            repo = self.dbrepo()
+            create = utils._create_changesets
+            calls = []
+
+            def crash(*args):
+                calls.append(args)
+                if len(calls) == 2:
+                    raise RuntimeError('crash')
+                return create(*args)
+
+            with mock.patch('pushes.utils._create_changesets', crash):
+                self.assertRaises(
+                    RuntimeError,
+                    utils.import_ancestors, repo, hgrepo, [revs[-1]]
+                )
+            self.assertListEqual(
+                list(Changeset.objects
+                     .exclude(revision='0' * 40)
+                     .order_by('id')
+                     .values_list('revision', flat=True)),
+                revs[:2]
+            )
+            checkpoint = os.path.join(
+                self.repo, '.hg', utils.CHECKPOINT_FILE
+            )
+            with open(checkpoint) as fh:
+                self.assertEqual(fh.read(), revs[1])
+            # resume, the walk stops at the checkpoint
+            with mock.patch('pushes.utils.log_changesets',
+                            wraps=utils.log_changesets) as log:
+                utils.import_ancestors(repo, hgrepo, [revs[-1]])
+            self.assertEqual(log.call_count, 3)
+            self.assertListEqual(
+                [args[1] for args, kwargs in log.call_args_list],
+                [[rev.encode('ascii') for rev in revs[i:i + 2]]
+                 for i in (2, 4, 6)]
+            )
+            with open(checkpoint) as fh:
+                self.assertEqual(fh.read(), revs[-1])
+        changesets = list(
+            Changeset.objects.exclude(revision='0' * 40).order_by('id')
+        )
+        self.assertListEqual([cs.revision for cs in changesets], revs)
+        for parent, child in zip(changesets, changesets[1:]):
+            self.assertListEqual(list(child.parents.all()), [parent])
+        self.assertEqual(repo.changesets.count(), 8)
@@ -0,0 +1,112 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+from pushes.stringdiff import diff_strings
+from .base import TestCase
+
+
+def classes_and_values(segments):
+    return [(segment['class'], segment['value']) for segment in segments]
+
+
+class DiffStringsTest(TestCase):
+
+    def test_words(self):
+        old, new = diff_strings(
+            'Open the file in a new window',
+            'Open the link in a new tab'
+        )
+        self.assertListEqual(classes_and_values(old), [
+            ('equal', 'Open the '),
+            ('replace', 'file'),
+            ('equal', ' in a new '),
+            ('replace', 'window'),
+        ])
+        self.assertListEqual(classes_and_values(new), [
+            ('equal', 'Open the '),
+            ('replace', 'link'),
+            ('equal', ' in a new '),
+            ('replace', 'tab'),
+        ])
+
+    def test_typo(self):
+        old, new = diff_strings('Save the Attrbute', 'Save the Attribute')
+        self.assertListEqual(classes_and_values(old), [
+            ('equal', 'Save the Attrbute'),
+        ])
+        self.assertListEqual(classes_and_values(new), [
+            ('equal', 'Save the Attr'),
+            ('insert', 'i'),
+            ('equal', 'bute'),
+        ])
+
+    def test_insert_delete(self):
+        old, new = diff_strings('', 'Hello')
+        self.assertListEqual(old, [])
+        self.assertListEqual(classes_and_values(new), [('insert', 'Hello')])
+        old, new = diff_strings('Hello, World', 'Hello')
+        self.assertListEqual(classes_and_values(old), [
+            ('equal', 'Hello'),
+            ('delete', ', World'),
+        ])
+        self.assertListEqual(classes_and_values(new), [('equal', 'Hello')])
+
+    def test_budget(self):
+        oldval = 'Start ' + 'a b ' * 100 + 'End'
+        newval = 'Start ' + 'b a ' * 100 + 'End'
+        old, new = diff_strings(oldval, newval, max_cost=100)
+        self.assertListEqual(classes_and_values(old), [
+            ('equal', 'Start '),
+            ('replace', ('a b ' * 100)[:-1]),
+            ('equal', ' End'),
+        ])
+        self.assertListEqual(classes_and_values(new), [
+            ('equal', 'Start '),
+            ('replace', ('b a ' * 100)[:-1]),
+            ('equal', ' End'),
+        ])
+        # within budget, we get a real diff
+        old, new = diff_strings(oldval, newval)
+        self.assertListEqual(classes_and_values(old), [
+            ('equal', 'Start ' + 'a b ' * 99 + 'a '),
+            ('delete', 'b '),
+            ('equal', 'End'),
+        ])
+        self.assertListEqual(classes_and_values(new), [
+            ('equal', 'Start '),
+            ('insert', 'b '),
+            ('equal', 'a b ' * 99 + 'a End'),
+        ])
+
+    def test_unspaced(self):
+        old, new = diff_strings('ファイルを開く', 'リンクを開く')
+        self.assertListEqual(classes_and_values(old), [
+            ('replace', 'ファイル'),
+            ('equal', 'を開く'),
+        ])
+        self.assertListEqual(classes_and_values(new), [
+            ('replace', 'リンク'),
+            ('equal', 'を開く'),
+        ])
+        # long texts without spaces are within the budget, or replaced
+        oldval = '\u4e00\u4e8c' * 3000
+        newval = '\u4e8c\u4e00' * 3000
+        old, new = diff_strings(oldval, newval, max_cost=100)
+        self.assertListEqual(classes_and_values(old), [('replace', oldval)])
+        self.assertListEqual(classes_and_values(new), [('replace', newval)])
+        old, new = diff_strings(oldval, oldval[:3000] + 'x' + oldval[3000:])
+        self.assertListEqual(classes_and_values(new), [
+            ('equal', oldval[:3000]),
+            ('insert', 'x'),
+            ('equal', oldval[3000:]),
+        ])
+
+    def test_long_words(self):
+        oldval = 'a' * 6000
+        newval = 'b' * 6000
+        old, new = diff_strings(oldval, newval, max_cost=100)
+        self.assertListEqual(classes_and_values(old), [('replace', oldval)])
+        self.assertListEqual(classes_and_values(new), [('replace', newval)])
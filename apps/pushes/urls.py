@@ -10,5 +10,8 @@ from .views import diff, pushlog
 app_name = 'pushes'
 urlpatterns = [
     url(r'^pushes/(?P<repo_name>.+)?$', pushlog.pushlog, name='pushlog'),
+    url(r'^pushes-json/(?P<repo_name>.+)?$', pushlog.pushlog_json,
+        name='pushlog-json'),
     url(r'^diff/$', diff.DiffView.as_view(), name='diff'),
+    url(r'^diff-json/$', diff.DiffJSONView.as_view(), name='diff-json'),
 ]
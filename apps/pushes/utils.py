@@ -17,12 +17,23 @@ import six.moves.urllib.parse
 from six.moves import range
 from functools import reduce
 import shutil
+import threading
+import time
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import hglib
 
-from life.models import Repository, Push, Changeset, Branch, File, Locale
+from life.models import (
+    Repository, Push, Changeset, ChangesetOrigin, Branch, Locale
+)
+from mbdb.files import file_ids
+from pushes import cache as pushes_cache
+from pushes.signals import pushes_ingested
+from pushes.hgpool import hg_pool
 from django.db import transaction, connection
+from django.db.models import Q
 import markus
 from markus.utils import generate_tag
 
@@ -30,20 +41,83 @@ from markus.utils import generate_tag
 metrics = markus.get_metrics('hg.worker')
 
 
+# number of pushes requested from json-pushes at a time
+PUSHES_PAGE_SIZE = 100
+# seconds to wait for json-pushes to respond
+PUSHES_TIMEOUT = 60
+# number of pushes requested and inserted at a time by backfill
+BACKFILL_PAGE_SIZE = 1000
+
+
+def _http_session():
+    '''Session with keep-alive and retries on hg.m.o hiccups.
+    '''
+    http = requests.Session()
+    adapter = HTTPAdapter(max_retries=Retry(
+        total=5, backoff_factor=1, status_forcelist=(500, 502, 503, 504)
+    ))
+    http.mount('http://', adapter)
+    http.mount('https://', adapter)
+    return http
+
+
+session = _http_session()
+
+# local clones to pull from instead of the upstream repository urls,
+# by url, for benchmarks like replay-pulse
+pull_urls = {}
+
+
+def pull_url(url):
+    '''The url to clone or pull url from.
+    '''
+    return pull_urls.get(str(url), str(url))
+
+
 class PushJS(object):
 
     @classmethod
     def pushes_for(cls, repo, last_new_push):
-        lkp = repo.last_known_push()
-        if lkp >= last_new_push:
-            return []
+        return [
+            push
+            for page in cls.pages_for(repo, last_new_push)
+            for push in page
+        ]
+
+    @classmethod
+    def pages_for(cls, repo, last_new_push, size=PUSHES_PAGE_SIZE):
+        '''Yield the pushes after the last known push up to last_new_push,
+        in sorted lists of at most size pushes.
+
+        Pages are fetched lazily, handle each page before requesting
+        the next one.
+        '''
+        start = repo.last_known_push()
+        while start < last_new_push:
+            end = min(start + size, last_new_push)
+            pushes = cls._json_pushes(repo, start, end)['pushes']
+            page = sorted(
+                (cls(k, v) for k, v in pushes.items()),
+                key=lambda push: push.id
+            )
+            if page:
+                yield page
+            start = end
+
+    @classmethod
+    def last_push_id(cls, repo):
+        '''Id of the last push to repo upstream.
+        '''
+        start = repo.last_known_push()
+        return cls._json_pushes(repo, start, start)['lastpushid']
+
+    @staticmethod
+    def _json_pushes(repo, start, end):
         url = '%sjson-pushes?version=2&startID=%d&endID=%d' % \
-            (repo.url, lkp, last_new_push)
-        r = requests.get(url).json()
-        return sorted(
-            (cls(k, v) for k, v in r['pushes'].items()),
-            key=lambda push: push.id
-        )
+            (repo.url, start, end)
+        response = session.get(url, timeout=PUSHES_TIMEOUT)
+        response.raise_for_status()
+        return response.json()
 
     def __init__(self, id, jsfrag):
         self.id = int(id)
@@ -55,72 +129,311 @@ class PushJS(object):
         return '<Push: %d>' % self.id
 
 
-def get_or_create_changeset(repo, hgrepo, ctx):
+# Template to read all data needed for ingestion with a single hg log.
+# One record per changeset, fields are separated by NUL, files by newlines.
+CHANGESET_TEMPLATE = (
+    b'{rev}\\0{node}\\0{p1node}\\0{p2node}\\0{branch}\\0{author}\\0{desc}\\0'
+    b'{file_mods % "{file}\\n"}{file_adds % "{file}\\n"}'
+    b'{file_dels % "{file}\\n"}\\0'
+)
+NULL_REVISION = '0' * 40
+# mysql doesn't like too many values at once, chunk up queries
+CHUNK_SIZE = 1000
+# Serializes the writes to tables shared between repositories, like
+# Changeset, File, Branch and ChangesetOrigin, which check for existing
+# rows and then insert the missing ones. The pulse consumer handles
+# pushes to different repositories on parallel threads, only hg and
+# the pushlog are accessed in parallel.
+ingest_lock = threading.RLock()
+# number of changesets inserted per transaction
+INGEST_BATCH_SIZE = 1000
+# number of recent changesets to bound the walk of unknown ancestors
+BOUNDARY_SIZE = 20
+# checkpoint of import_ancestors, inside the .hg dir of the local clone
+CHECKPOINT_FILE = 'elmo-ingest-checkpoint'
+
+
+def chunks(seq, size=CHUNK_SIZE):
+    seq = list(seq)
+    for i in range(0, len(seq), size):
+        yield seq[i:i + size]
+
+
+class HgChangeset(object):
+    """Metadata of a changeset in a local clone, as read by log_changesets.
+    """
+    def __init__(self, rev, revision, parents, branch, user, description,
+                 files):
+        self.rev = rev
+        self.revision = revision
+        self.parents = parents
+        self.branch = branch
+        self.user = user
+        self.description = description
+        self.files = files
+
+    def __str__(self):
+        return '<HgChangeset: %s>' % self.revision[:12]
+
+
+def log_changesets(hgrepo, revrange):
+    '''Read the data of all changesets in revrange from the local clone.
+
+    Returns a list of HgChangeset objects, ordered by local revision
+    number. That's a topological order, parents come before their children.
+    Raises KeyError if revrange can't be resolved.
+    '''
+    if not revrange:
+        return []
+    args = hglib.util.cmdbuilder(
+        b'log', template=CHANGESET_TEMPLATE, r=revrange, hidden=hgrepo.hidden
+    )
     try:
-        cs = Changeset.objects.get(revision=ctx.node().decode('ascii'))
-        repo.changesets.add(cs)
-        return cs
-    except Changeset.DoesNotExist:
-        pass
-    # create the changeset, but first, let's see if we need the parents
-    parent_revs = [parent.node().decode('ascii') for parent in ctx.parents()]
-    p_dict = dict(Changeset.objects
-                  .filter(revision__in=parent_revs)
-                  .values_list('revision', 'id'))
-    for p in ctx.parents():
-        if p.node().decode('ascii') not in p_dict:
-            p_cs = get_or_create_changeset(repo, hgrepo, p)
-            p_dict[p_cs.revision] = p_cs.id
-    cs = Changeset(revision=ctx.node().decode('ascii'))
-    cs.user = ctx.user().decode('utf-8', 'replace')
-    cs.description = ctx.description().decode('utf-8', 'replace')
-    branch = ctx.branch().decode('utf-8', 'replace')
-    if branch != 'default':
-        # 'default' is already set in the db, only change if needed
-        dbb, __ = Branch.objects.get_or_create(name=branch)
-        cs.branch = dbb
-
-    # because the many-to-many relationships etc don't work until the object
-    # has an ID
-    cs.save()
-
-    cs.parents.set(list(p_dict.values()))
-    repo.changesets.add(cs, *(list(p_dict.values())))
-    files = [p.decode('utf-8', 'replace') for p in ctx.files()]
-    spacefiles = [p for p in files if p.endswith(' ')]
-    goodfiles = [p for p in files if not p.endswith(' ')]
-    if goodfiles:
-        # chunk up the work on files,
-        # mysql doesn't like them all at once
-        chunk_count = len(goodfiles) // 1000 + 1
-        chunk_size = len(goodfiles) // chunk_count
-        if len(goodfiles) % chunk_size:
-            chunk_size += 1
-        for i in range(chunk_count):
-            good_chunk = goodfiles[i * chunk_size:(i + 1) * chunk_size]
-            existingfiles = File.objects.filter(path__in=good_chunk)
-            existingpaths = existingfiles.values_list('path',
-                                                      flat=True)
-            existingpaths = dict.fromkeys(existingpaths)
-            missingpaths = [p for p in good_chunk if p not in existingpaths]
-            File.objects.bulk_create([
-                File(path=p)
-                for p in missingpaths
-            ])
-            good_ids = File.objects.filter(path__in=good_chunk)
-            cs.files.add(*list(good_ids.values_list('pk', flat=True)))
-    for path in spacefiles:
-        # hack around mysql ignoring trailing ' ', and some
-        # of our localizers checking in files with trailing ' '.
-        f = [fo for fo in File.objects.filter(path=path) if fo.path == path]
-        if f:
-            cs.files.add(f[0])
-        else:
-            f = File.objects.create(path=path)
-            cs.files.add(f)
-            f.save()
-    cs.save()
-    return cs
+        out = hgrepo.rawcommand(args)
+    except hglib.error.CommandError as e:
+        raise KeyError(revrange) from e
+    changesets = []
+    for rev, node, p1, p2, branch, user, desc, files in hglib.util.grouper(
+        8, out.split(b'\0')[:-1]
+    ):
+        revision = node.decode('ascii')
+        parents = [p1.decode('ascii')]
+        if p2.decode('ascii') != NULL_REVISION:
+            parents.append(p2.decode('ascii'))
+            files = merge_files(hgrepo, node)
+        changesets.append(HgChangeset(
+            int(rev), revision, parents,
+            branch.decode('utf-8', 'replace'),
+            user.decode('utf-8', 'replace'),
+            desc.decode('utf-8', 'replace'),
+            [p.decode('utf-8', 'replace') for p in files.splitlines()]
+        ))
+    changesets.sort(key=lambda cs: cs.rev)
+    return changesets
+
+
+def merge_files(hgrepo, node):
+    '''Newline-separated paths changed by the merge node, relative to p1.
+
+    The file templates of hg log only list the files touched by the
+    merge resolution, as stored in the changeset. The files changed
+    relative to p1, which we store like changectx.files() does, need a
+    manifest comparison, which neither a template nor any other
+    command computes for more than one revision. Thus we ask status
+    for each merge. Merges are rare compared to regular changesets,
+    which don't need this.
+    '''
+    return b'\n'.join(
+        path for code, path in hgrepo.status(change=node)
+        if code in b'MAR'
+    )
+
+
+def changeset_ids(revisions):
+    '''Map the given revisions to the ids of the existing Changesets.
+    '''
+    ids = {}
+    for chunk in chunks(set(revisions)):
+        ids.update(
+            Changeset.objects
+            .filter(revision__in=chunk)
+            .values_list('revision', 'id')
+        )
+    return ids
+
+
+def branch_ids(names):
+    '''Map branch names to Branch ids, create missing Branch objects.
+    '''
+    names = set(names)
+    ids = dict(
+        Branch.objects.filter(name__in=names).values_list('name', 'id')
+    )
+    missing = [name for name in names if name not in ids]
+    if missing:
+        Branch.objects.bulk_create([Branch(name=name) for name in missing])
+        ids.update(
+            Branch.objects.filter(name__in=missing).values_list('name', 'id')
+        )
+    return ids
+
+
+def get_or_create_changesets(repo, hgrepo, revrange):
+    '''Batched variant of get_or_create_changeset.
+
+    Read all changesets in revrange from the local clone with one hg call,
+    find the existing ones, and bulk insert the missing Changesets,
+    together with their branches, parents and files.
+    Unknown ancestors outside of revrange are imported by import_ancestors.
+    All changesets are added to the repository.
+    Returns a dict mapping revisions to Changeset ids.
+    '''
+    changesets = log_changesets(hgrepo, revrange)
+    ids = changeset_ids(cs.revision for cs in changesets)
+    for chunk in chunks(ids.values()):
+        repo.changesets.add(*chunk)
+    missing = [cs for cs in changesets if cs.revision not in ids]
+    batch = set(cs.revision for cs in missing)
+    unknown = set(
+        p for cs in missing for p in cs.parents
+        if p not in batch
+    )
+    unknown.difference_update(changeset_ids(unknown))
+    if unknown:
+        import_ancestors(repo, hgrepo, unknown)
+    for chunk in chunks(missing, INGEST_BATCH_SIZE):
+        with transaction.atomic():
+            ids.update(_create_changesets(repo, chunk))
+    return dict((cs.revision, ids[cs.revision]) for cs in changesets)
+
+
+def import_ancestors(repo, hgrepo, revisions):
+    '''Import the given revisions and all their unknown ancestors.
+
+    This walks the history iteratively instead of recursing over parents,
+    which gets deep for forks of long histories.
+    The unknown part of the DAG is read with one hg log, and inserted
+    in batches of INGEST_BATCH_SIZE, parents before children. Each batch
+    is a transaction, after which the last revision is stored as a
+    checkpoint in the local clone. All of its ancestors are in the db,
+    so an import resuming after a crash doesn't walk them again.
+    '''
+    checkpoint = os.path.join(
+        os.fsdecode(hgrepo.root()), '.hg', CHECKPOINT_FILE
+    )
+    nodes = _unknown_ancestors(
+        hgrepo, revisions, _walk_boundary(repo, checkpoint)
+    )
+    for chunk in chunks(nodes, INGEST_BATCH_SIZE):
+        changesets = log_changesets(
+            hgrepo, [node.encode('ascii') for node in chunk]
+        )
+        with transaction.atomic():
+            _create_changesets(repo, changesets)
+        with open(checkpoint, 'w') as fh:
+            fh.write(chunk[-1])
+
+
+def _walk_boundary(repo, checkpoint):
+    '''Revisions in the db to stop walking the ancestry at.
+
+    That's the checkpoint of an earlier import, and the most recent
+    changesets, both of this repository and overall. The latter
+    help with forks sharing a unified clone.
+    '''
+    boundary = []
+    if os.path.isfile(checkpoint):
+        with open(checkpoint) as fh:
+            boundary.append(fh.read().strip())
+        boundary = list(
+            Changeset.objects
+            .filter(revision__in=boundary)
+            .values_list('revision', flat=True)
+        )
+    recent = Changeset.objects.exclude(revision=NULL_REVISION).order_by('-id')
+    boundary += recent.filter(repositories=repo).values_list(
+        'revision', flat=True
+    )[:BOUNDARY_SIZE]
+    boundary += recent.values_list('revision', flat=True)[:BOUNDARY_SIZE]
+    return boundary
+
+
+def _unknown_ancestors(hgrepo, revisions, boundary):
+    '''Read the ancestry of revisions up to boundary from the local clone,
+    and return the revisions which are not in the db.
+
+    The result is in topological order, parents come before their children.
+    '''
+    revset = b'::(%s)' % b' + '.join(
+        rev.encode('ascii') for rev in revisions
+    )
+    if boundary:
+        # present() as the boundary might not be in this clone
+        revset += b' - ::(%s)' % b' + '.join(
+            b'present(%s)' % rev.encode('ascii') for rev in boundary
+        )
+    args = hglib.util.cmdbuilder(
+        b'log', template=b'{rev}\\0{node}\\0', r=revset, hidden=hgrepo.hidden
+    )
+    out = hgrepo.rawcommand(args).split(b'\0')[:-1]
+    # local revision numbers are a topological order
+    nodes = [
+        node.decode('ascii')
+        for rev, node in sorted(
+            (int(rev), node) for rev, node in hglib.util.grouper(2, out)
+        )
+    ]
+    known = changeset_ids(nodes)
+    return [node for node in nodes if node not in known]
+
+
+def _create_changesets(repo, changesets):
+    '''Bulk insert the given HgChangesets, and add them to repo.
+
+    Parents need to be in the db, or earlier in changesets.
+    Returns a dict mapping revisions to the ids of the new Changesets.
+    '''
+    branches = branch_ids(
+        cs.branch for cs in changesets if cs.branch != 'default'
+    )
+    Changeset.objects.bulk_create(
+        [
+            Changeset(
+                revision=cs.revision,
+                user=cs.user,
+                description=cs.description,
+                # 'default' is already set in the db, only change if needed
+                branch_id=branches.get(cs.branch, 1),
+            )
+            for cs in changesets
+        ],
+        batch_size=CHUNK_SIZE
+    )
+    created = changeset_ids(cs.revision for cs in changesets)
+    ChangesetOrigin.objects.bulk_create(
+        [
+            ChangesetOrigin(changeset_id=id_, repository=repo)
+            for id_ in created.values()
+        ],
+        batch_size=CHUNK_SIZE
+    )
+    ids = dict(created)
+    ids.update(changeset_ids(
+        p for cs in changesets for p in cs.parents if p not in created
+    ))
+    ParentLink = Changeset.parents.through
+    ParentLink.objects.bulk_create(
+        [
+            ParentLink(
+                from_changeset_id=ids[cs.revision],
+                to_changeset_id=ids[p]
+            )
+            for cs in changesets for p in cs.parents
+        ],
+        batch_size=CHUNK_SIZE
+    )
+    files = file_ids.resolve(
+        path for cs in changesets for path in cs.files
+    )
+    FileLink = Changeset.files.through
+    FileLink.objects.bulk_create(
+        [
+            FileLink(changeset_id=ids[cs.revision], file_id=files[path])
+            for cs in changesets for path in set(cs.files)
+        ],
+        batch_size=CHUNK_SIZE
+    )
+    # add the new changesets and their parents to the repository
+    for chunk in chunks(ids.values()):
+        repo.changesets.add(*chunk)
+    return created
+
+
+def get_or_create_changeset(repo, hgrepo, ctx):
+    '''Get or create the Changeset for a hglib changectx.
+    '''
+    ids = get_or_create_changesets(repo, hgrepo, [ctx.node()])
+    return Changeset.objects.get(id=ids[ctx.node().decode('ascii')])
 
 
 def handlePushes(repo_id, submits, do_update=False, close_connection=False):
@@ -130,19 +443,21 @@ def handlePushes(repo_id, submits, do_update=False, close_connection=False):
     repo = Repository.objects.get(id=repo_id)
     logging.info('hg clone/update start for {}'.format(repo.name))
     now = datetime.utcnow().replace(microsecond=0)
-    hgrepo = _ensure_hg_repository_sync(
-        repo, do_update=do_update
+    _ensure_hg_repository_sync(
+        repo, do_update=do_update,
+        revisions=[rev for data in submits for rev in data.changesets]
     )
     logging.info('hg clone/update took {}'.format(
         datetime.utcnow().replace(microsecond=0) - now
     ))
-    with hgrepo:
+    with hg_pool.client(repo.local_path()) as hgrepo, ingest_lock:
         return _handlePushes(
             repo, hgrepo, repo_id, submits,
             do_update=do_update, close_connection=close_connection
         )
 
 
+@metrics.timer_decorator('handle-pushes')
 def _handlePushes(
     repo, hgrepo, repo_id, submits, do_update=False, close_connection=False
 ):
@@ -157,13 +472,13 @@ def _handlePushes(
         revs += [d['node'] for d in data['entries']]
         if not revs:
             revs.append(data['node'])
-    rev_to_changeset = {}
-    for revision in revs:
-        rev_to_changeset[revision] = \
-            get_or_create_changeset(repo, hgrepo, hgrepo[revision])
+    rev_to_changeset = get_or_create_changesets(
+        repo, hgrepo, [rev.encode('ascii') for rev in revs]
+    )
     # roll the complete push into one transaction, with all the jazz
     # about changesets and files and etc.
     with transaction.atomic():
+        pushes = []
         for data in submits:
             changesets = [rev_to_changeset[rev] for rev in data.changesets]
             p, __ = Push.objects.get_or_create(
@@ -173,58 +488,211 @@ def _handlePushes(
             )
             p.changesets.set(changesets)
             p.save()
+            _set_first_push(p, changesets)
+            pushes.append(p)
         repo.save()
-    hgrepo.close()
+        transaction.on_commit(lambda: pushes_cache.bump(repo.id))
+        transaction.on_commit(lambda: pushes_ingested.send(
+            sender=Push, repository=repo, pushes=pushes
+        ))
     logging.info('handlePushes took {}'.format(
         datetime.utcnow().replace(microsecond=0) - now
     ))
     return len(submits)
 
 
+def backfill(repo, page_size=BACKFILL_PAGE_SIZE):
+    '''Import the full history of repo from its local clone and pushlog.
+
+    The changelog is imported first, in checkpointed batches by
+    import_ancestors. Then the pushlog is read page by page, and each page
+    is bulk inserted by create_pushes. The pushes in the db are the
+    checkpoint for that, an interrupted backfill resumes after the last one.
+    Yields the number of created pushes for each page.
+    '''
+    _ensure_hg_repository_sync(repo)
+    with hg_pool.client(repo.local_path()) as hgrepo:
+        heads = [
+            changeset.node.decode('ascii')
+            for changeset in hgrepo.log(revrange=b'head() - closed()')
+        ]
+        if heads:
+            with ingest_lock:
+                import_ancestors(repo, hgrepo, heads)
+        for pushes in PushJS.pages_for(
+            repo, PushJS.last_push_id(repo), size=page_size
+        ):
+            with ingest_lock:
+                created = create_pushes(repo, hgrepo, pushes)
+            yield created
+
+
+def create_pushes(repo, hgrepo, submits):
+    '''Bulk variant of _handlePushes, for backfills.
+
+    Pushes already in the db are skipped. The others are inserted with
+    their changesets, with the same data as _handlePushes creates.
+    Returns the number of created pushes.
+    '''
+    known = set(
+        repo.push_set
+        .filter(push_id__in=[data.id for data in submits])
+        .values_list('push_id', flat=True)
+    )
+    submits = [data for data in submits if data.id not in known]
+    submits_by_id = {data.id: data for data in submits}
+    revs = [rev for data in submits for rev in data.changesets]
+    rev_to_changeset = {}
+    if revs:
+        rev_to_changeset = get_or_create_changesets(
+            repo, hgrepo, [rev.encode('ascii') for rev in revs]
+        )
+    PushChangesets = Push.changesets.through
+    with transaction.atomic():
+        Push.objects.bulk_create(
+            [
+                Push(
+                    repository=repo,
+                    push_id=data.id, user=data.user,
+                    push_date=datetime.utcfromtimestamp(data.date),
+                    tip_id=max(
+                        (rev_to_changeset[rev] for rev in data.changesets),
+                        default=None
+                    )
+                )
+                for data in submits
+            ],
+            batch_size=CHUNK_SIZE
+        )
+        push_ids = dict(
+            repo.push_set
+            .filter(push_id__in=[data.id for data in submits])
+            .values_list('push_id', 'id')
+        )
+        PushChangesets.objects.bulk_create(
+            [
+                PushChangesets(
+                    push_id=push_ids[data.id],
+                    changeset_id=changeset_id
+                )
+                for data in submits
+                for changeset_id in set(
+                    rev_to_changeset[rev] for rev in data.changesets
+                )
+            ],
+            batch_size=CHUNK_SIZE
+        )
+        for push in repo.push_set.filter(id__in=push_ids.values()):
+            _set_first_push(push, [
+                rev_to_changeset[rev]
+                for rev in submits_by_id[push.push_id].changesets
+            ])
+        repo.save()
+        transaction.on_commit(lambda: pushes_cache.bump(repo.id))
+    return len(submits)
+
+
+def _set_first_push(push, changeset_ids):
+    '''Make push the first push and its repository the canonical one
+    of the given changesets, unless they got pushed earlier.
+    '''
+    (
+        ChangesetOrigin.objects
+        .filter(changeset__in=changeset_ids)
+        .filter(
+            Q(first_push__isnull=True) |
+            Q(first_push__push_date__gt=push.push_date)
+        )
+        .update(first_push=push, repository_id=push.repository_id)
+    )
+    known = set(
+        ChangesetOrigin.objects
+        .filter(changeset__in=changeset_ids)
+        .values_list('changeset', flat=True)
+    )
+    ChangesetOrigin.objects.bulk_create(
+        [
+            ChangesetOrigin(
+                changeset_id=id_, first_push=push,
+                repository_id=push.repository_id
+            )
+            for id_ in set(changeset_ids) - known
+        ],
+        batch_size=CHUNK_SIZE
+    )
+
+
 def handleRepo(repo_name, repo_url, forest, locale_code):
     """New repository created upstream in one of our forests.
     """
     if not repo_url.endswith('/'):
         repo_url += '/'
-    db_repo, created = Repository.objects.get_or_create(
-        name=repo_name,
-        url=repo_url,
-    )
-    if created:
-        logging.error(
-            f"newrepo:unexpected New repo {repo_name} already exists"
+    with ingest_lock:
+        db_repo, created = Repository.objects.get_or_create(
+            name=repo_name,
+            url=repo_url,
         )
-    locale, _ = Locale.objects.get_or_create(code=locale_code)
-    db_repo.forest = forest
-    db_repo.locale = locale
-    db_repo.save()
+        if created:
+            logging.error(
+                f"newrepo:unexpected New repo {repo_name} already exists"
+            )
+        locale, _ = Locale.objects.get_or_create(code=locale_code)
+        db_repo.forest = forest
+        db_repo.locale = locale
+        db_repo.save()
     now = datetime.utcnow().replace(microsecond=0)
-    hgrepo = _ensure_hg_repository_sync(db_repo)
+    _ensure_hg_repository_sync(db_repo)
     logging.info('hg clone/update took {}'.format(
         datetime.utcnow().replace(microsecond=0) - now
     ))
-    with hgrepo:
-        heads = hgrepo.heads()
-        if not len(heads):
+    with hg_pool.client(db_repo.local_path()) as hgrepo, ingest_lock:
+        # open heads, like hg heads shows them
+        heads = [
+            changeset.node.decode('ascii')
+            for changeset in hgrepo.log(revrange=b'head() - closed()')
+        ]
+        if not heads:
             # No commits
             return
-        for head_rev in heads:
-            get_or_create_changeset(db_repo, hgrepo, hgrepo[head_rev])
+        # forks of long histories, walk the unknown part in batches
+        import_ancestors(db_repo, hgrepo, heads)
+        db_repo.changesets.add(*changeset_ids(heads).values())
 
 
-def _ensure_hg_repository_sync(repo, do_update=False):
+def _ensure_hg_repository_sync(repo, do_update=False, revisions=None):
+    '''Make sure the local clone of repo is up to date.
+
+    If the local clone has all given revisions already, for example because
+    a fork pulled them, the pull is skipped.
+    '''
     tags = [generate_tag('repo', repo.name)]
     if repo.forest:
         tags.append(generate_tag('forest', repo.forest.name))
     repopath = repo.local_path()
+    start = time.monotonic()
+    # Failures to check or update the local clone don't mean that it's
+    # broken, fall back to a pull before removing it.
+    try:
+        local = _has_revisions(repopath, revisions)
+        if local and do_update:
+            with hg_pool.client(repopath) as hgrepo:
+                hgrepo.update()
+    except Exception as e:
+        logging.warning('Local revision check failed, {}'.format(e))
+        local = False
     try:
-        with metrics.timer('hg-pull', tags=tags):
-            return _hg_repository_sync(repopath, repo.url,
-                                       do_update=do_update)
+        if not local:
+            _hg_repository_sync(repopath, repo.url, do_update=do_update)
+        metrics.timing(
+            'hg-pull', (time.monotonic() - start) * 1000,
+            tags=tags + [generate_tag('local', 'hit' if local else 'miss')]
+        )
+        return
     except Exception as e:
         logging.error('Clone/update failed, {}'.format(e))
     # something went wrong, let's just try again
     # nuke what we had
+    hg_pool.discard(repopath)
     if os.path.exists(repopath):
         shutil.rmtree(repopath, ignore_errors=True)
         logging.error('Removed {}'.format(repopath))
@@ -255,14 +723,35 @@ def _ensure_hg_repository_sync(repo, do_update=False):
     tags.append(generate_tag('clone_type', 'full-clone'))
     logging.info('Cloning from {}'.format(str(repo.url)))
     with metrics.timer('hg-pull', tags=tags):
-        hgrepo = _hg_repository_sync(repopath, repo.url,
-                                     do_update=do_update)
-    for other in other_repos:
-        tags[0] = generate_tag('repo', other.name)
-        logging.info('Pulling from {}'.format(str(other.url)))
-        with metrics.timer('hg-pull', tags=tags):
-            hgrepo.pull(source=str(other.url))
-    return hgrepo
+        _hg_repository_sync(repopath, repo.url, do_update=do_update)
+    with hg_pool.client(repopath) as hgrepo:
+        for other in other_repos:
+            tags[0] = generate_tag('repo', other.name)
+            logging.info('Pulling from {}'.format(str(other.url)))
+            with metrics.timer('hg-pull', tags=tags):
+                hgrepo.pull(source=pull_url(other.url))
+
+
+def _has_revisions(repopath, revisions):
+    '''Check if the local clone at repopath has all revisions,
+    with one hg log per chunk of revisions.
+    '''
+    if not revisions or not os.path.isfile(
+        os.path.join(repopath, '.hg', 'hgrc')
+    ):
+        return False
+    wanted = set(revisions)
+    with hg_pool.client(repopath) as hgrepo:
+        for chunk in chunks(sorted(wanted)):
+            revset = ' + '.join('present({})'.format(rev) for rev in chunk)
+            try:
+                found = hgrepo.log(revrange=revset.encode('ascii'))
+            except hglib.error.CommandError:
+                return False
+            wanted.difference_update(
+                changeset.node.decode('ascii') for changeset in found
+            )
+    return not wanted
 
 
 def _hg_repository_sync(repopath, url, do_update=False):
@@ -270,14 +759,12 @@ def _hg_repository_sync(repopath, url, do_update=False):
     if not os.path.isfile(configpath):
         if not os.path.isdir(os.path.dirname(repopath)):
             os.makedirs(os.path.dirname(repopath))
-        hgrepo = hglib.clone(source=str(url), dest=str(repopath))
+        hglib.clone(source=pull_url(url), dest=str(repopath))
         cfg = open(configpath, 'a')
         cfg.write('default-push = ssh%s\n' % str(url)[4:])
         cfg.close()
-        hgrepo.open()
     else:
-        hgrepo = hglib.open(repopath)
-        hgrepo.pull(source=hglib.util.b(url))
-        if do_update:
-            hgrepo.update()
-    return hgrepo
+        with hg_pool.client(repopath) as hgrepo:
+            hgrepo.pull(source=hglib.util.b(pull_url(url)))
+            if do_update:
+                hgrepo.update()
@@ -11,15 +11,20 @@ from __future__ import absolute_import
 from __future__ import unicode_literals
 
 from collections import OrderedDict
-from difflib import SequenceMatcher
+import pickle
+import zlib
 
+from django.core.cache import cache
 from django.shortcuts import render
 from django import http
 from django.views.generic.base import View
 
 from life.models import Repository, Changeset
+from pushes.entities import entity_cache
+from pushes.hgpool import hg_pool
+from pushes.stringdiff import diff_strings
 
-import hglib
+from hglib.util import cmdbuilder
 import markus
 
 from compare_locales.parser import getParser, FluentEntity
@@ -28,8 +33,28 @@ from compare_locales.compare.utils import AddRemove, Tree as DataTree
 
 metrics = markus.get_metrics(__name__)
 
+# django cache key for the diff tree between two resolved revisions.
+# Those never change, so entries live until the cache evicts them.
+# Bump the version when changing the format of the cached data.
+DIFF_CACHE_KEY = 'pushes.diff.2.{}.{}.{}'
+# Cached diff trees are compressed and split into chunks of this many
+# bytes, memcached drops values over 1MB.
+DIFF_CACHE_CHUNK_SIZE = 1000 * 1000
+# diff trees compressing to more than this many bytes aren't cached
+DIFF_CACHE_MAX_SIZE = 32 * 1000 * 1000
+# number of files to get per hg cat
+CAT_CHUNK_SIZE = 1000
+# hg cat template for the contents of multiple files,
+# path NUL size NUL data
+CAT_TEMPLATE = b'{path}\\0{data|count}\\0{data}'
 
-class BadRevision(Exception):
+
+class BadRequest(Exception):
+    "Missing or bad request parameter"
+    pass
+
+
+class BadRevision(BadRequest):
     "Revision could not be resolved"
     pass
 
@@ -44,7 +69,7 @@ class constdict(dict):
 class DiffView(View):
     # empty class default for tests
     # overwrite with mutable instance members if you need non-empty values
-    moved = copied = constdict()
+    moved = copied = contents = constdict()
     client = rev1 = rev2 = None
 
     def _universal_newlines(self, content):
@@ -54,70 +79,178 @@ class DiffView(View):
     @metrics.timer_decorator('diff.response')
     def get(self, request):
         '''Handle GET requests'''
+        try:
+            diffs = self.get_diffs(request)
+        except BadRequest as e:
+            return http.HttpResponseBadRequest(e.args[0])
+        return render(request, 'pushes/diff.html', {
+                        'given_title': request.GET.get('title', None),
+                        'repo': request.GET['repo'],
+                        'repo_url': self.repo.url,
+                        'old_rev': request.GET['from'],
+                        'new_rev': request.GET['to'],
+                        'diffs': diffs
+                      })
+
+    def get_diffs(self, request):
+        '''Validate the request and return the diff tree data for it.
+
+        Raises BadRequest for missing or bad parameters.
+        '''
         # The code validates the input, opens up an hglib client in a
         # context, and then goes through .status() and .cat() to
         # create a diff.
         if not request.GET.get('repo'):
-            return http.HttpResponseBadRequest("Missing 'repo' parameter")
-        reponame = request.GET['repo']
+            raise BadRequest("Missing 'repo' parameter")
         try:
-            self.getrepo(reponame)
+            self.getrepo(request.GET['repo'])
         except Repository.DoesNotExist:
             raise http.Http404("Repository not found")
-        # make sure we have the client open, and close it when done.
-        with self.client:
+        # make sure we return the client to the pool when done,
+        # or close it if it failed in an unknown state.
+        try:
             if not request.GET.get('from'):
-                return http.HttpResponseBadRequest("Missing 'from' parameter")
+                raise BadRequest("Missing 'from' parameter")
             if not request.GET.get('to'):
-                return http.HttpResponseBadRequest("Missing 'to' parameter")
+                raise BadRequest("Missing 'to' parameter")
+            self.resolve_revs(request.GET['from'], request.GET['to'])
+            diffs = self.cached_diffs()
+        except BadRequest:
+            hg_pool.release(self.client)
+            raise
+        except BaseException:
+            hg_pool.close(self.client)
+            raise
+        hg_pool.release(self.client)
+        return diffs
+
+    def cached_diffs(self):
+        '''The diff tree data between rev1 and rev2, from the cache
+        if possible.
+        '''
+        cache_key = DIFF_CACHE_KEY.format(
+            self.repo.id,
+            self.rev1.decode('ascii'),
+            self.rev2.decode('ascii')
+        )
+        diffs = get_cached(cache_key)
+        if diffs is None:
+            metrics.incr('diff.cache.miss')
+            diffs = self.tree_data(self.diff_tree(self.status()))
+            set_cached(cache_key, diffs)
+        else:
+            metrics.incr('diff.cache.hit')
+        return diffs
+
+    def diff_tree(self, paths):
+        '''Create the tree of diffs for the given paths and actions.
+
+        Unparsable files link to the revision they're in, as resolved
+        node, as the tree is cached for the resolved revisions.
+        '''
+        diffs = DataTree(dict)
+        for (path, action), lines in zip(paths, self.diff_files(paths)):
+            v = {'path': path,
+                 'renamed': self.moved.get(path),
+                 'copied': self.copied.get(path)}
+            if lines is None:
+                v.update({
+                    'isFile': True,
+                    'class': action,
+                    'rev': ((action == 'removed') and self.rev1
+                            or self.rev2).decode('ascii')
+                })
+            else:
+                container_class = lines and 'file' or 'empty-diff'
+                v.update({
+                    'class': container_class,
+                    'lines': lines
+                })
+            diffs[path].update(v)
+        return diffs
+
+    def diff_files(self, paths):
+        '''Return the diffLines for the given paths and actions, in order.
+
+        The contents of all files are fetched up front, parsing and
+        diffing is CPU-bound and done one file after the other.
+        '''
+        self.contents = self.fetch_contents(paths)
+        return [self.diffLines(path, action) for path, action in paths]
+
+    @metrics.timer_decorator('diff.contents')
+    def fetch_contents(self, paths):
+        '''Get the contents of the files in paths that we can diff,
+        as dict of (path, rev) to content.
+
+        The files are read with one hg cat per revision.
+        '''
+        wanted = {}
+        for path, action in paths:
             try:
-                paths = self.paths4revs(request.GET['from'],
-                                        request.GET['to'])
-            except BadRevision as e:
-                return http.HttpResponseBadRequest(e.args[0])
-            diffs = DataTree(dict)
-            for path, action in paths:
-                lines = self.diffLines(path, action)
-                v = {'path': path,
-                     'renamed': self.moved.get(path),
-                     'copied': self.copied.get(path)}
-                if lines is None:
-                    v.update({
-                        'isFile': True,
-                        'class': action,
-                        'rev': ((action == 'removed') and request.GET['from']
-                                or request.GET['to'])
-                    })
-                else:
-                    container_class = lines and 'file' or 'empty-diff'
-                    v.update({
-                        'class': container_class,
-                        'lines': lines
-                    })
-                diffs[path].update(v)
-        diffs = self.tree_data(diffs)
-        return render(request, 'pushes/diff.html', {
-                        'given_title': request.GET.get('title', None),
-                        'repo': reponame,
-                        'repo_url': self.repo.url,
-                        'old_rev': request.GET['from'],
-                        'new_rev': request.GET['to'],
-                        'diffs': diffs
-                      })
+                getParser(path)
+            except UserWarning:
+                continue
+            if action != 'added':
+                wanted.setdefault(self.rev1, set()).add(
+                    self.old_path(path, action)
+                )
+            if action != 'removed':
+                wanted.setdefault(self.rev2, set()).add(path)
+        contents = {}
+        for rev, files in wanted.items():
+            files = sorted(files)
+            for i in range(0, len(files), CAT_CHUNK_SIZE):
+                for path, content in self.cat(
+                    files[i:i + CAT_CHUNK_SIZE], rev
+                ):
+                    contents[(path, rev)] = content
+        metrics.histogram(
+            'diff.contents.bytes',
+            sum(len(content) for content in contents.values())
+        )
+        return contents
+
+    def cat(self, files, rev):
+        '''Yield path and content of the given files in rev,
+        with a single hg cat.
+        '''
+        args = cmdbuilder(
+            b'cat',
+            *[b'path:' + path.encode('latin-1') for path in files],
+            r=rev, T=CAT_TEMPLATE, hidden=self.client.hidden
+        )
+        out = self.client.rawcommand(args)
+        pos = 0
+        while pos < len(out):
+            path_end = out.index(b'\0', pos)
+            size_end = out.index(b'\0', path_end + 1)
+            size = int(out[path_end + 1:size_end])
+            yield (
+                out[pos:path_end].decode('latin-1'),
+                out[size_end + 1:size_end + 1 + size]
+            )
+            pos = size_end + 1 + size
 
     @metrics.timer_decorator('diff.getrepo')
     def getrepo(self, reponame):
         '''Set elmo db object and hglib client for given repo name'''
         self.repo = Repository.objects.get(name=reponame)
         if self.client:
-            self.client.close()
-        self.client = hglib.open(self.repo.local_path())
+            hg_pool.release(self.client)
+        self.client = hg_pool.acquire(self.repo.local_path())
 
-    @metrics.timer_decorator('diff.status')
     def paths4revs(self, _from, _to):
         '''Validate that the passed in revisions are valid, and computes
         the affected paths and their status.
         '''
+        self.resolve_revs(_from, _to)
+        return self.status()
+
+    def resolve_revs(self, _from, _to):
+        '''Validate that the passed in revisions are valid, and set
+        rev1 and rev2 to their nodes.
+        '''
         try:
             self.rev1 = self.real_rev(_from)
         except (KeyError, UnicodeEncodeError):
@@ -126,6 +259,12 @@ class DiffView(View):
             self.rev2 = self.real_rev(_to)
         except (KeyError, UnicodeEncodeError):
             raise BadRevision("Unrecognized 'to' parameter")
+
+    @metrics.timer_decorator('diff.status')
+    def status(self):
+        '''Compute the affected paths between rev1 and rev2,
+        and their status.
+        '''
         changed = []
         added = []
         removed = []
@@ -201,14 +340,16 @@ class DiffView(View):
             p = getParser(path)
         except UserWarning:
             return None
+        # getParser hands out shared instances, which keep the parsed
+        # content. Get our own, views run on several threads.
+        p = p.__class__()
         old_translations = OrderedDict()
         if action != 'added':
-            realpath = (action == 'moved' and self.moved[path] or
-                        action == 'copied' and self.copied[path] or
-                        path)
-            content = self.content(realpath, self.rev1)
+            content = self.content(self.old_path(path, action), self.rev1)
             try:
-                old_translations.update(self.parse(p, content))
+                old_translations.update(
+                    entity_cache.get(p, content, self.parse)
+                )
             except Exception:
                 # consider doing something like:
                 # logging.warn('Unable to parse %s', path, exc_info=True)
@@ -218,7 +359,9 @@ class DiffView(View):
         if action != 'removed':
             content = self.content(path, self.rev2)
             try:
-                new_translations.update(self.parse(p, content))
+                new_translations.update(
+                    entity_cache.get(p, content, self.parse)
+                )
             except Exception:
                 # consider doing something like:
                 # logging.warn('Unable to parse %s', path, exc_info=True)
@@ -267,8 +410,22 @@ class DiffView(View):
 
         return lines
 
+    def old_path(self, path, action):
+        '''The path of the file in rev1.'''
+        return (action == 'moved' and self.moved[path] or
+                action == 'copied' and self.copied[path] or
+                path)
+
     def content(self, path, rev):
-        content = self.client.cat([self.client.pathto(path)], rev=rev)
+        '''Content of path in rev, usually prefetched by fetch_contents.
+
+        Other files are read with self.client.
+        '''
+        if (path, rev) in self.contents:
+            content = self.contents[(path, rev)]
+        else:
+            metrics.incr('diff.contents.miss')
+            content = self.client.cat([self.client.pathto(path)], rev=rev)
         content = self._universal_newlines(content)
         return content
 
@@ -286,15 +443,7 @@ class DiffView(View):
                         fluent_attr.val)
 
     def diff_strings(self, oldval, newval):
-        sm = SequenceMatcher(None, oldval, newval)
-        oldhtml = []
-        newhtml = []
-        for op, o1, o2, n1, n2 in sm.get_opcodes():
-            if o1 != o2:
-                oldhtml.append({'class': op, 'value': oldval[o1:o2]})
-            if n1 != n2:
-                newhtml.append({'class': op, 'value': newval[n1:n2]})
-        return oldhtml, newhtml
+        return diff_strings(oldval, newval)
 
     def tree_data(self, tree):
         nodes = []
@@ -309,3 +458,133 @@ class DiffView(View):
             else:
                 nodes.append((path, {'children': self.tree_data(subtree)}))
         return nodes
+
+
+class DiffJSONView(DiffView):
+    '''The diff tree as JSON, one level at a time.
+
+    Without a path parameter, returns the top-level entries of the tree.
+    With the path of a directory, returns the entries in that directory.
+    Entries for files don't include the entity diffs, request the path
+    of the file to get those.
+    '''
+    @metrics.timer_decorator('diff.json')
+    def get(self, request):
+        '''Handle GET requests'''
+        try:
+            diffs = self.get_diffs(request)
+        except BadRequest as e:
+            return http.HttpResponseBadRequest(e.args[0])
+        path = request.GET.get('path', '').strip('/')
+        node = self.find_node(diffs, path)
+        if node is None:
+            raise http.Http404("Path not found")
+        if isinstance(node, dict) and 'value' in node:
+            return http.JsonResponse({'path': path, 'file': node['value']})
+        if isinstance(node, dict):
+            node = node['children']
+        return http.JsonResponse({
+            'path': path,
+            'entries': [
+                self.entry(path and path + '/' + name or name, name, child)
+                for name, child in node
+            ]
+        })
+
+    def find_node(self, nodes, path):
+        '''Find the node for path in tree data nodes.
+
+        Returns the list of nodes for the empty path,
+        and None if there's no node for path.
+        '''
+        if not path:
+            return nodes
+        for name, node in nodes:
+            if path == name:
+                return node
+            if path.startswith(name + '/') and 'value' not in node:
+                return self.find_node(
+                    node['children'], path[len(name) + 1:]
+                )
+        return None
+
+    def entry(self, path, name, node):
+        '''Summary of a node in the tree data.
+
+        name is the path relative to the parent node, which can span
+        multiple directories.
+        '''
+        if 'value' not in node:
+            return {'path': path, 'name': name, 'type': 'directory'}
+        entry = {
+            key: value
+            for key, value in node['value'].items()
+            if key != 'lines'
+        }
+        entry.update({
+            'name': name,
+            'type': 'file',
+            'entities': len(node['value'].get('lines') or []),
+        })
+        return entry
+
+
+def get_cached(cache_key):
+    '''Read a value stored by set_cached.
+
+    Returns None if it's not in the cache, or if any of its chunks
+    got evicted.
+    '''
+    header = cache.get(cache_key)
+    if header is None:
+        return None
+    count, size = header
+    keys = ['{}.{}'.format(cache_key, i) for i in range(count)]
+    chunks = cache.get_many(keys)
+    data = b''.join(chunks.get(key, b'') for key in keys)
+    if len(data) != size:
+        metrics.incr('diff.cache.incomplete')
+        return None
+    return pickle.loads(zlib.decompress(data))
+
+
+def set_cached(cache_key, value):
+    '''Store value compressed and in chunks of DIFF_CACHE_CHUNK_SIZE,
+    unless it's bigger than DIFF_CACHE_MAX_SIZE.
+
+    Returns if the value got stored.
+    '''
+    data = zlib.compress(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+    metrics.histogram('diff.cache.bytes', len(data))
+    if len(data) > DIFF_CACHE_MAX_SIZE:
+        metrics.incr('diff.cache.too_big')
+        return False
+    chunks = OrderedDict(
+        ('{}.{}'.format(cache_key, i), data[pos:pos + DIFF_CACHE_CHUNK_SIZE])
+        for i, pos in enumerate(range(0, len(data), DIFF_CACHE_CHUNK_SIZE))
+    )
+    if cache.set_many(chunks, None):
+        # the backend reported keys it failed to store
+        metrics.incr('diff.cache.set_failed')
+        return False
+    # the header goes last, readers only look for chunks after it
+    cache.set(cache_key, (len(chunks), len(data)), None)
+    return True
+
+
+def warm(repo_name, _from, _to):
+    '''Compute and cache the diff between two revisions in a repository,
+    if it's not cached yet.
+    '''
+    view = DiffView()
+    view.getrepo(repo_name)
+    try:
+        view.resolve_revs(_from, _to)
+        view.cached_diffs()
+    except BadRequest:
+        hg_pool.release(view.client)
+        raise
+    except BaseException:
+        hg_pool.close(view.client)
+        raise
+    hg_pool.release(view.client)
@@ -7,17 +7,32 @@
 from __future__ import absolute_import
 from __future__ import unicode_literals
 
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+import binascii
+from calendar import timegm
 from datetime import datetime
+import hashlib
+import json
 import operator
 from time import mktime
 
+from django.core.cache import cache
+from django.http import StreamingHttpResponse
 from django.shortcuts import render
 from django.db.models import Q, Count
 
-from life.models import Push, File
+from life.models import Push, Repository
+from mbdb.files import matching_files
+from pushes import cache as pushes_cache
 from functools import reduce
 
 
+# number of pushes read at a time by pushlog_json
+JSON_BATCH_SIZE = 100
+# seconds to cache pushlog data, it's invalidated by new pushes, too
+PUSHLOG_CACHE_TIMEOUT = 60 * 60
+
+
 def pushlog(request, repo_name):
     '''View to show pushes and their changesets for:
     - all repositories starting with repo_name
@@ -26,66 +41,42 @@ def pushlog(request, repo_name):
     If file `path` parts are passed in, only show the changesets that
     affect the requested files.
     '''
-    try:
-        limit = int(request.GET['length'])
-    except (ValueError, KeyError):
-        limit = None
-    startTime = endTime = None
-    try:
-        startTime = datetime.utcfromtimestamp(float(request.GET['from']))
-    except (ValueError, KeyError):
-        if limit is None:
-            limit = 50
-    try:
-        endTime = datetime.utcfromtimestamp(float(request.GET['until']))
-    except (ValueError, KeyError):
-        pass
-    try:
-        start = int(request.GET['start'])
-    except (ValueError, KeyError):
+    cache_key = _cache_key(request, repo_name)
+    context = cache.get(cache_key)
+    if context is None:
+        context = _pushlog_context(request, repo_name)
+        cache.set(cache_key, context, PUSHLOG_CACHE_TIMEOUT)
+    return render(request, 'pushes/pushlog.html', context)
+
+
+def _pushlog_context(request, repo_name):
+    pushes, files, search, limit, start, cursor = _filter_pushes(
+        request, repo_name
+    )
+    if cursor is not None:
         start = 0
-    excludes = request.GET.getlist('exclude')
-    paths = [_p for _p in request.GET.getlist('path') if _p is not None]
-    repo_parts = [_r for _r in request.GET.getlist('repo') if _r is not None]
-    search = {}
-    q = Push.objects
-    if startTime is not None:
-        q = q.filter(push_date__gte=startTime)
-        search['from'] = startTime
-    if endTime is not None:
-        q = q.filter(push_date__lte=endTime)
-        search['until'] = endTime
-    if repo_name is not None:
-        q = q.filter(repository__name__startswith=repo_name)
-    elif repo_parts:
-        repo_parts = [Q(repository__name__contains=s) for s in repo_parts]
-        if len(repo_parts) == 1:
-            q = q.filter(repo_parts[0])
-        else:
-            q = q.filter(reduce(operator.or_, repo_parts))
-        search['repo'] = repo_parts
-    if excludes:
-        q = q.exclude(repository__name__in=excludes)
-    files = None
-    if paths:
-        pathquery = File.objects
-        for p in paths:
-            pathquery = pathquery.filter(path__contains=p)
-        files = list(pathquery.values_list('id', flat=True))
-        q = q.filter(changesets__files__in=files)
-    if paths:
-        search['path'] = paths
-    pushes = q.distinct().order_by('-push_date')[start:]
+        pushes = _seek(pushes, cursor)
+    elif start:
+        # offset pagination, scans all earlier pushes
+        pushes = pushes[start:]
     if limit is not None:
         pushes = pushes[:(start + limit)]
     # get all push IDs
     # the get the changesets for them
-    push_ids = list(pushes.values_list('id', flat=True))
+    push_rows = list(pushes.values_list('push_date', 'id'))
+    push_ids = [push_id for _, push_id in push_rows]
+    next_page = None
+    if limit is not None and push_rows and len(push_rows) >= limit:
+        query = request.GET.copy()
+        query.pop('start', None)
+        query['cursor'] = _encode_cursor(*push_rows[-1])
+        next_page = query.urlencode()
     push_changesets = (Push.changesets.through.objects
                        .filter(push__in=push_ids)
-                       .order_by('-push__push_date', '-changeset__id'))
+                       .order_by('-push__push_date', '-push__id',
+                                 '-changeset__id'))
     pushcounts = {}
-    if files:
+    if files is not None:
         # we're only interested in the changesets that actually contain
         # our paths, reduce our query, and store how many changesets
         # there are per push without the filter
@@ -96,35 +87,277 @@ def pushlog(request, repo_name):
                           .filter(id__in=push_ids)
                           .annotate(changecount=Count('changesets'))
                           .values_list('id', 'changecount'))
-    # get all pushes, with their changesets, possibly filtered
+    # get all pushes, with their changesets, possibly filtered.
+    # The context is cached, only use plain values.
     pushrows = []
-    push = None
+    push_id = None
     odd = 0
-    for pc in push_changesets.select_related('push__repository', 'changeset'):
-        if pc.push != push:
+    for row in push_changesets.values(
+        'push_id', 'push__push_id', 'push__user', 'push__push_date',
+        'push__repository__name', 'push__repository__url',
+        'changeset__revision', 'changeset__user', 'changeset__description'
+    ):
+        changeset = {
+            'revision': row['changeset__revision'],
+            'shortrev': row['changeset__revision'][:12],
+            'user': row['changeset__user'],
+            'description': row['changeset__description'],
+        }
+        if row['push_id'] != push_id:
             if pushrows:
                 pushrows[-1]['span'] = len(pushrows[-1]['changesets']) + 1
-            push = pc.push
+            push_id = row['push_id']
             odd = 1 - odd
             pushrows.append({
-                'push': push,
-                'tip': pc.changeset,
+                'push': {
+                    'id': push_id,
+                    'push_id': row['push__push_id'],
+                    'user': row['push__user'],
+                    'push_date': row['push__push_date'],
+                    'repository': {
+                        'name': row['push__repository__name'],
+                        'url': row['push__repository__url'],
+                    },
+                },
+                'tip': changeset,
                 'changesets': [],
                 'class': 'parity%d' % odd,
-                'change_count': pushcounts.get(push.id)
+                'change_count': pushcounts.get(push_id)
                 })
         else:
-            pushrows[-1]['changesets'].append(pc.changeset)
+            pushrows[-1]['changesets'].append(changeset)
     if pushrows:
         # we have the last iteration to add still
         pushrows[-1]['span'] = len(pushrows[-1]['changesets']) + 1
-        timespan = (int(mktime(pushrows[-1]['push'].push_date.timetuple())),
-                    int(mktime(pushrows[0]['push'].push_date.timetuple())))
+        timespan = (
+            int(mktime(pushrows[-1]['push']['push_date'].timetuple())),
+            int(mktime(pushrows[0]['push']['push_date'].timetuple()))
+        )
     else:
         timespan = None
-    return render(request, 'pushes/pushlog.html', {
-                    'pushes': pushrows,
-                    'limit': limit,
-                    'search': search,
-                    'timespan': timespan,
-                  })
+    return {
+        'pushes': pushrows,
+        'limit': limit,
+        'search': search,
+        'timespan': timespan,
+        'next_page': next_page,
+    }
+
+
+def pushlog_json(request, repo_name):
+    '''Stream pushes and their changesets as JSON.
+
+    Takes the same query parameters as pushlog, and returns
+    {"pushes": [...], "next": cursor}, with the cursor for the next page
+    if there might be one, or null.
+    Pushes are read in batches, to keep memory constant for long pushlogs.
+    '''
+    pushes, files, _, limit, start, cursor = _filter_pushes(
+        request, repo_name
+    )
+    if cursor is None and start:
+        # offset pagination, find the push to seek past
+        cursor = pushes.values_list('push_date', 'id')[start - 1:start]
+        if cursor:
+            cursor = cursor[0]
+        else:
+            cursor, limit = None, 0
+    return StreamingHttpResponse(
+        _stream_pushes(pushes, files, limit, cursor),
+        content_type='application/json'
+    )
+
+
+def _stream_pushes(pushes, files, limit, cursor):
+    remaining = limit
+    sep = ''
+    yield '{"pushes": ['
+    while remaining is None or remaining > 0:
+        size = JSON_BATCH_SIZE
+        if remaining is not None:
+            size = min(size, remaining)
+        batch = pushes if cursor is None else _seek(pushes, cursor)
+        push_rows = list(batch.values_list('push_date', 'id')[:size])
+        if push_rows:
+            cursor = push_rows[-1]
+        if remaining is not None:
+            remaining -= len(push_rows)
+        for push in _push_dicts([push_id for _, push_id in push_rows], files):
+            yield sep + json.dumps(push)
+            sep = ', '
+        if len(push_rows) < size:
+            # no more pushes
+            cursor = None
+            break
+    next_page = None
+    if limit is not None and cursor is not None:
+        next_page = _encode_cursor(*cursor)
+    yield '], "next": {}}}'.format(json.dumps(next_page))
+
+
+def _push_dicts(push_ids, files):
+    '''Yield the given pushes with their changesets as dicts,
+    as they come in from the database.
+    '''
+    push_changesets = (
+        Push.changesets.through.objects
+        .filter(push__in=push_ids)
+        .order_by('-push__push_date', '-push__id', '-changeset__id')
+    )
+    if files is not None:
+        push_changesets = (
+            push_changesets.filter(changeset__files__in=files).distinct()
+        )
+    push = None
+    for row in push_changesets.values(
+        'push_id', 'push__push_id', 'push__repository__name', 'push__user',
+        'push__push_date', 'changeset__revision', 'changeset__user',
+        'changeset__description'
+    ).iterator():
+        if push is None or push['id'] != row['push_id']:
+            if push is not None:
+                yield push
+            push = {
+                'id': row['push_id'],
+                'push_id': row['push__push_id'],
+                'repository': row['push__repository__name'],
+                'user': row['push__user'],
+                'date': timegm(row['push__push_date'].utctimetuple()),
+                'changesets': [],
+            }
+        push['changesets'].append({
+            'revision': row['changeset__revision'],
+            'user': row['changeset__user'],
+            'description': row['changeset__description'],
+        })
+    if push is not None:
+        yield push
+
+
+def _filter_pushes(request, repo_name):
+    '''Parse the query of a pushlog request.
+
+    Returns the filtered and sorted pushes, the query for the matching
+    files or None, the search parameters for the template, the limit,
+    the start offset and the cursor.
+    '''
+    try:
+        limit = int(request.GET['length'])
+    except (ValueError, KeyError):
+        limit = None
+    startTime = endTime = None
+    try:
+        startTime = datetime.utcfromtimestamp(float(request.GET['from']))
+    except (ValueError, KeyError):
+        if limit is None:
+            limit = 50
+    try:
+        endTime = datetime.utcfromtimestamp(float(request.GET['until']))
+    except (ValueError, KeyError):
+        pass
+    cursor = _decode_cursor(request.GET.get('cursor'))
+    try:
+        start = int(request.GET['start'])
+    except (ValueError, KeyError):
+        start = 0
+    paths = [_p for _p in request.GET.getlist('path') if _p is not None]
+    search = {}
+    q = Push.objects
+    if startTime is not None:
+        q = q.filter(push_date__gte=startTime)
+        search['from'] = startTime
+    if endTime is not None:
+        q = q.filter(push_date__lte=endTime)
+        search['until'] = endTime
+    repos = _filter_repositories(request, repo_name)
+    if repos is not None:
+        q = q.filter(repository__in=repos)
+    if repo_name is None and request.GET.getlist('repo'):
+        search['repo'] = request.GET.getlist('repo')
+    files = None
+    if paths:
+        # subquery, joined by the database
+        files = matching_files(paths)
+        q = q.filter(changesets__files__in=files)
+    if paths:
+        search['path'] = paths
+    pushes = q.distinct().order_by('-push_date', '-id')
+    return pushes, files, search, limit, start, cursor
+
+
+def _filter_repositories(request, repo_name):
+    '''Return the repositories a pushlog request is for,
+    or None for all repositories.
+    '''
+    excludes = request.GET.getlist('exclude')
+    repo_parts = [_r for _r in request.GET.getlist('repo') if _r is not None]
+    repos = None
+    if repo_name is not None:
+        repos = Repository.objects.filter(name__startswith=repo_name)
+    elif repo_parts:
+        repos = Repository.objects.filter(reduce(
+            operator.or_, (Q(name__contains=s) for s in repo_parts)
+        ))
+    if excludes:
+        if repos is None:
+            repos = Repository.objects.all()
+        repos = repos.exclude(name__in=excludes)
+    return repos
+
+
+def _cache_key(request, repo_name):
+    '''Cache key for the pushlog request, from the normalized query and
+    the generations of the requested repositories.
+    '''
+    repos = _filter_repositories(request, repo_name)
+    if repos is None:
+        repo_ids = [pushes_cache.ALL]
+    else:
+        repo_ids = list(repos.values_list('id', flat=True))
+    key = json.dumps([
+        repo_name,
+        sorted(
+            (param, sorted(values)) for param, values in request.GET.lists()
+        ),
+        sorted(pushes_cache.generations(repo_ids).items(), key=str),
+    ])
+    return 'pushes.pushlog.1.' + hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def _seek(pushes, cursor):
+    '''Keyset pagination, filter pushes to those after cursor.
+    '''
+    push_date, push_id = cursor
+    return pushes.filter(
+        Q(push_date__lt=push_date) |
+        Q(push_date=push_date, id__lt=push_id)
+    )
+
+
+def _encode_cursor(push_date, push_id):
+    '''Opaque token for the position after the given push.
+    '''
+    token = '{}|{}'.format(push_date.isoformat(), push_id)
+    return urlsafe_b64encode(token.encode('ascii')).decode('ascii')
+
+
+def _decode_cursor(token):
+    '''Return the push_date and id from a cursor token, or None.
+    '''
+    if not token:
+        return None
+    try:
+        push_date, push_id = (
+            urlsafe_b64decode(token.encode('ascii')).decode('ascii')
+            .split('|')
+        )
+        return (
+            datetime.strptime(
+                push_date,
+                '%Y-%m-%dT%H:%M:%S.%f' if '.' in push_date
+                else '%Y-%m-%dT%H:%M:%S'
+            ),
+            int(push_id)
+        )
+    except (ValueError, UnicodeError, binascii.Error):
+        return None
@@ -0,0 +1,19 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+from django.apps import AppConfig
+
+
+class ShippingConfig(AppConfig):
+    """Warm up sign-off diffs for new pushes"""
+    name = 'shipping'
+
+    def ready(self):
+        from pushes.signals import pushes_ingested
+        from .warmup import queue_signoff_diffs
+        pushes_ingested.connect(
+            queue_signoff_diffs, dispatch_uid='shipping.warmup'
+        )
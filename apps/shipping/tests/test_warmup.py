@@ -0,0 +1,138 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import datetime
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.test import override_settings
+
+from elmo.test import TestCase
+from life.models import (
+    Branch, Changeset, Forest, Locale, Push, Repository, Tree
+)
+from pushes.signals import pushes_ingested
+from shipping import warmup
+from shipping.models import (
+    Action, AppVersion, AppVersionTreeThrough, Application, Signoff
+)
+
+
+class WarmupTest(TestCase):
+    fixtures = ['test_repos.json']
+
+    def setUp(self):
+        forest = Forest.objects.get(name='l10n')
+        tree = Tree.objects.create(code='fx', l10n=forest)
+        app = Application.objects.create(name='Firefox', code='fx')
+        self.av = AppVersion.objects.create(
+            app=app,
+            version='1.0',
+            code='fx1.0',
+            accepts_signoffs=True,
+        )
+        AppVersionTreeThrough.objects.create(
+            start=None,
+            tree=tree,
+            appversion=self.av,
+            end=None,
+        )
+        self.locale = Locale.objects.get(code='de')
+        self.repo, = Repository.objects.filter(locale=self.locale)
+        first_date = datetime.datetime.utcnow() - datetime.timedelta(days=12)
+        branch, = Branch.objects.all()
+        self.pushes = []
+        for i in range(1, 4):
+            push = Push.objects.create(
+                user='Bob',
+                repository=self.repo,
+                push_date=first_date + datetime.timedelta(days=i),
+                push_id=i + 1
+            )
+            push.changesets.add(Changeset.objects.create(
+                revision='abc123-%d' % i,
+                branch=branch
+            ))
+            self.pushes.append(push)
+
+    def accept(self, push):
+        user = User.objects.create_user('peter')
+        signoff = Signoff.objects.create(
+            push=push,
+            appversion=self.av,
+            author=user,
+            locale=self.locale,
+        )
+        Action.objects.create(
+            signoff=signoff,
+            flag=Action.ACCEPTED,
+            author=user,
+        )
+
+    def test_signoff_diffs(self):
+        # nothing accepted, nothing to diff against
+        self.assertListEqual(warmup.signoff_diffs(self.repo), [])
+        self.accept(self.pushes[0])
+        self.assertListEqual(
+            warmup.signoff_diffs(self.repo),
+            [('abc123-1', 'abc123-3')]
+        )
+        # closed appversions don't get diffs
+        self.av.accepts_signoffs = False
+        self.av.save()
+        self.assertListEqual(warmup.signoff_diffs(self.repo), [])
+
+    def test_signoff_diffs_latest_accepted(self):
+        self.accept(self.pushes[2])
+        self.assertListEqual(warmup.signoff_diffs(self.repo), [])
+
+    def test_warm_signoff_diffs(self):
+        self.accept(self.pushes[1])
+        with mock.patch.object(warmup.diff, 'warm') as warm:
+            warmup.warm_signoff_diffs(self.repo.id)
+        warm.assert_called_once_with(self.repo.name, 'abc123-2', 'abc123-3')
+
+    def test_signoff_diffs_other_repo(self):
+        # accepted on a push to another repository of the locale,
+        # like the sign-off view, diff against it in our repository
+        forest = Forest.objects.create(name='l10n-old', url='http://hg/old/')
+        old_repo = Repository.objects.create(
+            name='l10n-old/de',
+            url='http://hg/old/de/',
+            forest=forest,
+            locale=self.locale,
+        )
+        push = Push.objects.create(
+            user='Bob',
+            repository=old_repo,
+            push_date=self.pushes[0].push_date,
+            push_id=1
+        )
+        push.changesets.add(Changeset.objects.create(
+            revision='def456',
+            branch=Branch.objects.get(id=1)
+        ))
+        self.accept(push)
+        self.assertListEqual(
+            warmup.signoff_diffs(self.repo),
+            [('def456', 'abc123-3')]
+        )
+
+    def test_queue(self):
+        with mock.patch.object(warmup, '_executor', None), \
+                mock.patch.object(warmup, 'ThreadPoolExecutor') as executor:
+            # disabled by default
+            pushes_ingested.send(
+                sender=Push, repository=self.repo, pushes=self.pushes
+            )
+            executor.assert_not_called()
+            with override_settings(DIFF_WARMUP_WORKERS=2):
+                pushes_ingested.send(
+                    sender=Push, repository=self.repo, pushes=self.pushes
+                )
+            executor.return_value.submit.assert_called_once_with(
+                warmup._run, self.repo.id
+            )
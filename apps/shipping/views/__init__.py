@@ -15,12 +15,11 @@ from six.moves import zip
 from django.shortcuts import render
 from django.views.generic import TemplateView
 from django import http
-from life.models import Locale, Tree, Push, Changeset
+from life.models import Locale, Tree, Push
 from l10nstats.models import Run
 from shipping.models import AppVersion, Action
 from shipping.api import flags4appversions
 from django.conf import settings
-from django.db.models import Max
 from django.utils.http import urlencode
 from django.utils.safestring import mark_safe
 
@@ -294,20 +293,16 @@ def teamsnippet(loc, team_locales):
         for p in pushes
         if p is not None
     ]
-    tip4push = dict(Push.objects
-                    .annotate(tc=Max('changesets'))
+    rev4push = dict(Push.objects
                     .filter(id__in=pushes)
-                    .values_list('id', 'tc'))
-    rev4id = dict(Changeset.objects
-                  .filter(id__in=tip4push.values())
-                  .values_list('id', 'revision'))
+                    .values_list('id', 'tip__revision'))
     for runs in six.itervalues(applications):
         for run in runs:
             actions = [run.accepted] if run.accepted else []
             if run.actions:
                 actions += run.actions
             for action in actions:
-                action.rev = rev4id[tip4push[action.push.id]][:12]
+                action.rev = rev4push[action.push.id][:12]
                 # unset the suggestion if there's existing signoff action
                 if action.rev == run.suggested_shortrev:
                     run.suggested_shortrev = None
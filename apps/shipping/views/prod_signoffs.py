@@ -99,8 +99,7 @@ class SignoffTableView(TemplateView):
             for id_, name, last in
             Push.objects
             .filter(id__in=push_ids)
-            .annotate(last=Max('changesets'))
-            .values_list('id', 'repository__name', 'last')
+            .values_list('id', 'repository__name', 'tip')
         }
         cs2rev = dict(
             Changeset.objects
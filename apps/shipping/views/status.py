@@ -10,13 +10,12 @@ import six
 
 from django.http import HttpResponse, HttpResponseBadRequest
 from django.views.generic import View
-from life.models import Changeset, Locale, Push
+from life.models import Locale, Push
 from l10nstats.models import Run
 from shipping.api import accepted_signoffs, flags4appversions
 from shipping.models import Action, Signoff, AppVersion
 from django.views.decorators.cache import cache_control
 import json
-from django.db.models import Max
 
 from .utils import class_decorator
 from shipping.forms import SignoffFilterForm
@@ -79,11 +78,10 @@ class Changesets(SignoffDataView):
     filename = 'l10n-changesets'
 
     def content(self, request, signoffs):
-        sos = signoffs.annotate(tip=Max('push__changesets__id'))
-        tips = dict(sos.values_list('locale__code', 'tip'))
-        revs = Changeset.objects.filter(id__in=tips.values())
-        revmap = dict(revs.values_list('id', 'revision'))
-        return ['%s %s\n' % (l, revmap[tips[l]][:12])
+        tips = dict(
+            signoffs.values_list('locale__code', 'push__tip__revision')
+        )
+        return ['%s %s\n' % (l, tips[l][:12])
                 for l in sorted(tips.keys())]
 
 
@@ -363,8 +361,7 @@ class StatusJSON(SignoffDataView):
             so_tips = dict(
                 Signoff.objects
                 .filter(id__in=old_signoffs)
-                .annotate(cs=Max("push__changesets"))
-                .values_list('id', 'cs')
+                .values_list('id', 'push__tip')
             )
             latest_changeset = dict((t[4], t[1]) for t in maybe_new_run)
             for so_id, tip in six.iteritems(so_tips):
@@ -0,0 +1,113 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+'''Precompute the diffs that sign-off reviewers are likely to open.
+
+Reviewers start with the diff between the newest push and the last
+accepted sign-off, see SignoffView.annotated_pushes. When new pushes come
+in, compute those diffs on a few background threads, so that the first
+click on them comes from the cache.
+'''
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import threading
+
+from django.conf import settings
+from django.db import connection
+import markus
+
+from life.models import Repository
+from pushes.views import diff
+from shipping.api import flags4appversions
+from shipping.models import AppVersion, AppVersionTreeThrough, Action
+
+
+metrics = markus.get_metrics('shipping.warmup')
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def queue_signoff_diffs(sender, repository, pushes, **kwargs):
+    '''Receiver for pushes_ingested, queues warm_signoff_diffs for
+    locale repositories.
+
+    Disabled if the DIFF_WARMUP_WORKERS setting is 0.
+    '''
+    if not settings.DIFF_WARMUP_WORKERS or repository.locale_id is None:
+        return
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=settings.DIFF_WARMUP_WORKERS
+            )
+    _executor.submit(_run, repository.id)
+
+
+def _run(repo_id):
+    try:
+        warm_signoff_diffs(repo_id)
+    except Exception:
+        logging.exception('Warming up diffs for {} failed'.format(repo_id))
+    finally:
+        # we're on our own thread, with our own connection
+        connection.close()
+
+
+def warm_signoff_diffs(repo_id):
+    '''Compute and cache the sign-off diffs for the repository.
+    '''
+    repo = Repository.objects.select_related('locale').get(id=repo_id)
+    for _from, _to in signoff_diffs(repo):
+        with metrics.timer('diff'):
+            diff.warm(repo.name, _from, _to)
+
+
+def signoff_diffs(repo):
+    '''Return the (from, to) revisions of the diffs between the newest push
+    in repo and the accepted sign-offs, for the appversions accepting
+    sign-offs.
+
+    Like the sign-off view, the accepted sign-off may be on a push to
+    another repository of the locale, the diff is still shown in repo.
+    '''
+    if repo.locale_id is None or repo.forest_id is None:
+        return []
+    tips = (
+        repo.push_set
+        .filter(changesets__branch__id=1)  # default branch
+        .order_by('-push_date', '-id')
+        .values_list('tip__revision', flat=True)[:1]
+    )
+    if not tips or tips[0] is None:
+        return []
+    tip = tips[0]
+    appvers = AppVersion.objects.filter(
+        accepts_signoffs=True,
+        trees_over_time__in=(
+            AppVersionTreeThrough.objects.current()
+            .filter(tree__l10n=repo.forest_id)
+        )
+    ).distinct()
+    accepted = set()
+    for locales in flags4appversions(
+        appvers, locales=[repo.locale_id]
+    ).values():
+        _, flags = locales.get(repo.locale.code, [None, {}])
+        if Action.ACCEPTED in flags:
+            accepted.add(flags[Action.ACCEPTED])
+    revisions = set(
+        Action.objects
+        .filter(id__in=accepted)
+        .values_list('signoff__push__tip__revision', flat=True)
+    )
+    return sorted(
+        (revision, tip)
+        for revision in revisions
+        if revision is not None and revision != tip
+    )
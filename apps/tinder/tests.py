@@ -15,12 +15,12 @@ from elmo.test import TestCase
 from elmo_commons.tests.mixins import EmbedsTestCaseMixin
 from django.urls import reverse
 from django.test import override_settings
-from django.test.client import Client
+from django.test.client import Client, RequestFactory
 from django.utils.encoding import force_text
 from mbdb.models import (Build, Change, Master, Log, Property, SourceStamp,
                          Builder, Slave)
 import tinder.views
-from tinder.views import _waterfall, LogMountKeyError
+from tinder.views import _waterfall, tbpl_inner, LogMountKeyError
 from tinder.templatetags import build_extras
 
 
@@ -56,6 +56,55 @@ class WaterfallStarted(TestCase):
         response = self.client.get(url)
         self.assertEqual(response.status_code, 200)
 
+    def testTbplDimensions(self):
+        '''Filter builds on the locale column'''
+        request = RequestFactory().get('/', {'locale': 'af'})
+        stamps = list(tbpl_inner(request))
+        self.assertEqual(len(stamps), 1)
+        props = [b['props'] for b in stamps[0]['builds']]
+        self.assertEqual(len(props), 2)
+        self.assertEqual(props[0], {
+            'locale': 'af',
+            'slavename': 'bot1',
+            'tree': 'tree',
+        })
+        request = RequestFactory().get('/', {'locale': 'de'})
+        self.assertListEqual(list(tbpl_inner(request)), [])
+
+    def testTbplProperties(self):
+        '''Filter builds on other properties by value hash'''
+        request = RequestFactory().get('/', {'app': 'browser'})
+        stamps = list(tbpl_inner(request))
+        self.assertEqual(len(stamps), 1)
+        self.assertEqual(len(stamps[0]['builds']), 2)
+        request = RequestFactory().get('/', {'app': 'mail'})
+        self.assertListEqual(list(tbpl_inner(request)), [])
+
+    def testWaterfallFilters(self):
+        '''Filter the waterfall on the locale column and properties'''
+        request = RequestFactory().get('/', {'locale': 'de'})
+        blame, buildercolumns, filters, times = _waterfall(request)
+        self.assertEqual(len(buildercolumns), 0)
+        self.assertEqual(filters, 'locale=de&')
+        request = RequestFactory().get('/', {'app': 'browser'})
+        blame, buildercolumns, filters, times = _waterfall(request)
+        self.assertEqual(len(buildercolumns), 1)
+        request = RequestFactory().get('/', {'app': 'mail'})
+        blame, buildercolumns, filters, times = _waterfall(request)
+        self.assertEqual(len(buildercolumns), 0)
+
+    def testLongDimensions(self):
+        '''Filter on values longer than their column'''
+        slavename = 'bot-' + 'x' * 200
+        for build in Build.objects.all():
+            build.setProperty('slavename', slavename, 'BuildSlave')
+        request = RequestFactory().get('/', {'slavename': slavename})
+        stamps = list(tbpl_inner(request))
+        self.assertEqual(len(stamps), 1)
+        self.assertEqual(len(stamps[0]['builds']), 2)
+        blame, buildercolumns, filters, times = _waterfall(request)
+        self.assertEqual(len(buildercolumns), 1)
+
 
 class WaterfallParallel(TestCase):
     fixtures = ['parallel_builds.json']
@@ -88,6 +88,8 @@ def tbpl_inner(request):
     """
     ss = SourceStamp.objects.filter(builds__isnull=False).order_by('-pk')
     props = []
+    # filters on the locale, tree, and slavename columns
+    dimensions = {}
     if request is not None:
         for key, values in request.GET.lists():
             if key == "random":
@@ -106,18 +108,28 @@ def tbpl_inner(request):
                 except (IndexError, ValueError):
                     pass
                 continue
+            if key in Build.DIMENSIONS:
+                dimensions[key + '__in'] = [
+                    Build.dimension(key, val) for val in values
+                ]
+                continue
             q = Q()
             for val in values:
-                q = q | Q(name=key, value=val)
+                q = q | Q(name=key, value_hash=Property.hash_value(val))
             if q:
                 props.append(list(Property.objects
                                   .filter(q)
                                   .values_list('id', flat=True)))
+    if dimensions:
+        ss = ss.filter(**{
+            'builds__' + lookup: values
+            for lookup, values in dimensions.items()
+        })
     for _p in props:
         ss = ss.filter(builds__properties__in=_p)
     ss = ss.distinct()
     ss = list(ss[:10])
-    blds = Build.objects.filter(sourcestamp__in=ss)
+    blds = Build.objects.filter(sourcestamp__in=ss, **dimensions)
     for _p in props:
         blds = blds.filter(properties__in=_p)
     nc = NumberedChange.objects.filter(sourcestamp__in=ss)
@@ -160,12 +172,15 @@ def tbpl_inner(request):
         changes_for_source[_nc.sourcestamp_id].append(_nc.change)
     for _cs in changes_for_source.values():
         _cs.sort(key=lambda c: c.id, reverse=True)
-    bld_ids = list(blds.values_list('id', flat=True))
-    bprops = pmap(('locale', 'tree', 'slavename'), bld_ids)
-
+    bprops = {}
     builds_for_source = defaultdict(list)
     for b in blds.filter(sourcestamp__in=ss).select_related('builder'):
         builds_for_source[b.sourcestamp_id].append(b)
+        bprops[b.id] = {
+            name: getattr(b, name)
+            for name in Build.DIMENSIONS
+            if getattr(b, name) is not None
+        }
     for _b in builds_for_source.values():
         _b.sort(key=lambda b: b.id)
     pending = defaultdict(int)
@@ -403,14 +418,16 @@ def _waterfall(request):
             if opt in filters:
                 filters.pop(opt)
         builderopts = ['name', 'category']
-        buildopts = ['slavename']
+        buildopts = Build.DIMENSIONS
         for k, v in filters.items():
             if k in builderopts:
                 buildf[str('builder__' + k)] = v
             elif k in buildopts:
-                buildf[str(k)] = v
+                buildf[str(k)] = Build.dimension(k, v)
             else:
-                props.append(Property.objects.filter(name=k).filter(value=v))
+                props.append(Property.objects.filter(
+                    name=k, value_hash=Property.hash_value(v)
+                ))
 
     # get the real hours, for consecutive queries
     hours = 12
@@ -619,6 +636,7 @@ def builds_for_change(request):
 
         url = str(
             Push.objects
+            .select_related('repository', 'tip')
             .get(changesets__revision__startswith=change.revision,
                  repository__name__startswith=change.branch)
         )
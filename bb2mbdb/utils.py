@@ -9,9 +9,9 @@ from __future__ import unicode_literals
 from datetime import datetime
 import os.path
 
-from mbdb.models import Change, Tag, File, SourceStamp
+from mbdb.files import file_ids
+from mbdb.models import Change, Tag, SourceStamp
 from django.db import transaction
-import six
 
 
 def timeHelper(t):
@@ -39,10 +39,7 @@ def modelForChange(master, change):
         if not change.files:
             return dbchange
 
-        dbfiles = list(File.objects.filter(path__in=change.files))
-        newfiles = set(change.files) - set((six.text_type(f) for f in dbfiles))
-        dbfiles += [File.objects.create(path=file) for file in newfiles]
-        dbchange.files.add(*dbfiles)
+        dbchange.files.add(*file_ids.resolve(change.files).values())
         return dbchange
 
 
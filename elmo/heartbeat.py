@@ -46,8 +46,8 @@ def heartbeat(request):
             status_code = 500
     if data['mounts'] == 'ok':
         try:
-            import hglib
-            with hglib.open(repos[0].local_path()) as client:
+            from pushes.hgpool import hg_pool
+            with hg_pool.client(repos[0].local_path()) as client:
                 client.tip()
             data['mercurial'] = 'ok'
         except Exception as e:
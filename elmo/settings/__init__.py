@@ -142,10 +142,12 @@ for key in (
     'PULSE_USER',
     'PULSE_PASSWORD',
     'PULSE_TTL',  # default set in base.py
+    'PULSE_WORKERS',  # default set in base.py
+    'PULSE_COALESCE_WINDOW',  # default set in base.py
 ):
     if key in os.environ:
         val = os.environ[key]
-        if key == 'PULSE_TTL':
+        if key in ('PULSE_TTL', 'PULSE_WORKERS', 'PULSE_COALESCE_WINDOW'):
             try:
                 val = int(val)
             except ValueError:
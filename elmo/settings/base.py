@@ -194,11 +194,21 @@ INCLUDE_ANALYTICS = False
 PROGRESS_DAYS = 50
 PROGRESS_IMG_SIZE = {'x': 100, 'y': 20}
 
+# bytes of parsed files to keep in memory for diffs
+DIFF_ENTITY_CACHE_SIZE = 64 * 1024 * 1024
+# number of threads precomputing sign-off diffs after new pushes,
+# 0 to disable
+DIFF_WARMUP_WORKERS = 0
+
 # settings for consumers of pulse.mozilla.org
 PULSE_HOST = 'amqp://pulse.mozilla.org:5671'
 PULSE_SSL = True
 PULSE_USER='_test_'
 PULSE_TTL=None
+# number of threads handling pushes, in parallel for different repositories
+PULSE_WORKERS = 1
+# seconds to wait for more pushes to the same repository, to merge them
+PULSE_COALESCE_WINDOW = 5
 
 
 __all__ = [